@@ -0,0 +1,357 @@
+# api_server.py
+# Headless HTTP API for the recommendation pipeline (no Streamlit needed).
+#   POST /v1/recommend         {"query": ..., "category_score_threshold": 6} -> JSON summary of the run
+#   GET  /v1/recommend/stream  ?q=...&threshold=6 -> the pipeline's events as server-sent events
+#   GET  /healthz              liveness of the worker
+#   GET  /readyz               SQLite catalog and prompt files present (503 otherwise)
+# The parent process binds the port and pre-forks API_WORKERS processes that
+# accept on the shared socket, restarting any that die. Finished runs are kept
+# in the SQLite result cache (API_RESULT_CACHE), which all workers read, so a
+# query answered by one worker is replayed by the others without LLM calls.
+#
+#   python -m api_server --workers 4 --port 8000
+#   curl -N 'http://localhost:8000/v1/recommend/stream?q=vestido+para+casamento+na+praia'
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import signal
+import sqlite3
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+from config.config import (
+    API_HOST, API_PORT, API_WORKERS, API_RESULT_CACHE, API_RESULT_TTL, ASYNC_PIPELINE, DB_PATH, QUERY_SINGLE_FLIGHT,
+)
+from run_user_query import (
+    ATTRIBUTE_INFO, PIPELINE_PROMPTS, PROMPT_MAPPING, aprocess_user_query_streaming, process_user_query_streaming,
+)
+from utils.admission import admission_stats
+from utils.async_runtime import iterate_async
+from utils.llm_cache import get_cache
+from utils.single_flight import join_flight, query_flight_key
+
+DEFAULT_THRESHOLD = 6
+# Largest request body accepted by POST /v1/recommend
+MAX_BODY_BYTES = 64 * 1024
+# Pause before a worker that died is replaced, so a crash loop does not spin
+RESPAWN_DELAY_S = 1.0
+
+# Tables /readyz expects in the catalog
+CATALOG_TABLES = ["products", "products_taxonomy", "attributes", "message"] + [
+    info["table"] for info in ATTRIBUTE_INFO.values()]
+TERMINAL_STATUSES = ("final_result", "final_message", "error")
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def _start_run(user_query, threshold):
+    """The pipeline's events, run the way the Streamlit orchestrator runs it (and joined with its runs)."""
+    def start():
+        if ASYNC_PIPELINE:
+            return iterate_async(aprocess_user_query_streaming(user_query, threshold))
+        return process_user_query_streaming(user_query, threshold)
+
+    if QUERY_SINGLE_FLIGHT:
+        return join_flight(query_flight_key(user_query, threshold), start)
+    return start()
+
+
+def _result_cache():
+    return get_cache("api_results", ttl=API_RESULT_TTL)
+
+
+def _recorded(user_query, threshold):
+    """Events of a live run; a complete, non-degraded run is stored for the other workers."""
+    kept = []
+    for event in _start_run(user_query, threshold):
+        if event.get("status") != "progress":
+            kept.append(event)
+        yield event
+    last = kept[-1] if kept else {}
+    if API_RESULT_CACHE and last.get("status") == "final_result" and not last.get("degraded"):
+        _result_cache().put(query_flight_key(user_query, threshold), json.dumps(kept, ensure_ascii=False, default=str))
+
+
+def query_events(user_query, threshold):
+    """(events, cached): the stored run from the result cache, else a live pipeline run."""
+    if API_RESULT_CACHE:
+        payload = _result_cache().get(query_flight_key(user_query, threshold))
+        if payload:
+            return iter(json.loads(payload)), True
+    return _recorded(user_query, threshold), False
+
+
+def summarize(events, cached=False):
+    """The JSON answer for a finished run: context, selections, products and the terminal event's fields."""
+    summary = {"status": None, "context": None, "attributes": [], "categories": [], "products": {},
+               "message": None, "degraded": False, "metrics": None, "cached": cached}
+    for event in events:
+        status = event.get("status")
+        if status == "context_result":
+            summary["context"] = event.get("data")
+        elif status == "intermediate_result" and event.get("type") in ("attributes", "categories"):
+            summary[event["type"]] = event.get("data") or []
+        elif status in TERMINAL_STATUSES:
+            summary["status"] = status
+            summary["message"] = event.get("message")
+            summary["degraded"] = bool(event.get("degraded"))
+            summary["metrics"] = event.get("metrics")
+            if status == "final_result":
+                summary["products"] = event.get("data") or {}
+    return summary
+
+
+def readiness():
+    """(ready, checks): the catalog opens read-only with its tables and products, and every prompt file is there."""
+    checks = {}
+    try:
+        with contextlib.closing(sqlite3.connect(Path(DB_PATH).resolve().as_uri() + "?mode=ro", uri=True)) as conn:
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            missing = [table for table in CATALOG_TABLES if table not in tables]
+            products = conn.execute("SELECT COUNT(*) FROM products").fetchone()[0] if "products" in tables else 0
+        checks["catalog"] = {"ok": not missing and products > 0, "path": DB_PATH, "products": products,
+                             "missing_tables": missing}
+    except sqlite3.Error as e:
+        checks["catalog"] = {"ok": False, "path": DB_PATH, "error": str(e)}
+    prompts = list(PIPELINE_PROMPTS) + [PROMPT_MAPPING["ContextAnalyzer"]]
+    missing = [path for path in prompts if not os.path.isfile(path) or not os.path.getsize(path)]
+    checks["prompts"] = {"ok": not missing, "count": len(prompts), "missing": missing}
+    return all(check["ok"] for check in checks.values()), checks
+
+
+def _threshold(value):
+    if value in (None, ""):
+        return DEFAULT_THRESHOLD
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise BadRequest("category_score_threshold must be an integer")
+
+
+def _content_length(value):
+    try:
+        length = int(value or 0)
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise BadRequest("Content-Length must be a non-negative integer")
+    return length
+
+
+def _query(value):
+    if not isinstance(value, str) or not value.strip():
+        raise BadRequest("query is required")
+    return value.strip()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "StyletellingAPI/1.0"
+
+    def _send_json(self, status: int, payload: dict, headers=None) -> None:
+        data = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        route = url.path.rstrip("/")
+        if route == "/healthz":
+            self._send_json(200, {"status": "ok", "worker": os.getpid()})
+        elif route == "/readyz":
+            ready, checks = readiness()
+            self._send_json(200 if ready else 503, {"ready": ready, "worker": os.getpid(), "checks": checks,
+                                                    "admission": admission_stats()})
+        elif route == "/v1/recommend/stream":
+            params = parse_qs(url.query)
+            try:
+                user_query = _query((params.get("q") or [None])[0])
+                threshold = _threshold((params.get("threshold") or [None])[0])
+            except BadRequest as e:
+                self._send_json(400, {"error": str(e)})
+                return
+            self._stream(user_query, threshold)
+        else:
+            self._send_json(404, {"error": f"no route for GET {url.path}"})
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip("/") != "/v1/recommend":
+            self._send_json(404, {"error": f"no route for POST {self.path}"})
+            return
+        try:
+            length = _content_length(self.headers.get("Content-Length"))
+        except BadRequest as e:
+            self.close_connection = True  # the body's extent is unknown, so nothing after it can be read
+            self._send_json(400, {"error": str(e)})
+            return
+        if length > MAX_BODY_BYTES:
+            self._send_json(413, {"error": "request body too large"})
+            return
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(body, dict):
+                raise BadRequest("body must be a JSON object")
+            user_query = _query(body.get("query"))
+            threshold = _threshold(body.get("category_score_threshold"))
+        except (BadRequest, json.JSONDecodeError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        try:
+            events, cached = query_events(user_query, threshold)
+            summary = summarize(events, cached)
+        except Exception as e:
+            traceback.print_exc()
+            self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+        # A pipeline error is an upstream (LLM) failure rather than a bad request
+        self._send_json(502 if summary["status"] == "error" else 200, summary,
+                        {"X-Cache": "hit" if cached else "miss"})
+
+    def _stream(self, user_query, threshold):
+        """
+        One SSE event per pipeline event ("event: <status>"); the connection
+        closes after the terminal one. A run that fails before its first event
+        is answered with JSON instead: 500, or 502 for a pipeline error event.
+        """
+        events = None
+        try:
+            try:
+                events, cached = query_events(user_query, threshold)
+                first = next(events, None)
+            except Exception as e:
+                traceback.print_exc()
+                self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+                return
+            if first is not None and first.get("status") == "error":
+                self._send_json(502, {"error": first.get("message")})
+                return
+            self._send_events(itertools.chain([first] if first is not None else [], events), cached)
+        finally:
+            # Closing the generator stops the run and frees its admission slot, however the response ended
+            close = getattr(events, "close", None)
+            if close is not None:
+                close()
+
+    def _send_events(self, events, cached):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.send_header("X-Accel-Buffering", "no")
+        self.send_header("X-Cache", "hit" if cached else "miss")
+        self.end_headers()
+        self.close_connection = True
+
+        def send(event_id, event):
+            data = json.dumps(event, ensure_ascii=False, default=str)
+            self.wfile.write(f"id: {event_id}\nevent: {event.get('status')}\ndata: {data}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        try:
+            for i, event in enumerate(events):
+                send(i, event)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # client went away
+        except Exception as e:
+            traceback.print_exc()
+            try:
+                send("error", {"status": "error", "message": f"{type(e).__name__}: {e}"})
+            except OSError:
+                pass
+
+
+def _serve_worker(server, address):
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()  # shutdown() waits for serve_forever
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"[API] Worker {os.getpid()} serving http://{address}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def serve(host=API_HOST, port=API_PORT, workers=API_WORKERS):
+    """Bind once, then pre-fork `workers` processes on the shared socket (in-process without fork)."""
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    address = f"{host}:{server.server_address[1]}"
+    ready, checks = readiness()
+    print(f"[API] Ready: {ready} {json.dumps(checks, ensure_ascii=False)}")
+    if workers <= 1 or not hasattr(os, "fork"):
+        _serve_worker(server, address)
+        return
+
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _serve_worker(server, address)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for _ in range(workers):
+        spawn()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"[API] {workers} workers on http://{address}")
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            print(f"[API] Worker {pid} exited (status {status}); starting a new one")
+            time.sleep(RESPAWN_DELAY_S)
+            spawn()
+    server.server_close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Headless HTTP API (JSON and SSE) for the styletelling pipeline.")
+    parser.add_argument("--host", default=API_HOST)
+    parser.add_argument("--port", type=int, default=API_PORT)
+    parser.add_argument("--workers", type=int, default=API_WORKERS, help="worker processes (1 = no fork)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    serve(args.host, args.port, args.workers)
+
+
+if __name__ == "__main__":
+    main()
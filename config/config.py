@@ -1,3 +1,4 @@
+import json
 import os
 from pathlib import Path
 
@@ -35,6 +36,16 @@ def _get(key: str, default=None):
                 return int(val)
             except Exception:
                 return default
+        if isinstance(default, float):
+            try:
+                return float(val)
+            except Exception:
+                return default
+        if isinstance(default, (dict, list)):
+            try:
+                return json.loads(val)
+            except Exception:
+                return default
         return val
     if key in _cfg:
         return _cfg[key]
@@ -126,6 +137,113 @@ LAYOUT: str = _get("LAYOUT", "wide")
 USE_CACHE: bool = _get("USE_CACHE", True)
 SHOW_CACHE_TOOLS: bool = _get("SHOW_CACHE_TOOLS", False)
 
+# LLM connections
+LLM_PREWARM: bool = _get("LLM_PREWARM", False)
+LLM_MAX_CONNECTIONS: int = _get("LLM_MAX_CONNECTIONS", 20)
+LLM_KEEPALIVE_EXPIRY: float = _get("LLM_KEEPALIVE_EXPIRY", 60.0)
+LLM_REQUEST_TIMEOUT: float = _get("LLM_REQUEST_TIMEOUT", 60.0)
+# Stream the attribute selection and start each attribute analysis as its field arrives
+LLM_STREAMING: bool = _get("LLM_STREAMING", False)
+# Send each prompt's JSON schema as response_format (json_object on providers without schema support).
+# On by default: the schemas describe the JSON the prompts already ask for, and answers that
+# do not fit them still go through the old lenient parser; set false to send no response_format
+LLM_STRUCTURED_OUTPUT: bool = _get("LLM_STRUCTURED_OUTPUT", True)
+
+# Run queries on the shared asyncio event loop instead of a thread per LLM call
+ASYNC_PIPELINE: bool = _get("ASYNC_PIPELINE", False)
+# Run all seven attribute analyzers alongside step 2 and keep the selected five (less latency, more tokens)
+SPECULATIVE_ATTRIBUTES: bool = _get("SPECULATIVE_ATTRIBUTES", False)
+# One prompt (prompt_context_selection.txt) for steps 1 and 2 instead of two round-trips
+FUSED_CONTEXT_SELECTION: bool = _get("FUSED_CONTEXT_SELECTION", False)
+# Step 3: "fanout" (one call per attribute) or "batched" (all selected attributes in one call)
+ATTRIBUTE_ANALYSIS_MODE: str = _get("ATTRIBUTE_ANALYSIS_MODE", "fanout")
+
+# LLM rate limiting / retries (per provider: max_in_flight, rpm, tpm)
+LLM_RATE_LIMITS: dict = _get("LLM_RATE_LIMITS", {})
+# Retries after a failed attempt; 1 keeps call_model's earlier single retry, now with backoff
+LLM_MAX_RETRIES: int = _get("LLM_MAX_RETRIES", 1)
+LLM_BACKOFF_BASE: float = _get("LLM_BACKOFF_BASE", 1.0)
+LLM_BACKOFF_MAX: float = _get("LLM_BACKOFF_MAX", 30.0)
+LLM_QUEUE_TIMEOUT: float = _get("LLM_QUEUE_TIMEOUT", 60.0)
+
+# Hedged requests (opt-in): delays per stage in seconds or as "p90"-style percentiles
+LLM_HEDGE_ENABLED: bool = _get("LLM_HEDGE_ENABLED", False)
+LLM_HEDGE_DELAYS: dict = _get("LLM_HEDGE_DELAYS", {"default": 5.0})
+LLM_HEDGE_MODELS: dict = _get("LLM_HEDGE_MODELS", {})
+LLM_HEDGE_MAX_RATIO: float = _get("LLM_HEDGE_MAX_RATIO", 0.1)
+
+# Circuit breakers and per-stage fallback chains ({stage|default: [model aliases]})
+LLM_BREAKER_FAILURES: int = _get("LLM_BREAKER_FAILURES", 3)
+LLM_BREAKER_COOLDOWN: float = _get("LLM_BREAKER_COOLDOWN", 30.0)
+LLM_BREAKER_SLOW_CALL_S: float = _get("LLM_BREAKER_SLOW_CALL_S", 30.0)
+LLM_FALLBACKS: dict = _get("LLM_FALLBACKS", {})
+
+# LLM response cache (opt-in): content-addressed, SQLite-backed, TTL + LRU bounded
+LLM_CACHE: bool = _get("LLM_CACHE", False)
+LLM_CACHE_PATH: str = _get("LLM_CACHE_PATH", "data/llm_cache.sqlite")
+LLM_CACHE_TTL: int = _get("LLM_CACHE_TTL", 86400)
+LLM_CACHE_MAX_ENTRIES: int = _get("LLM_CACHE_MAX_ENTRIES", 5000)
+
+# Identical in-flight queries (same canonical text) share one pipeline run, and the
+# sessions that join it get the model routes of the session that started it (opt-in);
+# with LLM_SINGLE_FLIGHT identical in-flight LLM requests also share one API call
+QUERY_SINGLE_FLIGHT: bool = _get("QUERY_SINGLE_FLIGHT", False)
+LLM_SINGLE_FLIGHT: bool = _get("LLM_SINGLE_FLIGHT", False)
+
+# Step-5 memo: categories reused across queries with the same attribute values and context bucket
+LOOK_COMPOSER_MEMO: bool = _get("LOOK_COMPOSER_MEMO", False)
+LOOK_COMPOSER_MEMO_TTL: int = _get("LOOK_COMPOSER_MEMO_TTL", 7 * 86400)
+
+# Step-3 lexical fast path from the taxonomy keywords (off | skip | preliminary)
+LEXICAL_FAST_PATH: str = _get("LEXICAL_FAST_PATH", "off")
+LEXICAL_CONFIDENCE: float = _get("LEXICAL_CONFIDENCE", 0.5)
+
+# Mensagem from the `message` combination table (llm | derived | tiebreak)
+MENSAGEM_MODE: str = _get("MENSAGEM_MODE", "llm")
+
+# Adaptive per-stage model routing (opt-in); MODEL_ROUTING {stage: alias} pins stages regardless
+MODEL_ROUTER: bool = _get("MODEL_ROUTER", False)
+MODEL_ROUTING: dict = _get("MODEL_ROUTING", {})
+ROUTER_CANDIDATES: dict = _get("ROUTER_CANDIDATES", {"default": ["gpt-4o", "gpt-4o-mini"]})
+ROUTER_QUALITY_FLOOR: dict = _get("ROUTER_QUALITY_FLOOR", {"default": 0.95})
+ROUTER_MIN_SAMPLES: int = _get("ROUTER_MIN_SAMPLES", 10)
+ROUTER_EXPLORE_RATE: float = _get("ROUTER_EXPLORE_RATE", 0.05)
+ROUTER_BENCH_GLOB: str = _get("ROUTER_BENCH_GLOB", "llm/bench_results_*.xlsx")
+
+# Record/replay of LLM traffic: "off", "record" or "replay" (offline, no API keys)
+LLM_CASSETTE_MODE: str = _get("LLM_CASSETTE_MODE", "off")
+LLM_CASSETTE_PATH: str = _get("LLM_CASSETTE_PATH", "data/llm_cassette.jsonl.gz")
+LLM_CASSETTE_REPLAY_LATENCY: bool = _get("LLM_CASSETTE_REPLAY_LATENCY", False)
+
+# Endpoint of the local stand-in server (llm/stand_in_server.py), model alias "local-stand-in"
+STAND_IN_URL: str = _get("STAND_IN_URL", "http://127.0.0.1:8790/v1")
+
+# Per-query LLM budgets (0 = unlimited); further calls are skipped once spent
+QUERY_TOKEN_BUDGET: int = _get("QUERY_TOKEN_BUDGET", 0)
+QUERY_COST_BUDGET: float = _get("QUERY_COST_BUDGET", 0.0)
+
+# Per-query deadline in seconds (0 = none): a late context analysis is replaced by the empty
+# context, a late attribute selection by DEADLINE_ATTRIBUTES, late attribute analyses are
+# dropped and a late look composer is replaced by DEADLINE_CATEGORIES; the result is flagged as degraded
+QUERY_DEADLINE_S: float = _get("QUERY_DEADLINE_S", 0.0)
+DEADLINE_ATTRIBUTES: list = _get("DEADLINE_ATTRIBUTES", ["Mensagem", "Cor", "Estrutura", "Material", "Textura"])
+DEADLINE_CATEGORIES: list = _get("DEADLINE_CATEGORIES", ["VESTIDOS", "BLUSAS & TOPS", "CALÇAS", "SAIAS", "CAMISAS"])
+
+# Queries running at once across all sessions (0 = unlimited, as before admission control);
+# the rest wait in a FIFO queue
+MAX_CONCURRENT_QUERIES: int = _get("MAX_CONCURRENT_QUERIES", 0)
+# Threads per shared pool, sized for 8 queries in flight: up to 6 stages at once per query,
+# 9 LLM calls (7 speculative analyzers, look composer, one spare), 5 categories ranked
+# (SQLite-bound, so 16 is ~3 queries' worth); "hedged" runs primaries of hedged LLM requests
+EXECUTOR_WORKERS: dict = _get("EXECUTOR_WORKERS", {"stages": 48, "llm": 72, "ranking": 16, "hedged": 72})
+
+# Headless HTTP API (api_server.py): pre-forked worker processes sharing the SQLite result cache
+API_HOST: str = _get("API_HOST", "0.0.0.0")
+API_PORT: int = _get("API_PORT", 8000)
+API_WORKERS: int = _get("API_WORKERS", 2)
+API_RESULT_CACHE: bool = _get("API_RESULT_CACHE", True)
+API_RESULT_TTL: int = _get("API_RESULT_TTL", 3600)
+
 
 def get_api_key(name: str) -> str | None:
     """
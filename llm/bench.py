@@ -4,7 +4,8 @@ from pathlib import Path
 from datetime import datetime
 
 from utils import llm_utils
-from utils.llm_utils import execute_prompt, last_input_tokens, last_output_tokens, last_cost
+from utils.llm_utils import execute_prompt
+from utils.metering import metering_scope
 
 
 # ---- simple config you can edit in PyCharm ----
@@ -61,15 +62,20 @@ def compute_cost(in_tok, out_tok, pricing):
     po = float(pricing.get("output", 0.0))
     return (in_tok / 1e6) * pi + (out_tok / 1e6) * po
 
-def write_xlsx(rows, out_path: Path):
+BENCH_HEADERS = ["model","prompt_file","query","latency_ms","input_tokens","output_tokens","cost_usd","quality_ok","quality_reason"]
+ATTRIBUTE_MODE_HEADERS = ["model","query","mode","latency_ms","calls","input_tokens","cached_tokens","output_tokens",
+                          "cost_usd","attributes_answered","top_value_agreement"]
+MENSAGEM_HEADERS = ["model","query","llm_latency_ms","derived_latency_ms","llm_top","derived_top","derived_share",
+                    "top1_agreement","llm_top_in_derived_top3","tiebreak_reordered"]
+
+def write_xlsx(rows, out_path: Path, headers=BENCH_HEADERS, title="bench"):
     try:
         from openpyxl import Workbook
     except ImportError:
         raise SystemExit("openpyxl not installed. Run: pip install openpyxl")
     wb = Workbook()
     ws = wb.active
-    ws.title = "bench"
-    headers = ["model","prompt_file","query","latency_ms","input_tokens","output_tokens","cost_usd","quality_ok","quality_reason"]
+    ws.title = title
     ws.append(headers)
     for r in rows:
         ws.append([r.get(h) for h in headers])
@@ -107,12 +113,6 @@ def resolve_prompt_files():
         print(f"Warning: missing pinned prompts, falling back to glob: {missing}")
     return sorted((BASE_DIR.parent).glob("prompts/*.txt"))
 
-def _val(x):
-    try:
-        return x() if callable(x) else x
-    except Exception:
-        return None
-
 def run():
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
     cfg = load_yaml(MODELS_YAML)
@@ -133,12 +133,14 @@ def run():
             for q in queries:
                 t0 = time.perf_counter()
                 try:
-                    resp = execute_prompt(
-                        api_model=alias,
-                        prompt_file=p_str,
-                        user_query=q,
-                        **defaults
-                    )
+                    # Per-call meter: the llm_utils last_* globals are shared across threads
+                    with metering_scope() as meter:
+                        resp = execute_prompt(
+                            api_model=alias,
+                            prompt_file=p_str,
+                            user_query=q,
+                            **defaults
+                        )
                 except Exception as e:
                     latency_ms = round((time.perf_counter() - t0) * 1000, 2)
                     err = f"{type(e).__name__}: {e}"
@@ -154,13 +156,12 @@ def run():
                 text = resp if isinstance(resp, str) else json.dumps(resp, ensure_ascii=False)
                 ok, reason = soft_json_ok(text)
 
-                in_tok = _val(getattr(llm_utils, "last_input_tokens", None))
-                out_tok = _val(getattr(llm_utils, "last_output_tokens", None))
-                last_cost_val = _val(getattr(llm_utils, "last_cost", None))
+                usage = meter.totals()
+                in_tok = usage["input_tokens"]
+                out_tok = usage["output_tokens"]
 
                 pricing = mcfg.get("pricing_per_million") or mcfg.get("cost_per_million")
-                cost = last_cost_val if isinstance(last_cost_val, (int, float)) else compute_cost(in_tok, out_tok,
-                                                                                                  pricing)
+                cost = usage["cost"] or compute_cost(in_tok, out_tok, pricing)
 
                 results.append({
                     "model": alias,
@@ -180,5 +181,148 @@ def run():
     write_xlsx(results, out_path)
     print(f"Saved: {out_path}")
 
+def _top_values(blocks):
+    return {b.get("attribute"): str(b.get("value_1_id")) for b in blocks if isinstance(b, dict)}
+
+def _fanout_attributes(alias, row, attrs, templates):
+    """Step 3 as the pipeline fans it out: one call per attribute, all in flight at once."""
+    from concurrent.futures import ThreadPoolExecutor
+    from run_user_query import PROMPT_MAPPING
+    from utils.execute_prompt import execute_prompt as execute_stage_prompt
+    from utils.metering import bind_meter, current_meter
+
+    call = bind_meter(current_meter(), execute_stage_prompt)
+    with ThreadPoolExecutor(max_workers=len(attrs)) as executor:
+        futures = [executor.submit(call, row, prompt_template=templates[PROMPT_MAPPING[a]],
+                                   prompt_template_path=PROMPT_MAPPING[a], api_model=alias) for a in attrs]
+        return [f.result() for f in futures]
+
+def run_attribute_modes(aliases=None):
+    """
+    Step 3 fan-out (one call per attribute) vs ATTRIBUTE_ANALYSIS_MODE=batched
+    (one call for all of them) over every query, through the pipeline's own
+    call path. Models are MODELS aliases (args, else the models.yaml aliases
+    known to llm_utils, else MODEL). top_value_agreement is the share of
+    attributes whose best value matches the fan-out's.
+    """
+    from run_user_query import ANALYZER_ATTRIBUTES, PIPELINE_PROMPTS, analyze_attributes_batched
+    from utils.util_functions import load_prompt
+
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    queries = load_lines(QUERIES_PATH)
+    if not queries: raise SystemExit("No queries in queries.csv")
+    aliases = aliases or _default_aliases()
+
+    templates = {path: load_prompt(path) for path in PIPELINE_PROMPTS}
+    attrs = list(ANALYZER_ATTRIBUTES)
+    modes = {
+        "fanout": lambda alias, row: _fanout_attributes(alias, row, attrs, templates),
+        "batched": lambda alias, row: analyze_attributes_batched(attrs, row, templates, api_model=alias),
+    }
+
+    results = []
+    for alias in aliases:
+        for q in queries:
+            row = {"user_query": q, "query_context": "{}"}
+            baseline = None
+            for mode, analyze in modes.items():
+                t0 = time.perf_counter()
+                with metering_scope() as meter:
+                    try:
+                        blocks = [b for b in analyze(alias, row) if isinstance(b, dict)]
+                    except Exception as e:
+                        print(f"[{alias}] {mode} | CALL FAIL: {type(e).__name__}: {e}")
+                        blocks = []
+                latency_ms = round((time.perf_counter() - t0) * 1000, 2)
+                usage = meter.totals()
+                top = _top_values(blocks)
+                if baseline is None:
+                    baseline = top
+                agreement = (sum(top.get(a) == v for a, v in baseline.items()) / len(baseline)) if baseline else None
+                results.append({
+                    "model": alias, "query": q, "mode": mode, "latency_ms": latency_ms,
+                    "calls": usage["calls"], "input_tokens": usage["input_tokens"],
+                    "cached_tokens": usage["cached_tokens"], "output_tokens": usage["output_tokens"],
+                    "cost_usd": round(usage["cost"], 6), "attributes_answered": len(blocks),
+                    "top_value_agreement": round(agreement, 3) if agreement is not None else None,
+                })
+                print(f"[{alias}] {mode} | {latency_ms} ms | {usage['input_tokens']}+{usage['output_tokens']} tokens"
+                      f" | {len(blocks)}/{len(attrs)} attributes")
+
+    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+    out_path = OUTPUT_DIR / f"bench_attribute_modes_{ts}.xlsx"
+    write_xlsx(results, out_path, ATTRIBUTE_MODE_HEADERS, "attribute_modes")
+    print(f"Saved: {out_path}")
+
+def _default_aliases():
+    from utils.execute_prompt import MODEL
+    known = llm_utils.MODELS
+    aliases = [a for a, _ in normalize_models(load_yaml(MODELS_YAML)) if a in known] if MODELS_YAML.exists() else []
+    return aliases or [MODEL]
+
+def run_mensagem(aliases=None):
+    """
+    Mensagem from its LLM call vs MENSAGEM_MODE=derived (the `message` table
+    ranked from the other attributes' LLM blocks) over every query. Agreement
+    compares the best title of each; llm_top_in_derived_top3 is the looser
+    check, and tiebreak_reordered tells whether "tiebreak" would change the
+    LLM's order.
+    """
+    from run_user_query import (MESSAGE_COMBINATION_ATTRIBUTES, PIPELINE_PROMPTS, PROMPT_MAPPING,
+                                break_mensagem_ties, derive_mensagem)
+    from utils.util_functions import load_prompt
+
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    queries = load_lines(QUERIES_PATH)
+    if not queries: raise SystemExit("No queries in queries.csv")
+    templates = {path: load_prompt(path) for path in PIPELINE_PROMPTS}
+    derive_mensagem([])  # loads the index, so the first query does not time the database read
+
+    results = []
+    for alias in aliases or _default_aliases():
+        for q in queries:
+            row = {"user_query": q, "query_context": "{}"}
+            try:
+                with metering_scope():
+                    blocks = [b for b in _fanout_attributes(alias, row, MESSAGE_COMBINATION_ATTRIBUTES, templates)
+                              if isinstance(b, dict)]
+                    t0 = time.perf_counter()
+                    llm_block = _fanout_attributes(alias, row, ["Mensagem"], templates)[0]
+                    llm_ms = round((time.perf_counter() - t0) * 1000, 2)
+            except Exception as e:
+                print(f"[{alias}] CALL FAIL: {type(e).__name__}: {e}")
+                continue
+            t0 = time.perf_counter()
+            derived = derive_mensagem(blocks)
+            derived_ms = round((time.perf_counter() - t0) * 1000, 3)
+            llm_top = str(llm_block.get("value_1_id")) if isinstance(llm_block, dict) else None
+            derived_top3 = [str(derived.get(f"value_{i}_id")) for i in range(1, 4)]
+            reordered = break_mensagem_ties(llm_block, blocks)[1] if isinstance(llm_block, dict) else None
+            results.append({
+                "model": alias, "query": q, "llm_latency_ms": llm_ms, "derived_latency_ms": derived_ms,
+                "llm_top": llm_top, "derived_top": derived_top3[0],
+                "derived_share": derived.get("value_1_justification"),
+                "top1_agreement": llm_top == derived_top3[0], "llm_top_in_derived_top3": llm_top in derived_top3,
+                "tiebreak_reordered": reordered,
+            })
+            print(f"[{alias}] mensagem | LLM {llm_ms} ms vs derived {derived_ms} ms | top {llm_top} vs {derived_top3[0]}")
+
+    if results:
+        agree = sum(r["top1_agreement"] for r in results) / len(results)
+        top3 = sum(r["llm_top_in_derived_top3"] for r in results) / len(results)
+        print(f"top-1 agreement {agree:.0%}, LLM top in derived top 3 {top3:.0%} over {len(results)} queries")
+    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+    out_path = OUTPUT_DIR / f"bench_mensagem_{ts}.xlsx"
+    write_xlsx(results, out_path, MENSAGEM_HEADERS, "mensagem")
+    print(f"Saved: {out_path}")
+
 if __name__ == "__main__":
-    run()
+    # python -m llm.bench                           -> prompt x model bench
+    # python -m llm.bench attribute-modes [alias..] -> step 3 fan-out vs batched
+    # python -m llm.bench mensagem [alias..]        -> Mensagem LLM call vs derived from the message table
+    if sys.argv[1:2] == ["attribute-modes"]:
+        run_attribute_modes(sys.argv[2:])
+    elif sys.argv[1:2] == ["mensagem"]:
+        run_mensagem(sys.argv[2:])
+    else:
+        run()
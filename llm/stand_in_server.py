@@ -0,0 +1,320 @@
+# llm/stand_in_server.py
+# Local OpenAI-compatible stand-in for load tests and offline development.
+# Speaks the /v1/chat/completions subset the pipeline uses (JSON and SSE
+# streaming with usage) and answers every pipeline prompt with JSON that
+# passes its schema in utils/prompt_schemas.py, so the whole pipeline can run
+# against it. Latency follows a configurable distribution and 429 / 5xx
+# answers can be injected to exercise the governor, retries, breakers and
+# hedging without spending provider quota.
+#
+#   python -m llm.stand_in_server --median-ms 900 --p99-ms 4000 --rate-limit 0.02 --error-rate 0.01
+#   MODEL_ROUTING='{"default": "local-stand-in"}' streamlit run streamlit_app.py
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.prompt_schemas import SCHEMAS
+
+# Size of the text deltas a streamed answer is cut into
+STREAM_CHUNK_CHARS = 24
+# Share of the sampled latency spent before the first streamed delta
+FIRST_TOKEN_SHARE = 0.3
+# OpenAI only caches prompts from this many tokens on, in steps of CACHE_BLOCK_TOKENS
+CACHE_MIN_TOKENS = 1024
+CACHE_BLOCK_TOKENS = 128
+CHARS_PER_TOKEN = 4
+# z-score of the 99th percentile of a standard normal
+Z_P99 = 2.326
+
+# "1 – Name: keywords" (keywords optional, as in the Mensagem prompt)
+_VALUE_LINE = re.compile(r"^[ \t]*(\d+)[ \t]*[–-][ \t]*([^:\n]+?)[ \t]*(?::[ \t]*(.*))?$", re.M)
+_ATTRIBUTE = re.compile(r'"attribute":\s*"([^"]+)"')
+_QUERY = re.compile(r'User Query:\s*"([^"]*)"')
+
+
+def _slug(name: str) -> str:
+    return unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode().lower()
+
+
+def detect_stage(body: dict, text: str):
+    """
+    (stage, schema) the answer must follow: the json_schema sent with the request
+    (batched analyzer schemas only exist there), else a stage recognized by
+    markers in the prompt. (None, None) for prompts that are not ours.
+    """
+    json_schema = (body.get("response_format") or {}).get("json_schema") or {}
+    if json_schema.get("schema"):
+        return json_schema.get("name"), json_schema["schema"]
+    stage = _stage_from_text(text)
+    return stage, SCHEMAS.get(stage)
+
+
+def _stage_from_text(text: str):
+    if '"cat_1"' in text:
+        return "look_composer"
+    if '"att_1"' in text:
+        return "context_selection" if '"occasion"' in text else "0_attribute_selection"
+    if '"occasion"' in text:
+        return "context_analyzer"
+    match = _ATTRIBUTE.search(text)
+    if match:
+        for stage in SCHEMAS:
+            if stage.endswith("_att_" + _slug(match.group(1))):
+                return stage
+    return None
+
+
+def _ranked_scores(rng: random.Random, count: int) -> list:
+    return sorted((rng.randint(1, 10) for _ in range(count)), reverse=True)
+
+
+def _query_hits(query: str, keywords: str) -> int:
+    words = set(re.findall(r"\w+", query.lower()))
+    return sum(1 for kw in re.split(r"[,|]", keywords.lower()) if kw.strip() and kw.strip() in words)
+
+
+def _batch_section(text: str, key: str) -> str:
+    """The "### <key> (...)" section of a batched analyzer prompt, up to the next blank line."""
+    match = re.search(rf"^### {re.escape(key)} \(.*?\)\n(.*?)(?:\n\n|\Z)", text, re.M | re.S)
+    return match.group(1) if match else ""
+
+
+def fake_answer(schema: dict, text: str, rng: random.Random) -> dict:
+    """A schema-valid answer. Analyzer values come from the prompt's own value list."""
+    props = schema["properties"]
+    if props and all("attribute" in (sub.get("properties") or {}) for sub in props.values()):
+        # Batched analyzers: one analyzer block per attribute, each from its own section
+        query = (_QUERY.search(text) or [None, ""])[1]
+        return {key: {**fake_answer(sub, f'{_batch_section(text, key)}\nUser Query:\n"{query}"', rng), "attribute": key}
+                for key, sub in props.items()}
+    answer = {}
+    for key in ("occasion", "weather"):
+        if key in props:
+            answer[key] = {field: rng.choice(sub["enum"]) for field, sub in props[key]["properties"].items()}
+
+    if "attribute" in props:
+        query = (_QUERY.search(text) or [None, ""])[1]
+        values = _VALUE_LINE.findall(text)
+        # Values whose keywords appear in the query rank first, the rest in random order
+        rng.shuffle(values)
+        values.sort(key=lambda v: _query_hits(query, v[2]), reverse=True)
+        count = sum(1 for key in props if key.endswith("_id"))
+        answer["attribute"] = (_ATTRIBUTE.search(text) or [None, "?"])[1]
+        for i, ((value_id, name, _), score) in enumerate(zip(values, _ranked_scores(rng, count)), 1):
+            answer.update({
+                f"value_{i}_id": int(value_id),
+                f"value_{i}_name": name.strip(),
+                f"value_{i}_score": score,
+                f"value_{i}_justification": "Stand-in answer.",
+            })
+        return answer
+
+    # att_N / cat_N rankings: distinct enum members with descending scores
+    picks = [key for key in props if re.fullmatch(r"(att|cat)_\d+", key)]
+    if not picks:
+        return answer
+    names = rng.sample(props[picks[0]]["enum"], len(picks))
+    for key, name, score in zip(picks, names, _ranked_scores(rng, len(picks))):
+        answer.update({key: name, f"{key}_score": score, f"{key}_justification": "Stand-in answer."})
+    return answer
+
+
+class Profile:
+    """Latency distribution and fault injection, shared by all handler threads."""
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.window = deque()  # request times within the last minute, for --rpm
+        self.stats = Counter()
+        self.seen_prefixes = set()
+
+    def latency(self) -> float:
+        median = self.args.median_ms / 1000.0
+        if self.args.latency == "fixed":
+            return median
+        if self.args.latency == "uniform":
+            return self.rng.uniform(0.0, 2 * median)
+        sigma = max(math.log(max(self.args.p99_ms, self.args.median_ms) / self.args.median_ms) / Z_P99, 1e-6)
+        return self.rng.lognormvariate(math.log(median), sigma)
+
+    def fault(self):
+        """(status, retry_after) to fail this request with, or None to answer it."""
+        with self.lock:
+            now = time.monotonic()
+            while self.window and now - self.window[0] >= 60:
+                self.window.popleft()
+            if self.args.rpm and len(self.window) >= self.args.rpm:
+                return 429, max(60 - (now - self.window[0]), 0.1)
+            self.window.append(now)
+            roll = self.rng.random()
+        if roll < self.args.rate_limit:
+            return 429, self.args.retry_after
+        if roll < self.args.rate_limit + self.args.error_rate:
+            return self.rng.choice((500, 502, 503)), None
+        return None
+
+    def cached_tokens(self, messages) -> int:
+        """Prefix-cache hit for everything before the last message, mimicking OpenAI's rules."""
+        prefix = json.dumps(messages[:-1], ensure_ascii=False)
+        tokens = len(prefix) // CHARS_PER_TOKEN
+        with self.lock:
+            hit = prefix in self.seen_prefixes
+            self.seen_prefixes.add(prefix)
+        if not hit or tokens < CACHE_MIN_TOKENS:
+            return 0
+        return tokens // CACHE_BLOCK_TOKENS * CACHE_BLOCK_TOKENS
+
+    def count(self, key: str) -> None:
+        with self.lock:
+            self.stats[key] += 1
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    profile: Profile = None
+
+    def log_message(self, fmt, *args):
+        if self.profile.args.verbose:
+            super().log_message(fmt, *args)
+
+    def _send_json(self, status: int, payload: dict, headers=None) -> None:
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": "stand-in", "object": "model", "owned_by": "local"}]})
+        elif self.path.rstrip("/") == "/stats":
+            with self.profile.lock:
+                self._send_json(200, dict(self.profile.stats))
+        else:
+            self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+            return
+        profile = self.profile
+        profile.count("requests")
+
+        fault = profile.fault()
+        if fault is not None:
+            status, retry_after = fault
+            profile.count(f"status_{status}")
+            headers = {"Retry-After": f"{retry_after:.1f}"} if retry_after is not None else None
+            kind = "rate_limit_exceeded" if status == 429 else "server_error"
+            self._send_json(status, {"error": {"message": f"stand-in injected {status}", "type": kind}}, headers)
+            return
+
+        messages = body.get("messages") or []
+        text = "\n".join(str(m.get("content") or "") for m in messages)
+        stage, schema = detect_stage(body, text)
+        profile.count(f"stage_{stage or 'unknown'}")
+        # Identical requests get identical answers, like a provider at temperature 0
+        rng = random.Random(f"{profile.args.seed}:{text}")
+        answer = fake_answer(schema, text, rng) if schema else {"answer": "stand-in"}
+        content = json.dumps(answer, ensure_ascii=False, indent=2)
+
+        prompt_tokens = len(text) // CHARS_PER_TOKEN
+        completion_tokens = len(content) // CHARS_PER_TOKEN
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": profile.cached_tokens(messages)},
+        }
+        model = body.get("model") or "stand-in"
+        delay = profile.latency()
+        if body.get("stream"):
+            self._stream(model, content, usage if (body.get("stream_options") or {}).get("include_usage") else None, delay)
+            return
+        time.sleep(delay)
+        self._send_json(200, {
+            "id": f"chatcmpl-standin-{rng.getrandbits(32):08x}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}],
+            "usage": usage,
+        })
+
+    def _stream(self, model: str, content: str, usage, delay: float) -> None:
+        chunk_id = f"chatcmpl-standin-{random.getrandbits(32):08x}"
+
+        def event(choices, extra=None):
+            chunk = {"id": chunk_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": choices, **(extra or {})}
+            self.wfile.write(b"data: " + json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n\n")
+            self.wfile.flush()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.close_connection = True  # no Content-Length: the end of the stream is the end of the body
+
+        pieces = [content[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(content), STREAM_CHUNK_CHARS)]
+        time.sleep(delay * FIRST_TOKEN_SHARE)
+        gap = delay * (1 - FIRST_TOKEN_SHARE) / max(len(pieces), 1)
+        for i, piece in enumerate(pieces):
+            delta = {"role": "assistant", "content": piece} if i == 0 else {"content": piece}
+            event([{"index": 0, "delta": delta, "finish_reason": None}])
+            time.sleep(gap)
+        event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if usage is not None:
+            event([], {"usage": usage})
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="OpenAI-compatible stand-in server for the styletelling prompts.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--latency", choices=("fixed", "uniform", "lognormal"), default="lognormal",
+                        help="latency distribution (uniform spans 0 to 2x the median)")
+    parser.add_argument("--median-ms", type=float, default=800.0, help="median response latency")
+    parser.add_argument("--p99-ms", type=float, default=3000.0, help="99th percentile latency (lognormal only)")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with injected 429s")
+    parser.add_argument("--rpm", type=int, default=0, help="requests per minute before 429s (0 = unlimited)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 500/502/503")
+    parser.add_argument("--seed", type=int, default=0, help="seed for latency, faults and answers")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    Handler.profile = Profile(args)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    print(f"[STAND-IN] Serving http://{args.host}:{args.port}/v1 "
+          f"({args.latency}, median {args.median_ms:.0f} ms, 429 {args.rate_limit:.1%}, 5xx {args.error_rate:.1%})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,31 @@
 # This script processes a user query to find product recommendations.
 # Updated to include context reporting for UI display.
 
+import asyncio
+import hashlib
 import json
+import re
+import threading
+import time
 import concurrent.futures
+from functools import lru_cache, partial
 from utils.database_utils import connect_to_db  # Use centralized connection
-from utils.execute_prompt import execute_prompt
-from utils.util_functions import to_int_safe
+from config.config import (
+    QUERY_TOKEN_BUDGET, QUERY_COST_BUDGET, LLM_STREAMING, SPECULATIVE_ATTRIBUTES, FUSED_CONTEXT_SELECTION,
+    ATTRIBUTE_ANALYSIS_MODE, QUERY_DEADLINE_S, DEADLINE_CATEGORIES, DEADLINE_ATTRIBUTES, LOOK_COMPOSER_MEMO, LOOK_COMPOSER_MEMO_TTL,
+    LEXICAL_FAST_PATH, LEXICAL_CONFIDENCE, MENSAGEM_MODE,
+)
+from utils.admission import get_admission
+from utils.deadline import Deadline
+from utils.executors import TaskScope, get_executor
+from utils.lexical_classifier import get_lexical_classifier
+from utils.llm_cache import get_cache
+from utils.message_index import get_message_index, record_message
+from utils.execute_prompt import execute_prompt, aexecute_prompt, execute_prompt_streaming, stage_name
+from utils.metering import Meter, bind_meter, bind_meter_iter, bind_meter_async
+from utils.prompt_schemas import get_schema, register_batch_schema, split_context_selection
+from utils.stage_graph import StageGraph, StopPipeline
+from utils.util_functions import load_prompt, to_int_safe
 
 
 # --- Constants (unchanged) ---
@@ -61,13 +81,143 @@ WEATHER_EXCLUSIONS = {
     "Cold": {"Estrutura": ["Leve | Fluido"]}
 }
 
+ATTRIBUTE_SELECTION_PROMPT = "./prompts/prompt_0_attribute_selection.txt"
+LOOK_COMPOSER_PROMPT = "./prompts/prompt_look_composer.txt"
+# Steps 1 and 2 in one prompt (FUSED_CONTEXT_SELECTION)
+CONTEXT_SELECTION_PROMPT = "./prompts/prompt_context_selection.txt"
+# Step 3 for several attributes in one prompt (ATTRIBUTE_ANALYSIS_MODE = "batched")
+ATTRIBUTE_BATCH_PROMPT = "./prompts/prompt_att_batch.txt"
+# A runner-up attribute value is passed to the look composer from this score on
+VALUE_SCORE_THRESHOLD = 7
 
-def analyze_single_attribute(attr_name, user_query_row):
-    """Analyzes a single attribute by calling the LLM (unchanged)."""
+# Attributes with an analyzer prompt (step 3)
+ANALYZER_ATTRIBUTES = [name for name in PROMPT_MAPPING if name != "ContextAnalyzer"]
+
+# Attributes whose values the `message` table combines into a Mensagem title
+MESSAGE_COMBINATION_ATTRIBUTES = [name for name in ANALYZER_ATTRIBUTES if name != "Mensagem"]
+
+# Templates the stage graph loads up front (the context prompt is read by step 1 itself)
+PIPELINE_PROMPTS = [
+    ATTRIBUTE_SELECTION_PROMPT, LOOK_COMPOSER_PROMPT, CONTEXT_SELECTION_PROMPT, ATTRIBUTE_BATCH_PROMPT,
+] + [PROMPT_MAPPING[name] for name in ANALYZER_ATTRIBUTES]
+
+# Step 3 as one call; per-attribute early starts and speculation only apply to the fan-out
+BATCHED_ANALYSIS = ATTRIBUTE_ANALYSIS_MODE == "batched"
+
+# How often a queued query re-reads its place in line
+QUEUE_POLL_S = 0.5
+
+# With QUERY_DEADLINE_S, step 1 (context) and step 2 (selection, or the fused call
+# for both) fall back at these shares of it, step 3 stops waiting for stragglers
+# at its share, and the rest is left to the look composer
+CONTEXT_DEADLINE_SHARE = 0.3
+SELECTION_DEADLINE_SHARE = 0.5
+ANALYSIS_DEADLINE_SHARE = 0.7
+
+# Fields of prompt_0_attribute_selection.txt that name a selected attribute
+SELECTED_ATTRIBUTE_KEYS = {f"att_{i}" for i in range(1, 6)}
+
+
+def analyze_single_attribute(attr_name, user_query_row, session_routes=None, prompt_template=None):
+    """Analyzes a single attribute by calling the LLM (prompt_template: the already loaded prompt file)."""
     if attr_name not in PROMPT_MAPPING:
         return None
     prompt_path = PROMPT_MAPPING[attr_name]
-    return execute_prompt(user_query_row, prompt_template_path=prompt_path)
+    return execute_prompt(user_query_row, prompt_template=prompt_template, prompt_template_path=prompt_path,
+                          session_routes=session_routes)
+
+
+async def aanalyze_single_attribute(attr_name, user_query_row, session_routes=None, prompt_template=None):
+    """Async analyze_single_attribute."""
+    if attr_name not in PROMPT_MAPPING:
+        return None
+    return await aexecute_prompt(user_query_row, prompt_template=prompt_template,
+                                 prompt_template_path=PROMPT_MAPPING[attr_name], session_routes=session_routes)
+
+
+# Value lines ("1 – Jeans: jeans") and the answer label of an analyzer prompt
+_VALUE_LINE = re.compile(r"^\s*\d+\s*[–-]\s*\S")
+_ATTRIBUTE_LABEL = re.compile(r'"attribute":\s*"([^"]+)"')
+# Id and name of a value line ("1 – Jeans: jeans" -> "1", "Jeans")
+_VALUE_NAME = re.compile(r"^[ \t]*(\d+)[ \t]*[–-][ \t]*([^:\n]+?)[ \t]*(?::.*)?$", re.M)
+
+
+def _escape_braces(text):
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+def build_batched_attribute_prompt(attrs, templates):
+    """
+    (stage, template) analyzing `attrs` in one call. Each attribute's value list
+    is taken from its own analyzer prompt and the answer holds that analyzer's
+    JSON block under the attribute's name; the combined schema is registered
+    under `stage`. Attributes are put in PROMPT_MAPPING order, so the same set
+    always yields the same prompt.
+    """
+    attrs = sorted(attrs, key=ANALYZER_ATTRIBUTES.index)
+    sections, example, parts = [], {}, {}
+    for attr in attrs:
+        template = templates[PROMPT_MAPPING[attr]]
+        label = _ATTRIBUTE_LABEL.search(template)
+        parts[attr] = stage_name(PROMPT_MAPPING[attr])
+        count = sum(1 for key in get_schema(parts[attr])["properties"] if key.endswith("_id"))
+        values = "\n".join(line.strip() for line in template.splitlines() if _VALUE_LINE.match(line))
+        sections.append(f"### {attr} (return the top {count} values)\n{values}")
+        block = {"attribute": label.group(1) if label else attr}
+        for i in range(1, count + 1):
+            block.update({
+                f"value_{i}_id": "[suggested value id]",
+                f"value_{i}_name": "[suggested value name]",
+                f"value_{i}_score": "[relevance score 1 to 10]",
+                f"value_{i}_justification": "[30-word justification]",
+            })
+        example[attr] = block
+
+    stage = "att_batch_" + "".join(parts[attr].split("_")[0] for attr in attrs)
+    register_batch_schema(stage, parts)
+    template = (templates[ATTRIBUTE_BATCH_PROMPT]
+                .replace("{attribute_sections}", _escape_braces("\n\n".join(sections)))
+                .replace("{output_format}", _escape_braces(json.dumps(example, ensure_ascii=False, indent=2))))
+    return stage, template
+
+
+def _batched_attributes(attrs):
+    return [attr for attr in dict.fromkeys(attrs) if attr in ANALYZER_ATTRIBUTES]
+
+
+def _batched_blocks(answer, attrs):
+    """The per-attribute blocks of a batched answer, in `attrs` order (as the fan-out would return them)."""
+    if not isinstance(answer, dict):
+        return []
+    return [answer[attr] for attr in attrs if isinstance(answer.get(attr), dict)]
+
+
+def analyze_attributes_batched(attrs, user_query_row, templates=None, session_routes=None, api_model=None):
+    """
+    Step 3 in one LLM call: the blocks analyze_single_attribute would return for
+    each attribute in `attrs`. templates maps prompt paths to loaded prompts
+    (read from disk when missing).
+    """
+    attrs = _batched_attributes(attrs)
+    if not attrs:
+        return []
+    templates = templates or {path: load_prompt(path) for path in PIPELINE_PROMPTS}
+    stage, template = build_batched_attribute_prompt(attrs, templates)
+    answer = execute_prompt(user_query_row, prompt_template=template, stage=stage, api_model=api_model,
+                            session_routes=session_routes)
+    return _batched_blocks(answer, attrs)
+
+
+async def aanalyze_attributes_batched(attrs, user_query_row, templates=None, session_routes=None, api_model=None):
+    """Async analyze_attributes_batched."""
+    attrs = _batched_attributes(attrs)
+    if not attrs:
+        return []
+    templates = templates or {path: load_prompt(path) for path in PIPELINE_PROMPTS}
+    stage, template = build_batched_attribute_prompt(attrs, templates)
+    answer = await aexecute_prompt(user_query_row, prompt_template=template, stage=stage, api_model=api_model,
+                                   session_routes=session_routes)
+    return _batched_blocks(answer, attrs)
 
 
 def normalize_attribute_name(raw_attr):
@@ -75,8 +225,106 @@ def normalize_attribute_name(raw_attr):
     return raw_attr.split('|')[0].strip()
 
 
-def search_products_with_details(detailed_results, category_name=None, limit=3):
-    """Finds and ranks products based on style attributes."""
+def load_attribute_ids():
+    """{attribute key (e.g. "Material"): attributes.id} for every attribute in ATTRIBUTE_INFO."""
+    with connect_to_db() as conn:
+        rows = conn.execute("SELECT name, id FROM attributes").fetchall()
+    ids_by_name = dict(rows)
+    return {key: ids_by_name[info["attr_name"]] for key, info in ATTRIBUTE_INFO.items()
+            if info["attr_name"] in ids_by_name}
+
+
+@lru_cache(maxsize=None)
+def prompt_value_names(attr):
+    """{value id: name} as the analyzer prompt of `attr` lists them, i.e. the names the exclusion rules use."""
+    return {int(value_id): name for value_id, name in _VALUE_NAME.findall(load_prompt(PROMPT_MAPPING[attr]))}
+
+
+@lru_cache(maxsize=None)
+def prompt_attribute_label(attr):
+    """The "attribute" label the analyzer prompt of `attr` answers with (e.g. "Linha | Forma")."""
+    label = _ATTRIBUTE_LABEL.search(load_prompt(PROMPT_MAPPING[attr]))
+    return label.group(1) if label else attr
+
+
+def lexical_matches(user_query, attrs=None):
+    """
+    {attribute: analyzer-shaped block} for the attributes (default: all of step 3)
+    the query names through taxonomy keywords with at least LEXICAL_CONFIDENCE.
+    """
+    classifier = get_lexical_classifier({attr: ATTRIBUTE_INFO[attr]["table"] for attr in ANALYZER_ATTRIBUTES},
+                                        {attr: prompt_value_names(attr) for attr in ANALYZER_ATTRIBUTES},
+                                        {attr: prompt_attribute_label(attr) for attr in ANALYZER_ATTRIBUTES})
+    matches = {}
+    for attr in attrs or ANALYZER_ATTRIBUTES:
+        block, confidence = classifier.classify(attr, user_query)
+        if block is not None and confidence >= LEXICAL_CONFIDENCE:
+            matches[attr] = block
+    return matches
+
+
+def _value_block(attribute, values):
+    """An analyzer-shaped block from [{"id", "name", "score", "justification"}]."""
+    block = {"attribute": attribute}
+    for i, val in enumerate(values, 1):
+        for field in ("id", "name", "score", "justification"):
+            block[f"value_{i}_{field}"] = val[field]
+    return block
+
+
+def _block_values(block):
+    return [{field: block.get(f"value_{i}_{field}") for field in ("id", "name", "score", "justification")}
+            for i in range(1, 4) if block.get(f"value_{i}_id") is not None]
+
+
+def _message_weights(detailed_results):
+    """{attr_name: {value id: score / 10}} from the analyzed blocks of the attributes `message` combines."""
+    weights = {}
+    for block in detailed_results:
+        attr = normalize_attribute_name(block.get("attribute", ""))
+        if attr not in MESSAGE_COMBINATION_ATTRIBUTES:
+            continue
+        values = weights.setdefault(ATTRIBUTE_INFO[attr]["attr_name"], {})
+        for val in _block_values(block):
+            value_id = to_int_safe(val["id"])
+            values[value_id] = max(values.get(value_id, 0.0), to_int_safe(val["score"], 1) / 10)
+    return weights
+
+
+def rank_mensagem(detailed_results):
+    """Mensagem titles ranked from the other attributes' step-3 blocks via the `message` table: [(id, title, share)]."""
+    index = get_message_index([ATTRIBUTE_INFO[attr]["attr_name"] for attr in MESSAGE_COMBINATION_ATTRIBUTES],
+                              prompt_value_names("Mensagem"))
+    return index.rank(_message_weights(detailed_results))
+
+
+def derive_mensagem(detailed_results):
+    """The Mensagem block analyze_single_attribute would return, derived without an LLM call."""
+    ranked = rank_mensagem(detailed_results)[:3]
+    top = ranked[0][2] if ranked else 0.0
+    return _value_block("Mensagem", [
+        {"id": title_id, "name": title, "score": max(round(10 * share / top), 1) if top else 1,
+         "justification": f"{share:.0%} do peso das combinações compatíveis da tabela message"}
+        for title_id, title, share in ranked
+    ])
+
+
+def break_mensagem_ties(block, detailed_results):
+    """
+    The LLM's Mensagem block with equally scored values ordered by the derived
+    ranking -> (block, whether the order changed).
+    """
+    order = {title_id: i for i, (title_id, _, _) in enumerate(rank_mensagem(detailed_results))}
+    values = _block_values(block)
+    ranked = sorted(values, key=lambda val: (-to_int_safe(val["score"]), order.get(to_int_safe(val["id"]), len(order))))
+    return _value_block(block["attribute"], ranked), ranked != values
+
+
+def search_products_with_details(detailed_results, category_name=None, limit=3, attribute_ids=None):
+    """
+    Finds and ranks products based on style attributes.
+    attribute_ids (from load_attribute_ids) saves the per-attribute id lookups.
+    """
     # FIXED: Use centralized connection
     with connect_to_db() as conn:
         conn.row_factory = lambda cursor, row: dict(zip([col[0] for col in cursor.description], row))
@@ -92,11 +340,16 @@ def search_products_with_details(detailed_results, category_name=None, limit=3):
             if not info:
                 continue
 
-            cur.execute("SELECT id FROM attributes WHERE name = ?", (info["attr_name"],))
-            row = cur.fetchone()
-            if not row:
-                continue
-            attr_id = row["id"]
+            if attribute_ids is not None:
+                attr_id = attribute_ids.get(key)
+                if attr_id is None:
+                    continue
+            else:
+                cur.execute("SELECT id FROM attributes WHERE name = ?", (info["attr_name"],))
+                row = cur.fetchone()
+                if not row:
+                    continue
+                attr_id = row["id"]
 
             for i in (1, 2, 3):
                 val_id, val_score = block.get(f"value_{i}_id"), block.get(f"value_{i}_score")
@@ -142,69 +395,8 @@ def search_products_with_details(detailed_results, category_name=None, limit=3):
         return product_list
 
 
-def process_user_query_streaming(user_query, category_score_threshold=6):
-    """
-    Enhanced generator function that processes the user query and yields
-    status updates and results at each step, including context analysis.
-    """
-
-    # === Step 1: Analyze Occasion and Weather ===
-    yield {"status": "progress", "message": "➡️ Step 1/6: Analyzing occasion and weather..."}
-    context_prompt_path = PROMPT_MAPPING["ContextAnalyzer"]
-    context_row = {"user_query": user_query}
-    context_results = execute_prompt(context_row, prompt_template_path=context_prompt_path)
-
-    # Fallback to an empty context if the prompt fails
-    if not context_results:
-        context_results = {"occasion": {}, "weather": {}}
-
-    # NEW: Yield context results for UI display
-    yield {"status": "context_result", "data": context_results}
-
-    # Pass the full context to subsequent prompts
-    row_with_context = {
-        "user_query": user_query,
-        "query_context": json.dumps(context_results, ensure_ascii=False)
-    }
-
-    # === Step 2: Get top 5 attributes ===
-    yield {"status": "progress", "message": "➡️ Step 2/6: Selecting the most relevant style attributes..."}
-    prompt_0_path = "./prompts/prompt_0_attribute_selection.txt"
-    attribute_results = execute_prompt(row_with_context, prompt_template_path=prompt_0_path)
-    if not attribute_results:
-        yield {"status": "error", "message": "Failed to get initial attribute selection."}
-        return
-
-    top_attributes_from_prompt = [attribute_results.get(f"att_{i}") for i in range(1, 6) if
-                                  attribute_results.get(f"att_{i}")]
-    yield {
-        "status": "intermediate_result",
-        "type": "attributes",
-        "data": top_attributes_from_prompt
-    }
-
-    # === Step 3: Analyze each selected attribute in parallel ===
-    yield {"status": "progress", "message": "➡️ Step 3/6: Analyzing each attribute in detail..."}
-    detailed_results = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        future_to_attribute = {executor.submit(analyze_single_attribute, attr, row_with_context): attr for attr in
-                               top_attributes_from_prompt}
-        for future in concurrent.futures.as_completed(future_to_attribute):
-            try:
-                result = future.result()
-                if result:
-                    detailed_results.append(result)
-            except Exception as e:
-                print(f"An exception occurred: {e}")
-
-    if not detailed_results:
-        yield {"status": "error", "message": "Could not get detailed attribute values."}
-        return
-
-    # === Step 4: Apply Exclusion Rules ===
-    yield {"status": "progress", "message": "➡️ Step 4/6: Applying occasion and weather exclusion rules..."}
-
-    # Get current context
+def exclusion_rules_for(context_results):
+    """{attribute: excluded value names} for the occasion/weather context; needs only step 1."""
     occ = context_results.get("occasion", {})
     weather = context_results.get("weather", {})
     occasion_key = (occ.get("formality"), occ.get("time"), occ.get("location"), occ.get("activity"))
@@ -214,13 +406,22 @@ def process_user_query_streaming(user_query, category_score_threshold=6):
     occasion_rules = OCCASION_EXCLUSIONS.get(occasion_key, {})
     weather_rules = WEATHER_EXCLUSIONS.get(climate, {})
 
+    # Combine exclusions per attribute
+    rules = {}
+    for attr_name in set(occasion_rules) | set(weather_rules):
+        rules[attr_name] = set(occasion_rules.get(attr_name, [])) | set(weather_rules.get(attr_name, []))
+    return rules
+
+
+def apply_exclusion_rules(context_results, detailed_results, rules=None):
+    """Step 4: drop attribute values ruled out by the occasion/weather context (rules: exclusion_rules_for)."""
+    if rules is None:
+        rules = exclusion_rules_for(context_results)
+
     filtered_detailed_results = []
     for result_block in detailed_results:
         attr_name = normalize_attribute_name(result_block["attribute"])
-
-        # Combine exclusions for the current attribute
-        exclusions = set(occasion_rules.get(attr_name, []))
-        exclusions.update(weather_rules.get(attr_name, []))
+        exclusions = rules.get(attr_name)
 
         if not exclusions:
             filtered_detailed_results.append(result_block)
@@ -246,10 +447,11 @@ def process_user_query_streaming(user_query, category_score_threshold=6):
                 new_block[f"value_{i}_score"] = val["score"]
                 new_block[f"value_{i}_justification"] = val["justification"]
             filtered_detailed_results.append(new_block)
+    return filtered_detailed_results
 
-    # === Step 5: Select relevant product categories ===
-    yield {"status": "progress", "message": "➡️ Step 5/6: Identifying relevant product categories..."}
-    VALUE_SCORE_THRESHOLD = 7
+
+def fashion_attributes(filtered_detailed_results):
+    """The top value of each attribute plus any strong runner-up, as "Attribute: Value"."""
     fashion_attributes_list = []
     for res in filtered_detailed_results:  # Use filtered results
         attr_name = res.get("attribute")
@@ -259,11 +461,47 @@ def process_user_query_streaming(user_query, category_score_threshold=6):
         if res.get("value_2_name") and isinstance(res.get("value_2_score"), int) and res.get(
                 "value_2_score") >= VALUE_SCORE_THRESHOLD:
             fashion_attributes_list.append(f'{attr_name}: {res.get("value_2_name")}')
+    return fashion_attributes_list
+
+
+def build_category_prompt_row(user_query, filtered_detailed_results):
+    """Step 5 input: the query and its fashion attributes."""
+    return {"user_query": user_query,
+            "fashion_attributes": json.dumps(fashion_attributes(filtered_detailed_results), ensure_ascii=False)}
 
-    category_prompt_row = {"user_query": user_query,
-                           "fashion_attributes": json.dumps(fashion_attributes_list, ensure_ascii=False)}
-    category_results = execute_prompt(category_prompt_row, prompt_template_path="./prompts/prompt_look_composer.txt")
 
+def look_composer_memo_key(context_results, filtered_detailed_results, template):
+    """
+    Step-5 memo key: the attribute values the look composer is shown (sorted,
+    case-folded), a coarse context bucket (formality, location, climate) and
+    the prompt itself, so editing the prompt starts a fresh memo.
+    """
+    occasion = context_results.get("occasion") or {}
+    weather = context_results.get("weather") or {}
+    signature = {
+        "attributes": sorted({item.casefold() for item in fashion_attributes(filtered_detailed_results)}),
+        "context": [occasion.get("formality"), occasion.get("location"), weather.get("climate")],
+        "prompt": hashlib.sha256(template.encode("utf-8")).hexdigest(),
+    }
+    return hashlib.sha256(json.dumps(signature, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _look_composer_memo():
+    return get_cache("look_composer", ttl=LOOK_COMPOSER_MEMO_TTL)
+
+
+def recall_categories(memo_key):
+    """Step-5 answer memoized under memo_key, or None."""
+    payload = _look_composer_memo().get(memo_key)
+    return json.loads(payload) if payload else None
+
+
+def memoize_categories(memo_key, category_results):
+    if isinstance(category_results, dict) and category_results.get("cat_1"):
+        _look_composer_memo().put(memo_key, json.dumps(category_results, ensure_ascii=False))
+
+
+def select_relevant_categories(category_results, category_score_threshold):
     relevant_categories = []
     if category_results:
         for i in range(1, 6):
@@ -271,27 +509,748 @@ def process_user_query_streaming(user_query, category_score_threshold=6):
             cat_score = category_results.get(f'cat_{i}_score')
             if cat_name and isinstance(cat_score, int) and cat_score > category_score_threshold:
                 relevant_categories.append(cat_name)
+    return relevant_categories
+
+
+def iter_recommended_products(filtered_detailed_results, relevant_categories, attribute_ids=None):
+    """Step 6 with the categories ranked concurrently: yields (category, top 3 products) as each one finishes."""
+    pool = TaskScope(get_executor("ranking"))
+    futures = {pool.submit(search_products_with_details, detailed_results=filtered_detailed_results,
+                           category_name=category, limit=3, attribute_ids=attribute_ids): category
+               for category in relevant_categories}  # Use filtered results
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            yield futures[future], future.result()
+    finally:
+        pool.cancel_pending()
+
+
+def recommend_products(filtered_detailed_results, relevant_categories, attribute_ids=None):
+    """Step 6: top 3 products for each category."""
+    products = dict(iter_recommended_products(filtered_detailed_results, relevant_categories, attribute_ids))
+    return {category: products[category] for category in relevant_categories}
+
+
+def _context_row(user_query, context_results):
+    """Row for the prompts after step 1: the query plus the full context."""
+    return {"user_query": user_query, "query_context": json.dumps(context_results, ensure_ascii=False)}
+
+
+def _top_attributes(attribute_results):
+    return [attribute_results.get(f"att_{i}") for i in range(1, 6) if attribute_results.get(f"att_{i}")]
+
+
+def _stage_prompts(results, emit):
+    """Read every prompt template once, off the critical path."""
+    return {path: load_prompt(path) for path in PIPELINE_PROMPTS}
+
+
+def _stage_attribute_ids(results, emit):
+    return load_attribute_ids()
+
+
+def _stage_exclusions(results, emit):
+    return exclusion_rules_for(results["context"])
+
+
+def _stage_filter(results, emit):
+    emit({"status": "progress", "message": "➡️ Step 4/6: Applying occasion and weather exclusion rules..."})
+    return apply_exclusion_rules(results["context"], results["analysis"], results["exclusions"])
+
+
+def _stage_products(results, emit):
+    """Step 6, emitting a category_result per category as its ranking finishes (rank: its place in step 5)."""
+    emit({"status": "progress", "message": "➡️ Step 6/6: Searching for top products..."})
+    relevant_categories = results["categories"]
+    products = {}
+    for category, ranked in iter_recommended_products(results["filter"], relevant_categories, results["attribute_ids"]):
+        products[category] = ranked
+        emit({"status": "category_result", "category": category, "rank": relevant_categories.index(category),
+              "data": ranked})
+    return {category: products[category] for category in relevant_categories}
 
-    yield {
-        "status": "intermediate_result",
-        "type": "categories",
-        "data": relevant_categories
-    }
 
-    if not relevant_categories:
-        yield {"status": "final_message", "message": "No relevant product categories found for this query."}
-        return
+def _stage_fused_context(results, emit):
+    return results["fused"]["context"]
 
-    # === Step 6: Find top 3 products for each category ===
-    yield {"status": "progress", "message": "➡️ Step 6/6: Searching for top products..."}
-    product_recommendations = {}
-    for category in relevant_categories:
-        products = search_products_with_details(detailed_results=filtered_detailed_results, category_name=category,
-                                                limit=3)  # Use filtered results
-        product_recommendations[category] = products
 
-    # === Final Step: Yield the complete results ===
-    yield {"status": "final_result", "data": product_recommendations}
+def _stage_fused_selection(results, emit):
+    emit({"status": "progress", "message": "➡️ Step 2/6: Selecting the most relevant style attributes..."})
+    fused = results["fused"]
+    emit(_attributes_event(fused["attributes"]))
+    return {"attributes": _top_attributes(fused["attributes"]), "started": fused.get("started", {})}
+
+
+def _query_graph(context, selection, analysis, categories, speculation=None, fused=None):
+    """
+    The pipeline as a stage graph. The four LLM stages are passed in (thread
+    or asyncio versions); prompt loading, the attribute-id lookup and the
+    exclusion-rule lookup run alongside them. With a speculation stage, step 3
+    is launched for every attribute next to step 2 and only picks up results.
+    With a fused stage (steps 1 and 2 in one call), context and selection are
+    read off its answer instead.
+    """
+    graph = (StageGraph()
+             .add("prompts", _stage_prompts)
+             .add("attribute_ids", _stage_attribute_ids))
+    if fused is not None:
+        graph.add("fused", fused, deps=("prompts",))
+        graph.add("context", _stage_fused_context, deps=("fused",))
+        selection = _stage_fused_selection
+    else:
+        graph.add("context", context)
+    graph = (graph
+             .add("exclusions", _stage_exclusions, deps=("context",))
+             .add("selection", selection, deps=("context", "prompts")))
+    if speculation is not None:
+        graph.add("speculation", speculation, deps=("context", "prompts"))
+    return (graph
+            .add("analysis", analysis, deps=("selection", "speculation") if speculation else ("selection",))
+            .add("filter", _stage_filter, deps=("analysis", "exclusions"))
+            .add("categories", categories, deps=("filter", "context"))
+            .add("products", _stage_products, deps=("categories", "attribute_ids")))
+
+
+def _context_results(context_results):
+    # Fallback to an empty context if the prompt fails
+    return context_results or {"occasion": {}, "weather": {}}
+
+
+def _fused_results(answer):
+    """Context (with the empty fallback) and attribute selection from a fused answer."""
+    context_results, attribute_results = split_context_selection(answer)
+    return _context_results(context_results), attribute_results
+
+
+def _attributes_event(attribute_results):
+    if not attribute_results:
+        raise StopPipeline({"status": "error", "message": "Failed to get initial attribute selection."})
+    return {"status": "intermediate_result", "type": "attributes", "data": _top_attributes(attribute_results)}
+
+
+def _categories_event(category_results, category_score_threshold):
+    relevant_categories = select_relevant_categories(category_results, category_score_threshold)
+    return relevant_categories, {"status": "intermediate_result", "type": "categories", "data": relevant_categories}
+
+
+def _collect_detailed_results(results):
+    detailed_results = []
+    for result in results:
+        if isinstance(result, Exception):
+            print(f"An exception occurred: {result}")
+        elif result:
+            detailed_results.append(result)
+    if not detailed_results:
+        raise StopPipeline({"status": "error", "message": "Could not get detailed attribute values."})
+    return detailed_results
+
+
+def _no_categories():
+    return StopPipeline({"status": "final_message", "message": "No relevant product categories found for this query."})
+
+
+def _outcome(future):
+    """A finished step-3 future's answer, or the exception it ended with."""
+    if future.cancelled():
+        return concurrent.futures.CancelledError()
+    return future.exception() or future.result()
+
+
+def _usable(future):
+    outcome = _outcome(future)
+    return bool(outcome) and not isinstance(outcome, BaseException)
+
+
+def _settle_analyses(futures, deadline):
+    """
+    Outcomes of the step-3 futures ({future: attr}) in submission order. At the
+    analysis share of the deadline the unfinished ones are dropped; if none has
+    answered yet, the first usable answer is still waited for.
+    """
+    done, pending = concurrent.futures.wait(futures, timeout=deadline.remaining(ANALYSIS_DEADLINE_SHARE))
+    while pending and not any(_usable(future) for future in done):
+        newly_done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        done |= newly_done
+    _drop_stragglers(futures, pending, deadline)
+    return [_outcome(future) for future in futures if future in done]
+
+
+async def _asettle_analyses(tasks, deadline):
+    """asyncio _settle_analyses ({task: attr})."""
+    if not tasks:
+        return []
+    done, pending = await asyncio.wait(tasks, timeout=deadline.remaining(ANALYSIS_DEADLINE_SHARE))
+    while pending and not any(_usable(task) for task in done):
+        newly_done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        done |= newly_done
+    _drop_stragglers(tasks, pending, deadline)
+    return [_outcome(task) for task in tasks if task in done]
+
+
+def _drop_stragglers(futures, pending, deadline):
+    for future in pending:
+        future.cancel()  # a thread already running it finishes, but its answer is not used
+    if pending:
+        deadline.degrade("analysis", "deadline", [futures[future] for future in futures if future in pending])
+
+
+def _recalled_categories(memo_key, meter):
+    """The memoized step-5 answer (recorded on the meter as a cache hit), or None."""
+    if not memo_key:
+        return None
+    started = time.perf_counter()
+    category_results = recall_categories(memo_key)
+    if category_results is not None:
+        meter.add_call(stage_name(LOOK_COMPOSER_PROMPT), time.perf_counter() - started, cache_hit=True)
+    return category_results
+
+
+def _within(deadline, share, executor, fn, *args, **kwargs):
+    """fn(*args, **kwargs) on the query's pool until `share` of the deadline; then concurrent.futures.TimeoutError."""
+    timeout = deadline.remaining(share)
+    if timeout is None:
+        return fn(*args, **kwargs)
+    return executor.submit(fn, *args, **kwargs).result(timeout=timeout)
+
+
+class _Cutoff:
+    """
+    Stops a streaming stage call that missed its share of the deadline: the
+    call's loop checks `expired` under `lock` before acting on each field, so
+    nothing is reported or started after the stage has fallen back.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.expired = False
+
+    def cut(self):
+        with self.lock:
+            self.expired = True
+
+
+def _deadline_context(deadline, context_results=None):
+    """Step 1 fallback when the context analysis misses its share of the deadline: what arrived, else empty."""
+    print(f"Context analysis missed its share of the {deadline.seconds}s deadline; going on without it.")
+    deadline.degrade("context", "deadline")
+    return _context_results(context_results)
+
+
+def _deadline_selection(deadline, attribute_results=None):
+    """Step 2 fallback: the att_N fields that arrived in time, filled up from DEADLINE_ATTRIBUTES."""
+    print(f"Attribute selection missed its share of the {deadline.seconds}s deadline; using the default attributes.")
+    deadline.degrade("selection", "deadline")
+    attributes = list(dict.fromkeys(_top_attributes(attribute_results or {}) + list(DEADLINE_ATTRIBUTES)))
+    return {f"att_{i}": attr for i, attr in enumerate(attributes[:len(SELECTED_ATTRIBUTE_KEYS)], 1)}
+
+
+def _deadline_categories(deadline, emit):
+    """Step 5 fallback when the look composer misses the deadline."""
+    print(f"Look composer missed the {deadline.seconds}s deadline; using the default categories.")
+    deadline.degrade("categories", "deadline")
+    relevant_categories = list(DEADLINE_CATEGORIES)
+    emit({"status": "intermediate_result", "type": "categories", "data": relevant_categories})
+    return relevant_categories
+
+
+def _lexical_fast_path(user_query):
+    """(confident lexical blocks, the ones that replace their LLM call) under LEXICAL_FAST_PATH."""
+    if LEXICAL_FAST_PATH not in ("skip", "preliminary"):
+        return {}, {}
+    matches = lexical_matches(user_query)
+    return matches, (matches if LEXICAL_FAST_PATH == "skip" else {})
+
+
+def _lexical_blocks(matches, skipped, selected, emit):
+    """The lexical blocks of the selected attributes, reported as one event; returns the skipped ones."""
+    blocks = [matches[attr] for attr in selected if attr in matches]
+    if blocks:
+        emit({"status": "intermediate_result", "type": "lexical_attributes", "data": blocks,
+              "skipped": bool(skipped)})
+    if skipped and blocks:
+        print(f"Lexical fast path: answered {', '.join(b['attribute'] for b in blocks)} without the LLM.")
+    return [matches[attr] for attr in selected if attr in skipped]
+
+
+def _local_attributes(skipped):
+    """Step-3 attributes answered without their own LLM call: lexical skips, and Mensagem when derived."""
+    return set(skipped) | ({"Mensagem"} if MENSAGEM_MODE == "derived" else set())
+
+
+def _with_mensagem(results, selected, skipped):
+    """Step-3 outcomes completed per MENSAGEM_MODE: Mensagem derived from the others, or the LLM's ties broken."""
+    if "Mensagem" not in selected or "Mensagem" in skipped:
+        return results
+    blocks = [block for block in results if isinstance(block, dict)]
+    if MENSAGEM_MODE == "derived":
+        record_message("derived")
+        return results + [derive_mensagem(blocks)]
+    if MENSAGEM_MODE == "tiebreak":
+        completed = []
+        for result in results:
+            if isinstance(result, dict) and normalize_attribute_name(result.get("attribute", "")) == "Mensagem":
+                result, reordered = break_mensagem_ties(result, blocks)
+                record_message("tiebreaks", reordered)
+            completed.append(result)
+        return completed
+    return results
+
+
+def _speculating():
+    # Speculation overlaps the fan-out with a separate step-2 call; fused or batched modes have neither
+    return SPECULATIVE_ATTRIBUTES and not FUSED_CONTEXT_SELECTION and not BATCHED_ANALYSIS
+
+
+class _Speculation:
+    """Analyzer runs started before step 2 finished: their timings, and what discarding the unselected cost."""
+
+    def __init__(self):
+        self.spans = {}
+        self.launched = list(ANALYZER_ATTRIBUTES)
+        self.selected = None
+        self.analysis_started = None
+
+    def timed(self, attr, fn):
+        def run(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.spans[attr] = (started, time.perf_counter())
+        return run
+
+    def atimed(self, attr, fn):
+        async def run(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                self.spans[attr] = (started, time.perf_counter())
+        return run
+
+    def report(self, meter):
+        """
+        latency_saved_s: how much later step 3 would have ended had the selected
+        analyzers started only after step 2 (their longest run, from the moment
+        step 2 finished). Wasted tokens/cost are what the discarded analyzers
+        were billed by the time the query ended.
+        """
+        selected = self.selected or []
+        discarded = [attr for attr in self.launched if attr not in selected]
+        spans = [self.spans[attr] for attr in selected if attr in self.spans]
+        saved = 0.0
+        if spans and self.analysis_started is not None:
+            sequential_end = self.analysis_started + max(end - start for start, end in spans)
+            saved = max(sequential_end - max(end for _, end in spans), 0.0)
+        stages = meter.summary()["stages"]
+        wasted = [stages.get(stage_name(PROMPT_MAPPING[attr]), {}) for attr in discarded]
+        return {
+            "launched": len(self.launched),
+            "used": len([attr for attr in selected if attr in self.launched]),
+            "discarded": discarded,
+            "latency_saved_s": round(saved, 3),
+            "wasted_tokens": sum(s.get("input_tokens", 0) + s.get("output_tokens", 0) for s in wasted),
+            "wasted_cost": round(sum(s.get("cost", 0.0) for s in wasted), 6),
+        }
+
+
+def _queue_message(position):
+    return {"status": "progress", "message": f"⏳ Waiting for a free slot: position {position} in the queue..."}
+
+
+def _queue_events(ticket):
+    """A progress event each time a queued query moves up, until it is admitted."""
+    position = None
+    while not ticket.admitted:
+        current = ticket.position()
+        if current and current != position:
+            position = current
+            yield _queue_message(position)
+        ticket.wait(QUEUE_POLL_S)
+
+
+async def _aqueue_events(ticket):
+    """asyncio _queue_events."""
+    position = None
+    while not ticket.admitted:
+        current = ticket.position()
+        if current and current != position:
+            position = current
+            yield _queue_message(position)
+        await ticket.await_admission(QUEUE_POLL_S)
+
+
+def _terminal_event(graph, meter, deadline, speculation=None):
+    """
+    The run's last event: the stop event or final_result, with metrics, the
+    stage timeline, whether the deadline degraded the answer (what was dropped
+    is in metrics["degradations"]) and the speculation report when it was on.
+    """
+    event = graph.stop_event or {"status": "final_result", "data": graph.results["products"]}
+    event = {**event, "metrics": meter.summary(), "timeline": graph.timeline(), "critical_path": graph.critical_path(),
+             "degraded": deadline.degraded}
+    if speculation is not None:
+        event["speculation"] = speculation.report(meter)
+    return event
+
+
+def process_user_query_streaming(user_query, category_score_threshold=6, session_routes=None):
+    """
+    Enhanced generator function that processes the user query and yields
+    status updates and results at each step, including context analysis.
+    The steps run as a stage graph (utils/stage_graph.py): each starts once
+    its inputs are ready. Every LLM call reports into one Meter for this
+    query; the terminal event carries its summary as "metrics" plus the
+    per-stage "timeline" and "critical_path". session_routes (a dict kept
+    per UI session) makes the router's model choice per stage sticky.
+    Step 6 ranks the categories concurrently and emits a category_result
+    for each as it finishes; final_result still carries all of them.
+    With SPECULATIVE_ATTRIBUTES every attribute is analyzed while step 2
+    runs; the terminal event then also carries a "speculation" report.
+    With FUSED_CONTEXT_SELECTION steps 1 and 2 are one LLM call; the same
+    context_result and attributes events are emitted from its answer.
+    ATTRIBUTE_ANALYSIS_MODE = "batched" makes step 3 one call as well.
+    With LOOK_COMPOSER_MEMO, step 5 reuses the categories of an earlier query
+    with the same attribute values and context bucket.
+    LEXICAL_FAST_PATH matches the taxonomy keywords against the query and
+    reports confident matches as a lexical_attributes event in step 3;
+    "skip" also uses them instead of those attributes' LLM analyses.
+    MENSAGEM_MODE = "derived" answers Mensagem from the other attributes via
+    the `message` combination table; "tiebreak" uses it to order the LLM's ties.
+    With QUERY_DEADLINE_S, a late context analysis is replaced by the empty
+    context and a late attribute selection by DEADLINE_ATTRIBUTES, late
+    attribute analyses are dropped and a late look composer is replaced by
+    DEADLINE_CATEGORIES ("degraded": True).
+    Beyond MAX_CONCURRENT_QUERIES the query first waits in line, reporting
+    its position as progress events; the deadline starts once it runs.
+    """
+    ticket = get_admission().enqueue()
+    try:
+        yield from _queue_events(ticket)
+        yield from _run_query_streaming(user_query, category_score_threshold, session_routes, ticket.waited_s)
+    finally:
+        ticket.release()
+
+
+def _run_query_streaming(user_query, category_score_threshold, session_routes, queue_wait_s):
+    meter = Meter(budget_tokens=QUERY_TOKEN_BUDGET, budget_cost=QUERY_COST_BUDGET)
+    meter.queue_wait_s = queue_wait_s
+    run_prompt = bind_meter(meter, partial(execute_prompt, session_routes=session_routes))
+    stream_prompt = bind_meter_iter(meter, partial(execute_prompt_streaming, session_routes=session_routes))
+    analyze_attribute = bind_meter(meter, partial(analyze_single_attribute, session_routes=session_routes))
+    analyze_batch = bind_meter(meter, partial(analyze_attributes_batched, session_routes=session_routes))
+    deadline = Deadline(QUERY_DEADLINE_S, meter)
+    # This query's share of the process-wide pool for step-3 and look composer calls
+    executor = TaskScope(get_executor("llm"))
+    speculative = _Speculation() if _speculating() else None
+    early_starts = LLM_STREAMING and speculative is None and not BATCHED_ANALYSIS
+    lexical, skipped = _lexical_fast_path(user_query)
+    local = _local_attributes(skipped)
+
+    # === Step 1: Analyze Occasion and Weather ===
+    def context(results, emit):
+        emit({"status": "progress", "message": "➡️ Step 1/6: Analyzing occasion and weather..."})
+        try:
+            context_results = _context_results(_within(
+                deadline, CONTEXT_DEADLINE_SHARE, executor,
+                run_prompt, {"user_query": user_query}, prompt_template_path=PROMPT_MAPPING["ContextAnalyzer"]))
+        except concurrent.futures.TimeoutError:
+            context_results = _deadline_context(deadline)
+        emit({"status": "context_result", "data": context_results})
+        return context_results
+
+    # === Steps 1 + 2 fused: context and top 5 attributes in one call ===
+    def fused(results, emit):
+        emit({"status": "progress", "message": "➡️ Step 1/6: Analyzing occasion and weather..."})
+        prompt = {"prompt_template": results["prompts"][CONTEXT_SELECTION_PROMPT],
+                  "prompt_template_path": CONTEXT_SELECTION_PROMPT}
+        started = {}
+        answer = {}
+        cutoff = _Cutoff()
+        context_sent = False
+
+        def collect():
+            # The context fields come first: report it, then start analyzers as att_N fields arrive
+            nonlocal context_sent
+            for key, value in stream_prompt({"user_query": user_query}, **prompt):
+                with cutoff.lock:
+                    if cutoff.expired:
+                        break
+                    answer[key] = value
+                    context_results, _ = _fused_results(answer)
+                    if not context_sent and "occasion" in answer and "weather" in answer:
+                        emit({"status": "context_result", "data": context_results})
+                        context_sent = True
+                    if (key in SELECTED_ATTRIBUTE_KEYS and value and value not in local
+                            and value not in started.values()):
+                        future = executor.submit(analyze_attribute, value, _context_row(user_query, context_results),
+                                                 prompt_template=results["prompts"].get(PROMPT_MAPPING.get(value)))
+                        started[future] = value
+            return answer
+
+        try:
+            if early_starts:
+                answer = _within(deadline, SELECTION_DEADLINE_SHARE, executor, collect)
+            else:
+                answer = _within(deadline, SELECTION_DEADLINE_SHARE, executor, run_prompt, {"user_query": user_query},
+                                 **prompt)
+            context_results, attribute_results = _fused_results(answer)
+        except concurrent.futures.TimeoutError:
+            cutoff.cut()
+            partial_context, attribute_results = split_context_selection(dict(answer))
+            context_results = (_context_results(partial_context) if context_sent
+                               else _deadline_context(deadline, partial_context))
+            attribute_results = _deadline_selection(deadline, attribute_results)
+            started = dict(started)
+        if not context_sent:
+            emit({"status": "context_result", "data": context_results})
+        return {"context": context_results, "attributes": attribute_results, "started": started}
+
+    # === Step 2: Get top 5 attributes ===
+    def selection(results, emit):
+        emit({"status": "progress", "message": "➡️ Step 2/6: Selecting the most relevant style attributes..."})
+        row_with_context = _context_row(user_query, results["context"])
+        templates = results["prompts"]
+        prompt = {"prompt_template": templates[ATTRIBUTE_SELECTION_PROMPT],
+                  "prompt_template_path": ATTRIBUTE_SELECTION_PROMPT}
+        started = {}
+        attribute_results = {}
+        cutoff = _Cutoff()
+
+        def collect():
+            # Start each attribute's analysis as soon as its att_N field has streamed in
+            for key, value in stream_prompt(row_with_context, **prompt):
+                with cutoff.lock:
+                    if cutoff.expired:
+                        break
+                    attribute_results[key] = value
+                    if (key in SELECTED_ATTRIBUTE_KEYS and value and value not in local
+                            and value not in started.values()):
+                        future = executor.submit(analyze_attribute, value, row_with_context,
+                                                 prompt_template=templates.get(PROMPT_MAPPING.get(value)))
+                        started[future] = value
+            return attribute_results
+
+        try:
+            if early_starts:
+                attribute_results = _within(deadline, SELECTION_DEADLINE_SHARE, executor, collect)
+            else:
+                attribute_results = _within(deadline, SELECTION_DEADLINE_SHARE, executor, run_prompt,
+                                            row_with_context, **prompt)
+        except concurrent.futures.TimeoutError:
+            cutoff.cut()
+            attribute_results = _deadline_selection(deadline, dict(attribute_results))
+            started = dict(started)
+        emit(_attributes_event(attribute_results))
+        return {"attributes": _top_attributes(attribute_results), "started": started}
+
+    # === Step 3 (speculative): analyze every attribute while step 2 runs ===
+    def speculation(results, emit):
+        row_with_context = _context_row(user_query, results["context"])
+        speculative.launched = [attr for attr in ANALYZER_ATTRIBUTES if attr not in local]
+        return {attr: executor.submit(speculative.timed(attr, analyze_attribute), attr, row_with_context,
+                                      prompt_template=results["prompts"][PROMPT_MAPPING[attr]])
+                for attr in speculative.launched}
+
+    # === Step 3: Analyze each selected attribute in parallel ===
+    def analysis(results, emit):
+        emit({"status": "progress", "message": "➡️ Step 3/6: Analyzing each attribute in detail..."})
+        row_with_context = _context_row(user_query, results["context"])
+        templates = results["prompts"]
+        wanted = list(dict.fromkeys(results["selection"]["attributes"]))
+        answered = _lexical_blocks(lexical, skipped, wanted, emit)
+        selected = [attr for attr in wanted if attr not in local]
+        if BATCHED_ANALYSIS:
+            return _collect_detailed_results(
+                _with_mensagem(answered + analyze_batch(selected, row_with_context, templates), wanted, skipped))
+        futures = dict(results["selection"]["started"])
+        if speculative is not None:
+            speculative.analysis_started = time.perf_counter()
+            speculative.selected = list(dict.fromkeys(results["selection"]["attributes"]))
+            speculated = results["speculation"]
+            for attr, future in speculated.items():
+                if attr not in speculative.selected:
+                    future.cancel()  # only stops it if it has not started; otherwise its answer is dropped
+            for attr in speculative.selected:
+                if attr in speculated:
+                    futures[speculated[attr]] = attr
+        for attr in selected:
+            if attr not in futures.values():
+                future = executor.submit(analyze_attribute, attr, row_with_context,
+                                         prompt_template=templates.get(PROMPT_MAPPING.get(attr)))
+                futures[future] = attr
+        # Keep submission order rather than completion order, so the look composer
+        # prompt (built from these results) is the same for the same answers
+        return _collect_detailed_results(
+            _with_mensagem(answered + _settle_analyses(futures, deadline), wanted, skipped))
+
+    # === Step 5: Select relevant product categories ===
+    def categories(results, emit):
+        emit({"status": "progress", "message": "➡️ Step 5/6: Identifying relevant product categories..."})
+        template = results["prompts"][LOOK_COMPOSER_PROMPT]
+        memo_key = (look_composer_memo_key(results["context"], results["filter"], template)
+                    if LOOK_COMPOSER_MEMO else None)
+        category_results = _recalled_categories(memo_key, meter)
+        if category_results is None:
+            future = executor.submit(run_prompt, build_category_prompt_row(user_query, results["filter"]),
+                                     prompt_template=template, prompt_template_path=LOOK_COMPOSER_PROMPT)
+            try:
+                category_results = future.result(timeout=deadline.remaining())
+            except concurrent.futures.TimeoutError:
+                return _deadline_categories(deadline, emit)
+            if memo_key:
+                memoize_categories(memo_key, category_results)
+        relevant_categories, event = _categories_event(category_results, category_score_threshold)
+        emit(event)
+        if not relevant_categories:
+            raise _no_categories()
+        return relevant_categories
+
+    graph = _query_graph(context, selection, analysis, categories, speculation if speculative else None,
+                         fused if FUSED_CONTEXT_SELECTION else None)
+    try:
+        yield from graph.run(executor=get_executor("stages"))
+    finally:
+        executor.cancel_pending()
+    yield _terminal_event(graph, meter, deadline, speculative)
+
+
+async def aprocess_user_query_streaming(user_query, category_score_threshold=6, session_routes=None):
+    """
+    asyncio twin of process_user_query_streaming, yielding the same events.
+    LLM stages are awaited on the running loop and step 3 runs as tasks, so
+    many queries can be in flight on one event loop. Step 2 is not
+    token-streamed here (LLM_STREAMING applies to the threaded pipeline).
+    Speculative analyzers that step 2 did not select are cancelled, as are
+    analyses that miss QUERY_DEADLINE_S. A queued query waits on the loop.
+    """
+    ticket = get_admission().enqueue()
+    try:
+        async for event in _aqueue_events(ticket):
+            yield event
+        async for event in _arun_query_streaming(user_query, category_score_threshold, session_routes,
+                                                 ticket.waited_s):
+            yield event
+    finally:
+        ticket.release()
+
+
+async def _arun_query_streaming(user_query, category_score_threshold, session_routes, queue_wait_s):
+    meter = Meter(budget_tokens=QUERY_TOKEN_BUDGET, budget_cost=QUERY_COST_BUDGET)
+    meter.queue_wait_s = queue_wait_s
+    run_prompt = bind_meter_async(meter, partial(aexecute_prompt, session_routes=session_routes))
+    analyze_attribute = bind_meter_async(meter, partial(aanalyze_single_attribute, session_routes=session_routes))
+    analyze_batch = bind_meter_async(meter, partial(aanalyze_attributes_batched, session_routes=session_routes))
+    speculative = _Speculation() if _speculating() else None
+    deadline = Deadline(QUERY_DEADLINE_S, meter)
+    lexical, skipped = _lexical_fast_path(user_query)
+    local = _local_attributes(skipped)
+
+    # === Step 1: Analyze Occasion and Weather ===
+    async def context(results, emit):
+        emit({"status": "progress", "message": "➡️ Step 1/6: Analyzing occasion and weather..."})
+        try:
+            context_results = _context_results(await asyncio.wait_for(
+                run_prompt({"user_query": user_query}, prompt_template_path=PROMPT_MAPPING["ContextAnalyzer"]),
+                deadline.remaining(CONTEXT_DEADLINE_SHARE)))
+        except asyncio.TimeoutError:
+            context_results = _deadline_context(deadline)
+        emit({"status": "context_result", "data": context_results})
+        return context_results
+
+    # === Steps 1 + 2 fused: context and top 5 attributes in one call ===
+    async def fused(results, emit):
+        emit({"status": "progress", "message": "➡️ Step 1/6: Analyzing occasion and weather..."})
+        try:
+            answer = await asyncio.wait_for(
+                run_prompt({"user_query": user_query}, prompt_template=results["prompts"][CONTEXT_SELECTION_PROMPT],
+                           prompt_template_path=CONTEXT_SELECTION_PROMPT),
+                deadline.remaining(SELECTION_DEADLINE_SHARE))
+            context_results, attribute_results = _fused_results(answer)
+        except asyncio.TimeoutError:
+            context_results, attribute_results = _deadline_context(deadline), _deadline_selection(deadline)
+        emit({"status": "context_result", "data": context_results})
+        return {"context": context_results, "attributes": attribute_results}
+
+    # === Step 2: Get top 5 attributes ===
+    async def selection(results, emit):
+        emit({"status": "progress", "message": "➡️ Step 2/6: Selecting the most relevant style attributes..."})
+        try:
+            attribute_results = await asyncio.wait_for(
+                run_prompt(_context_row(user_query, results["context"]),
+                           prompt_template=results["prompts"][ATTRIBUTE_SELECTION_PROMPT],
+                           prompt_template_path=ATTRIBUTE_SELECTION_PROMPT),
+                deadline.remaining(SELECTION_DEADLINE_SHARE))
+        except asyncio.TimeoutError:
+            attribute_results = _deadline_selection(deadline)
+        emit(_attributes_event(attribute_results))
+        return {"attributes": _top_attributes(attribute_results)}
+
+    # === Step 3 (speculative): analyze every attribute while step 2 runs ===
+    async def speculation(results, emit):
+        row_with_context = _context_row(user_query, results["context"])
+        speculative.launched = [attr for attr in ANALYZER_ATTRIBUTES if attr not in local]
+        return {attr: asyncio.ensure_future(speculative.atimed(attr, analyze_attribute)(
+                    attr, row_with_context, prompt_template=results["prompts"][PROMPT_MAPPING[attr]]))
+                for attr in speculative.launched}
+
+    # === Step 3: Analyze each selected attribute concurrently ===
+    async def analysis(results, emit):
+        emit({"status": "progress", "message": "➡️ Step 3/6: Analyzing each attribute in detail..."})
+        row_with_context = _context_row(user_query, results["context"])
+        templates = results["prompts"]
+        selected = list(dict.fromkeys(results["selection"]["attributes"]))
+        answered = _lexical_blocks(lexical, skipped, selected, emit)
+        if BATCHED_ANALYSIS:
+            blocks = await analyze_batch([attr for attr in selected if attr not in local], row_with_context, templates)
+            return _collect_detailed_results(_with_mensagem(answered + blocks, selected, skipped))
+        started = {}
+        if speculative is not None:
+            speculative.analysis_started = time.perf_counter()
+            speculative.selected = selected
+            for attr, task in results["speculation"].items():
+                if attr in selected:
+                    started[attr] = task
+                else:
+                    task.cancel()
+        tasks = {started.get(attr) or asyncio.ensure_future(
+                     analyze_attribute(attr, row_with_context, prompt_template=templates.get(PROMPT_MAPPING.get(attr)))
+                 ): attr for attr in selected if attr not in local}
+        return _collect_detailed_results(_with_mensagem(answered + await _asettle_analyses(tasks, deadline),
+                                                        selected, skipped))
+
+    # === Step 5: Select relevant product categories ===
+    async def categories(results, emit):
+        emit({"status": "progress", "message": "➡️ Step 5/6: Identifying relevant product categories..."})
+        template = results["prompts"][LOOK_COMPOSER_PROMPT]
+        memo_key = (look_composer_memo_key(results["context"], results["filter"], template)
+                    if LOOK_COMPOSER_MEMO else None)
+        category_results = await asyncio.to_thread(_recalled_categories, memo_key, meter)
+        if category_results is None:
+            try:
+                category_results = await asyncio.wait_for(
+                    run_prompt(build_category_prompt_row(user_query, results["filter"]),
+                               prompt_template=template, prompt_template_path=LOOK_COMPOSER_PROMPT),
+                    deadline.remaining())
+            except asyncio.TimeoutError:
+                return _deadline_categories(deadline, emit)
+            if memo_key:
+                await asyncio.to_thread(memoize_categories, memo_key, category_results)
+        relevant_categories, event = _categories_event(category_results, category_score_threshold)
+        emit(event)
+        if not relevant_categories:
+            raise _no_categories()
+        return relevant_categories
+
+    graph = _query_graph(context, selection, analysis, categories, speculation if speculative else None,
+                         fused if FUSED_CONTEXT_SELECTION else None)
+    try:
+        async for event in graph.arun():
+            yield event
+    finally:
+        for task in (graph.results.get("speculation") or {}).values():
+            task.cancel()  # a run that stopped before step 3 must not leave analyzers behind
+    yield _terminal_event(graph, meter, deadline, speculative)
 
 
 if __name__ == '__main__':
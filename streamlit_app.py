@@ -5,18 +5,20 @@ import hashlib
 from typing import Dict, List, Any
 import time
 import uuid
-from streamlit_orchestrator import stream_user_query, fetch_results_for_prewarm, render_dev_sidebar
+from streamlit_orchestrator import stream_user_query, fetch_results_for_prewarm, render_dev_sidebar, prewarm_llm_clients
 from streamlit_persistence import ensure_tables
 from utils.streamlit_utils import format_context_summary, group_products, reset_session_for_run
-from streamlit_products import render_grouped_products
+from streamlit_products import render_grouped_products, render_products_preview
 import streamlit as st
 
-from config.config import MAX_PRODUCTS, USE_CACHE, DEV_MODE, PAGE_TITLE, PAGE_ICON, LAYOUT, RECORD_CACHE
+from config.config import MAX_PRODUCTS, USE_CACHE, DEV_MODE, PAGE_TITLE, PAGE_ICON, LAYOUT, RECORD_CACHE, LLM_PREWARM
 from data.cache_runtime import read_rows, canonicalize_query, build_envelope, write_cache, CACHE_DIR, load_index, get_cached_result
 
 # --------------------------- page setup & state -------------------------------
 st.set_page_config(page_title=PAGE_TITLE, page_icon=PAGE_ICON, layout=LAYOUT)
 ensure_tables()
+if LLM_PREWARM:
+    prewarm_llm_clients()
 
 if "session_id" not in st.session_state:
     st.session_state.session_id = str(uuid.uuid4())
@@ -66,6 +68,12 @@ def _render_results():
         render_grouped_products(st.session_state.products)
 
 
+def _render_preview(ranked: Dict[int, tuple]):
+    # category_result events arrive as rankings finish; show them in step-5 order
+    with results_area.container():
+        render_products_preview(group_products(dict(ranked[rank] for rank in sorted(ranked)), cap=MAX_PRODUCTS))
+
+
 def _handle_stream(q: str):
     import hashlib
 
@@ -86,7 +94,8 @@ def _handle_stream(q: str):
     with st.spinner("Encontrando os melhores produtos…"):
         try:
             start = time.time()
-            for step in stream_user_query(q):
+            ranked = {}
+            for step in stream_user_query(q, session_routes=st.session_state.setdefault("model_routes", {})):
                 status = step.get("status")
                 if status == "progress":
                     msg = step.get("message") or ""
@@ -107,10 +116,19 @@ def _handle_stream(q: str):
                     if _type == "attributes" and data:
                         st.session_state.logs.append(f"**Atributos selecionados:** {', '.join(data)}")
                         _render_logs()
+                    elif _type == "lexical_attributes" and data:
+                        found = "; ".join(f"{b['attribute']}: {b['value_1_name']}" for b in data)
+                        label = "Atributos por palavras-chave" if step.get("skipped") else "Prévia por palavras-chave"
+                        st.session_state.logs.append(f"**{label}:** {found}")
+                        _render_logs()
                     elif _type == "categories" and data:
                         st.session_state.logs.append(f"**Categorias sugeridas:** {', '.join(data)}")
                         _render_logs()
 
+                elif status == "category_result":
+                    ranked[step.get("rank", len(ranked))] = (step.get("category"), step.get("data") or [])
+                    _render_preview(ranked)
+
                 elif status == "final_result":
                     final_results = step.get("data") or {}
                     st.session_state.products = group_products(final_results, cap=MAX_PRODUCTS)
@@ -140,6 +158,37 @@ def _handle_stream(q: str):
                     took = round(time.time() - start, 2)
                     total = sum(len(v) for v in st.session_state.products.values())
                     st.session_state.logs.append(f"\n---\n**Tempo total:** {took}s • Itens retornados: {total}")
+                    metrics = step.get("metrics")
+                    if step.get("degraded"):
+                        degradations = (metrics or {}).get("degradations", [])
+                        dropped = [attr for d in degradations for attr in d["dropped"]]
+                        note = "⏱️ _Resultado parcial: tempo limite da busca atingido"
+                        if dropped:
+                            note += f" • atributos ignorados: {', '.join(dropped)}"
+                        if any(d["stage"] == "categories" for d in degradations):
+                            note += " • categorias padrão"
+                        st.session_state.logs.append(note + "_")
+                    if DEV_MODE and metrics:
+                        st.session_state.logs.append(
+                            f"_LLM: {metrics['calls']} chamadas • "
+                            f"{metrics['input_tokens'] + metrics['output_tokens']} tokens "
+                            f"({metrics['cached_tokens']} em cache) • "
+                            f"US$ {metrics['cost']:.4f}"
+                            + (f" • {metrics['queue_wait_s']}s na fila" if metrics.get("queue_wait_s") else "")
+                            + "_"
+                        )
+                    timeline = {row["stage"]: row for row in step.get("timeline") or []}
+                    if DEV_MODE and timeline:
+                        path = " → ".join(f"{stage} {timeline[stage]['duration_s']}s"
+                                          for stage in step.get("critical_path") or [])
+                        st.session_state.logs.append(f"_Caminho crítico: {path}_")
+                    speculation = step.get("speculation")
+                    if DEV_MODE and speculation:
+                        st.session_state.logs.append(
+                            f"_Especulação: ~{speculation['latency_saved_s']}s poupados • "
+                            f"{speculation['wasted_tokens']} tokens descartados "
+                            f"({', '.join(speculation['discarded']) or 'nenhum'})_"
+                        )
                     _render_logs()
 
                 elif status == "final_message":
@@ -148,7 +197,7 @@ def _handle_stream(q: str):
                         st.session_state.logs.append(msg)
                         _render_logs()
 
-                if not st.session_state.products:
+                if not st.session_state.products and not ranked:
                     results_area.info("Buscando…")
         except Exception as e:
             st.session_state.logs.append(f"❌ Erro: {e}")
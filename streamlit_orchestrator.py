@@ -1,24 +1,66 @@
 # streamlit_orchestrator.py
 import streamlit as st
-from typing import Iterator, Dict, Any
+from typing import Iterator, Dict, Any, Optional
 from utils.streamlit_utils import group_products
 
-from config.config import CACHE_DIR
+from config.config import CACHE_DIR, ASYNC_PIPELINE, QUERY_SINGLE_FLIGHT
 from data.cache_runtime import build_envelope, read_rows, write_cache
+from utils.llm_clients import client_stats
+from utils.llm_governor import governor_stats
+from utils.llm_hedging import hedge_stats
+from utils.llm_breaker import breaker_states
+from utils.llm_cache import cache_stats
+from utils.deadline import deadline_stats
+from utils.admission import admission_stats
+from utils.executors import executor_stats
+from utils.lexical_classifier import lexical_stats
+from utils.message_index import message_index_stats
+from utils.single_flight import join_flight, query_flight_key, single_flight_stats
+from utils.async_runtime import iterate_async
+from utils.llm_utils import prewarm_model_clients
+from utils.model_router import router_stats
+from utils.prompt_schemas import parse_stats
 
 
-def stream_user_query(user_query: str) -> Iterator[Dict[str, Any]]:
+@st.cache_resource(show_spinner=False)
+def prewarm_llm_clients() -> int:
+    """Open pooled LLM connections once per process (not once per rerun)."""
+    return prewarm_model_clients()
+
+
+def stream_user_query(user_query: str, session_routes: Optional[dict] = None) -> Iterator[Dict[str, Any]]:
     """
     Main interface between the UI and the data source.
     It yields events that drive the Streamlit front-end:
       - {"status": "progress", "message": str}
       - {"status": "context_result", ...}
       - {"status": "intermediate_result", ...}
+      - {"status": "category_result", "category": str, "rank": int, "data": [products]}
       - {"status": "final_result", "data": <grouped_products_dict>}
       - {"status": "final_message", "message": str}
+    Terminal events also carry "metrics", "timeline", "critical_path" and
+    "degraded" (QUERY_DEADLINE_S cut the answer short).
+    With ASYNC_PIPELINE the query runs on the shared asyncio loop and is
+    consumed here through a sync adapter; the events are the same.
+    session_routes keeps the model router's per-stage picks for a UI session.
+    With QUERY_SINGLE_FLIGHT, a query already running for another session
+    (same canonical text) is joined instead of run again: its events so far
+    are replayed, then followed live (that run's model routes apply).
     """
+    if QUERY_SINGLE_FLIGHT:
+        yield from join_flight(query_flight_key(user_query), lambda: _run_query(user_query, session_routes))
+        return
+    yield from _run_query(user_query, session_routes)
+
+
+def _run_query(user_query: str, session_routes: Optional[dict]) -> Iterator[Dict[str, Any]]:
+    if ASYNC_PIPELINE:
+        from run_user_query import aprocess_user_query_streaming
+        yield from iterate_async(aprocess_user_query_streaming(user_query, session_routes=session_routes))
+        return
+
     from run_user_query import process_user_query_streaming
-    for step in process_user_query_streaming(user_query):
+    for step in process_user_query_streaming(user_query, session_routes=session_routes):
         yield step
 
 
@@ -42,6 +84,37 @@ def fetch_results_for_prewarm(query: str) -> dict:
 
 def render_dev_sidebar():
     with st.sidebar:
+        st.markdown("### LLM")
+        st.caption("Circuit breakers por provedor")
+        for provider, state in breaker_states().items():
+            icon = {"closed": "🟢", "half_open": "🟡", "open": "🔴"}.get(state["state"], "⚪")
+            st.write(f"{icon} **{provider}** — {state['state']} "
+                     f"(falhas seguidas: {state['consecutive_failures']}, reabre em {state['retry_in_s']}s)")
+        st.caption("Conexões reaproveitadas por provedor")
+        st.json(client_stats(), expanded=False)
+        st.caption("Fila e limites por provedor")
+        st.json(governor_stats(), expanded=False)
+        st.caption("Cache de respostas")
+        st.json(cache_stats(), expanded=False)
+        st.caption("Requisições hedge")
+        st.json(hedge_stats(), expanded=False)
+        st.caption("Parsing das respostas (schema estrito vs. fallback)")
+        st.json(parse_stats(), expanded=False)
+        st.caption("Roteamento de modelos por etapa")
+        st.json(router_stats(), expanded=False)
+        st.caption("Prazo por busca (resultados parciais)")
+        st.json(deadline_stats(), expanded=False)
+        st.caption("Fila de buscas simultâneas")
+        st.json(admission_stats(), expanded=False)
+        st.caption("Pools de threads compartilhados")
+        st.json(executor_stats(), expanded=False)
+        st.caption("Buscas e chamadas coalescidas (single-flight)")
+        st.json(single_flight_stats(), expanded=False)
+        st.caption("Classificador por palavras-chave (sem LLM)")
+        st.json(lexical_stats(), expanded=False)
+        st.caption("Mensagem pela tabela de combinações")
+        st.json(message_index_stats(), expanded=False)
+
         st.markdown("### Cache")
         _overwrite = st.checkbox("Sobrescrever existentes", False)
         _limit = st.number_input("Limite (0 = todos)", min_value=0, value=0, step=1)
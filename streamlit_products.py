@@ -164,6 +164,22 @@ def _render_product_card(p: Dict[str, Any], scope: str):
             return
 
 
+def render_products_preview(grouped: Dict[str, List[Dict[str, Any]]]):
+    """Categories ranked so far, while the query is still running: cards without widgets
+    (the interactive cards are rendered once, after the run)."""
+    for cat, products in grouped.items():
+        st.subheader(f"{cat} · {len(products)}")
+        cols_per_row = 3
+        for i, p in enumerate(products):
+            if i % cols_per_row == 0:
+                row = st.columns(cols_per_row, gap="medium")
+            with row[i % cols_per_row]:
+                _render_image(p)
+                st.markdown(f"**{p.get('name','')}**")
+                if p.get("price"):
+                    st.write(p["price"])
+
+
 def render_grouped_products(grouped: Dict[str, List[Dict[str, Any]]]):
     # reset per-render occurrence map so base keys stay stable across reruns
     st.session_state["_card_occurrence_counter"] = {}
@@ -0,0 +1,65 @@
+import json
+from collections import Counter
+
+import pytest
+
+import run_user_query
+from utils.execute_prompt import stage_name
+from utils.metering import current_meter
+from utils.prompt_schemas import get_schema
+
+CONTEXT = {"occasion": {"formality": "INFORMAL", "time": "DIA", "location": "PRAIA", "activity": "LAZER"},
+           "weather": {"climate": "Hot"}}
+SELECTED = ["Cor", "Material", "Linha", "Estrutura", "Textura"]
+CATEGORIES = ["VESTIDOS", "SAIAS", "BLUSAS & TOPS"]
+# Tokens each fake answer is billed, so budgets and wasted-token reports have something to count
+FAKE_USAGE = (100, 20)
+
+
+def fake_answer(prompt_template_path):
+    """What the model would answer for a pipeline prompt, chosen by the prompt file."""
+    selection = {**{f"att_{i}": attr for i, attr in enumerate(SELECTED, 1)},
+                 **{f"att_{i}_score": 10 - i for i in range(1, 6)}}
+    if "context_selection" in prompt_template_path:
+        return {**json.loads(json.dumps(CONTEXT)), **selection}
+    if "context_analyzer" in prompt_template_path:
+        return json.loads(json.dumps(CONTEXT))
+    if "attribute_selection" in prompt_template_path:
+        return selection
+    if "look_composer" in prompt_template_path:
+        return {**{f"cat_{i}": cat for i, cat in enumerate(CATEGORIES, 1)},
+                **{f"cat_{i}_score": 9 for i in range(1, len(CATEGORIES) + 1)}}
+    attr = next(name for name, path in run_user_query.PROMPT_MAPPING.items() if path == prompt_template_path)
+    count = sum(1 for key in get_schema(stage_name(prompt_template_path))["properties"] if key.endswith("_id"))
+    block = {"attribute": attr}
+    for i in range(1, count + 1):
+        block.update({f"value_{i}_id": i, f"value_{i}_name": "?", f"value_{i}_score": 10 - i,
+                      f"value_{i}_justification": "..."})
+    return block
+
+
+@pytest.fixture
+def fake_llm(monkeypatch):
+    """
+    Answers every pipeline prompt without an API (run_user_query's execute_prompt
+    and aexecute_prompt), billing FAKE_USAGE to the query's meter. Yields the
+    number of calls per prompt file.
+    """
+    calls = Counter()
+
+    def answer(prompt_template_path):
+        calls[prompt_template_path] += 1
+        meter = current_meter()
+        if meter is not None:
+            meter.add_usage(stage_name(prompt_template_path), "gpt-4o", *FAKE_USAGE, 0.001)
+        return fake_answer(prompt_template_path)
+
+    def execute(row, prompt_template=None, prompt_template_path=None, *args, **kwargs):
+        return answer(prompt_template_path)
+
+    async def aexecute(row, prompt_template=None, prompt_template_path=None, *args, **kwargs):
+        return answer(prompt_template_path)
+
+    monkeypatch.setattr(run_user_query, "execute_prompt", execute)
+    monkeypatch.setattr(run_user_query, "aexecute_prompt", aexecute)
+    yield calls
@@ -0,0 +1,78 @@
+import asyncio
+import threading
+import time
+
+import run_user_query
+from run_user_query import _queue_events
+from utils import executors
+from utils.admission import Admission
+from utils.executors import TaskScope, get_executor
+
+
+def test_queued_queries_see_their_position_and_move_up():
+    admission = Admission(2)
+    tickets = [admission.enqueue() for _ in range(4)]
+    assert [ticket.admitted for ticket in tickets] == [True, True, False, False]
+    assert [ticket.position() for ticket in tickets] == [0, 0, 1, 2]
+
+    tickets[0].release()
+    assert tickets[2].admitted and tickets[3].position() == 1
+    tickets[3].release()  # gave up while queued
+    stats = admission.stats()
+    assert (stats["running"], stats["queue_depth"], stats["max_queue_depth"], stats["admitted"]) == (2, 0, 2, 3)
+
+
+def test_zero_means_unlimited():
+    admission = Admission(0)
+    assert all(admission.enqueue().admitted for _ in range(50))
+
+
+def test_a_waiting_query_reports_each_position_until_admitted(monkeypatch):
+    monkeypatch.setattr(run_user_query, "QUEUE_POLL_S", 0.01)
+    admission = Admission(1)
+    running = admission.enqueue()
+    ahead = admission.enqueue()
+    ticket = admission.enqueue()
+    threading.Timer(0.1, ahead.release).start()
+    threading.Timer(0.2, running.release).start()
+    messages = [event["message"] for event in _queue_events(ticket)]
+    assert len(messages) == 2
+    assert "position 2 " in messages[0] and "position 1 " in messages[1]
+    assert ticket.admitted
+
+
+def test_async_admission_waits_on_the_loop():
+    admission = Admission(1)
+    running = admission.enqueue()
+    ticket = admission.enqueue()
+
+    async def wait():
+        asyncio.get_running_loop().call_later(0.05, running.release)
+        return await ticket.await_admission(timeout=2)
+
+    assert asyncio.run(wait())
+    assert ticket.waited_s > 0
+
+
+def test_pools_are_shared_and_sized_from_config(monkeypatch):
+    monkeypatch.setattr(executors, "_executors", {})
+    monkeypatch.setattr(executors, "EXECUTOR_WORKERS", {"llm": 3})
+    assert get_executor("llm") is get_executor("llm")
+    assert get_executor("llm")._max_workers == 3
+    assert get_executor("ranking")._max_workers == executors.DEFAULT_WORKERS
+    assert set(executors.executor_stats()) == {"llm", "ranking"}
+
+
+def test_a_query_cancels_only_its_own_queued_work(monkeypatch):
+    monkeypatch.setattr(executors, "_executors", {})
+    pool = get_executor("ranking")
+    busy = threading.Event()
+    blockers = [pool.submit(busy.wait, 5) for _ in range(pool._max_workers)]
+    scope, other = TaskScope(pool), TaskScope(pool)
+    mine, theirs = scope.submit(time.sleep, 0), other.submit(time.sleep, 0)
+    scope.cancel_pending()
+    busy.set()
+    assert mine.cancelled() and not theirs.cancelled()
+    theirs.result(timeout=2)
+    for blocker in blockers:
+        blocker.result(timeout=2)
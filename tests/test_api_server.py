@@ -0,0 +1,81 @@
+import http.client
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import api_server
+from utils.single_flight import query_flight_key
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), api_server.Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _get(url):
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            return response.status, response.read().decode("utf-8")
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode("utf-8")
+
+
+def test_a_run_that_fails_to_start_is_a_json_500(server, monkeypatch):
+    def broken(user_query, threshold):
+        raise RuntimeError("catalog locked")
+
+    monkeypatch.setattr(api_server, "query_events", broken)
+    status, body = _get(f"{server}/v1/recommend/stream?q=vestido")
+    assert status == 500
+    assert json.loads(body) == {"error": "RuntimeError: catalog locked"}
+
+
+def test_a_pipeline_error_before_any_event_is_a_json_502(server, monkeypatch):
+    closed = threading.Event()
+
+    def run(user_query, threshold):
+        try:
+            yield {"status": "error", "message": "LLM down"}
+        finally:
+            closed.set()
+
+    monkeypatch.setattr(api_server, "query_events", lambda q, threshold: (run(q, threshold), False))
+    status, body = _get(f"{server}/v1/recommend/stream?q=vestido")
+    assert status == 502
+    assert json.loads(body) == {"error": "LLM down"}
+    assert closed.wait(1)  # the run was released, not left suspended
+
+
+def test_events_are_streamed_as_sse(server, monkeypatch):
+    events = [{"status": "progress", "message": "..."}, {"status": "final_message", "message": "nada"}]
+    monkeypatch.setattr(api_server, "query_events", lambda q, threshold: (iter(events), True))
+    status, body = _get(f"{server}/v1/recommend/stream?q=vestido")
+    assert status == 200
+    assert "event: progress" in body and "event: final_message" in body
+
+
+def test_the_api_and_the_ui_share_one_flight_key():
+    # The UI runs queries at the default threshold; the API's default is the same
+    assert query_flight_key("Vestido  para Praia!") == query_flight_key("vestido para praia",
+                                                                         api_server.DEFAULT_THRESHOLD)
+
+
+@pytest.mark.parametrize("length", ["abc", "-5"])
+def test_a_malformed_content_length_is_a_400(server, length):
+    host, port = server.rsplit("/", 1)[1].split(":")
+    conn = http.client.HTTPConnection(host, int(port), timeout=5)
+    conn.putrequest("POST", "/v1/recommend")
+    conn.putheader("Content-Length", length)
+    conn.endheaders()
+    response = conn.getresponse()
+    assert response.status == 400
+    assert "Content-Length" in json.loads(response.read())["error"]
+    conn.close()
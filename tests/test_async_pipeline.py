@@ -0,0 +1,19 @@
+from collections import Counter
+
+from conftest import CONTEXT
+from run_user_query import aprocess_user_query_streaming, process_user_query_streaming
+from utils.async_runtime import iterate_async
+
+
+def _shape(events):
+    return Counter((event.get("status"), event.get("type")) for event in events)
+
+
+def test_the_async_pipeline_yields_the_same_events(fake_llm):
+    threaded = list(process_user_query_streaming("vestido leve para praia"))
+    asynchronous = list(iterate_async(aprocess_user_query_streaming("vestido leve para praia")))
+    assert threaded[-1]["status"] == "final_result"
+    assert _shape(asynchronous) == _shape(threaded)
+    assert asynchronous[-1]["data"] == threaded[-1]["data"]
+    assert [e["data"] for e in asynchronous if e["status"] == "context_result"] == [CONTEXT]
+    assert asynchronous[-1]["metrics"]["calls"] == threaded[-1]["metrics"]["calls"]
@@ -0,0 +1,93 @@
+import json
+
+import pytest
+
+import run_user_query
+from conftest import SELECTED, fake_answer
+from run_user_query import (
+    ATTRIBUTE_BATCH_PROMPT, PIPELINE_PROMPTS, PROMPT_MAPPING, _batched_blocks, aprocess_user_query_streaming,
+    build_batched_attribute_prompt, process_user_query_streaming,
+)
+from utils.async_runtime import iterate_async
+from utils.execute_prompt import parse_structured
+from utils.prompt_schemas import parse_stats
+from utils.util_functions import load_prompt
+
+TEMPLATES = {path: load_prompt(path) for path in PIPELINE_PROMPTS}
+
+
+def test_the_prompt_is_built_from_each_analyzer_prompt():
+    stage, template = build_batched_attribute_prompt(["Material", "Cor"], TEMPLATES)
+    # The same set of attributes yields the same prompt whatever their order
+    assert (stage, template) == build_batched_attribute_prompt(["Cor", "Material"], TEMPLATES)
+    # In PROMPT_MAPPING order, each asking for as many values as its analyzer's schema
+    assert template.index("### Material (return the top 3 values)") < template.index("### Cor (return the top 3")
+    cor_values = [line.strip() for line in TEMPLATES[PROMPT_MAPPING["Cor"]].splitlines()
+                  if run_user_query._VALUE_LINE.match(line)]
+    assert cor_values and all(value in template for value in cor_values)
+    # Braces from the value lists and the output example survive formatting
+    assert '"Cor": {' in template.format(user_query="vestido vermelho")
+
+
+def test_the_answer_splits_into_the_blocks_the_fan_out_returns():
+    cor, material = fake_answer(PROMPT_MAPPING["Cor"]), fake_answer(PROMPT_MAPPING["Material"])
+    answer = {"Material": material, "Cor": cor, "Linha": "?"}
+    assert _batched_blocks(answer, ["Cor", "Material", "Linha", "Textura"]) == [cor, material]
+    assert _batched_blocks(None, ["Cor"]) == []
+
+
+def test_batch_answers_are_checked_against_the_combined_schema():
+    stage, _ = build_batched_attribute_prompt(["Cor", "Material"], TEMPLATES)
+    answer = {attr: fake_answer(PROMPT_MAPPING[attr]) for attr in ("Cor", "Material")}
+    before = parse_stats()
+    assert parse_structured(json.dumps(answer, indent=2), stage) == answer
+    # A block missing a value fails the strict parse; the lenient fallback still returns the JSON
+    del answer["Cor"]["value_2_name"]
+    assert parse_structured(json.dumps(answer, indent=2), stage) == answer
+    after = parse_stats()
+    assert (after["strict"], after["fallback"]) == (before["strict"] + 1, before["fallback"] + 1)
+
+
+@pytest.fixture
+def batched(monkeypatch, fake_llm):
+    """Batched step 3, answering for the selected attributes; set .answer to replace the batch answer."""
+    monkeypatch.setattr(run_user_query, "BATCHED_ANALYSIS", True)
+    execute, aexecute = run_user_query.execute_prompt, run_user_query.aexecute_prompt
+    batch = type("Batch", (), {"calls": 0, "answer": None})()
+
+    def answer(row, prompt_template):
+        batch.calls += 1
+        assert all(f"### {attr} " in prompt_template for attr in SELECTED)
+        return batch.answer if batch.answer is not None else {
+            attr: fake_answer(PROMPT_MAPPING[attr]) for attr in SELECTED}
+
+    def execute_batch(row, prompt_template=None, prompt_template_path=None, *args, stage=None, **kwargs):
+        if stage and stage.startswith("att_batch_"):
+            return answer(row, prompt_template)
+        return execute(row, prompt_template, prompt_template_path, *args, stage=stage, **kwargs)
+
+    async def aexecute_batch(row, prompt_template=None, prompt_template_path=None, *args, stage=None, **kwargs):
+        if stage and stage.startswith("att_batch_"):
+            return answer(row, prompt_template)
+        return await aexecute(row, prompt_template, prompt_template_path, *args, stage=stage, **kwargs)
+
+    monkeypatch.setattr(run_user_query, "execute_prompt", execute_batch)
+    monkeypatch.setattr(run_user_query, "aexecute_prompt", aexecute_batch)
+    batch.fan_out = fake_llm
+    return batch
+
+
+@pytest.mark.parametrize("run", [
+    lambda query: list(process_user_query_streaming(query)),
+    lambda query: list(iterate_async(aprocess_user_query_streaming(query))),
+], ids=["threaded", "async"])
+def test_step_3_is_one_call(batched, run):
+    assert run("vestido leve para praia")[-1]["status"] == "final_result"
+    assert batched.calls == 1
+    assert not any(batched.fan_out[PROMPT_MAPPING[attr]] for attr in SELECTED)
+
+
+def test_an_unusable_batch_answer_ends_the_query(batched):
+    batched.answer = {"Cor": "?"}
+    final = list(process_user_query_streaming("vestido leve para praia"))[-1]
+    assert final == {**final, "status": "error", "message": "Could not get detailed attribute values."}
@@ -0,0 +1,31 @@
+import time
+
+import run_user_query
+from run_user_query import _stage_products, select_relevant_categories
+
+RANKED = ["VESTIDOS", "SAIAS", "CAMISAS"]
+
+
+def test_categories_above_the_threshold_keep_the_look_composer_order():
+    answer = {"cat_1": "VESTIDOS", "cat_1_score": 9, "cat_2": "CALÇAS", "cat_2_score": 6,
+              "cat_3": "SAIAS", "cat_3_score": 8, "cat_4": "CAMISAS", "cat_4_score": "10"}
+    assert select_relevant_categories(answer, 6) == ["VESTIDOS", "SAIAS"]
+    assert select_relevant_categories(None, 6) == []
+
+
+def test_each_category_is_sent_as_it_finishes_and_the_result_keeps_step_5_order(monkeypatch):
+    delays = {"VESTIDOS": 0.2, "SAIAS": 0.0, "CAMISAS": 0.1}
+
+    def search(detailed_results=None, category_name=None, limit=3, attribute_ids=None):
+        time.sleep(delays[category_name])
+        return [f"{category_name} product"]
+
+    monkeypatch.setattr(run_user_query, "search_products_with_details", search)
+    events = []
+    products = _stage_products({"categories": RANKED, "filter": [], "attribute_ids": None}, events.append)
+
+    sent = [event for event in events if event["status"] == "category_result"]
+    assert [event["category"] for event in sent] == ["SAIAS", "CAMISAS", "VESTIDOS"]
+    assert [event["rank"] for event in sent] == [1, 2, 0]
+    assert sent[0]["data"] == ["SAIAS product"]
+    assert list(products) == RANKED
@@ -0,0 +1,49 @@
+import concurrent.futures
+import time
+
+import pytest
+
+from run_user_query import _deadline_selection, _settle_analyses, _within
+from utils.deadline import Deadline, deadline_stats
+
+
+def test_late_selection_keeps_what_arrived():
+    deadline = Deadline(1.0)
+    fallbacks = deadline_stats()["selection_fallbacks"]
+    attributes = _deadline_selection(deadline, {"att_1": "Linha", "att_1_score": "9", "att_2": "Cor"})
+    assert list(attributes.values())[:2] == ["Linha", "Cor"]
+    assert len(attributes) == 5 and len(set(attributes.values())) == 5
+    assert deadline.degraded
+    assert deadline_stats()["selection_fallbacks"] == fallbacks + 1
+
+
+def test_a_stage_call_is_given_its_share_of_the_deadline():
+    deadline = Deadline(0.2)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        assert _within(deadline, 0.5, executor, lambda: "in time") == "in time"
+        with pytest.raises(concurrent.futures.TimeoutError):
+            _within(deadline, 0.5, executor, time.sleep, 1.0)
+    finally:
+        executor.shutdown(wait=False)
+
+
+def test_without_a_deadline_the_call_runs_inline():
+    assert Deadline(0).remaining() is None
+    assert _within(Deadline(0), 0.5, None, lambda: "inline") == "inline"
+
+
+def test_failed_analyses_do_not_spin_the_wait_for_a_usable_one(monkeypatch):
+    calls = []
+    wait = concurrent.futures.wait
+    monkeypatch.setattr(concurrent.futures, "wait", lambda *args, **kwargs: calls.append(1) or wait(*args, **kwargs))
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    try:
+        failed = executor.submit(lambda: None)
+        late = executor.submit(lambda: time.sleep(0.2) or {"attribute": "Cor"})
+        failed.result()
+        outcomes = _settle_analyses({failed: "Linha", late: "Cor"}, Deadline(0.05))
+    finally:
+        executor.shutdown(wait=False)
+    assert outcomes == [None, {"attribute": "Cor"}]
+    assert len(calls) <= 3
@@ -0,0 +1,33 @@
+import pytest
+
+from run_user_query import ATTRIBUTE_SELECTION_PROMPT, CONTEXT_SELECTION_PROMPT, PROMPT_MAPPING
+from utils import execute_prompt as ep
+from utils import llm_utils
+from utils.execute_prompt import split_template
+from utils.util_functions import load_prompt
+
+
+@pytest.mark.parametrize("path", [ATTRIBUTE_SELECTION_PROMPT, CONTEXT_SELECTION_PROMPT] + list(PROMPT_MAPPING.values()))
+def test_only_the_query_is_left_out_of_the_cacheable_prefix(path):
+    static, dynamic = split_template(load_prompt(path))
+    assert "json" in static.lower()  # the output format is part of the prefix
+    assert dynamic.strip().startswith("User Query:")
+    assert dynamic.count("\n\n") == 0
+
+
+def test_escaped_braces_before_the_query_are_unescaped_in_the_prefix():
+    static, dynamic = split_template('Answer as JSON:\n{{"a": 1}}\n\nQuery: {user_query}\n')
+    assert static == 'Answer as JSON:\n{"a": 1}'
+    assert dynamic == "Query: {user_query}\n"
+
+
+@pytest.mark.parametrize("source, recorded", [(None, 1), ("cache", 0), ("cassette", 0), ("single_flight", 0)])
+def test_only_upstream_answers_feed_the_router(monkeypatch, source, recorded):
+    samples = []
+    response = llm_utils._completion("gpt-4o", '{"att_1": "Cor"}')
+    if source:
+        response = llm_utils._reused(response, source)
+    monkeypatch.setattr(ep, "call_model", lambda *args, **kwargs: response)
+    monkeypatch.setattr(ep, "record_outcome", lambda *args, **kwargs: samples.append(args))
+    assert ep.execute_prompt({}, prompt_template="Query", api_model="gpt-4o", stage="test") == {"att_1": "Cor"}
+    assert len(samples) == recorded
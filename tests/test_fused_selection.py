@@ -0,0 +1,65 @@
+import pytest
+
+import run_user_query
+from conftest import CONTEXT, SELECTED, fake_answer
+from run_user_query import (
+    ATTRIBUTE_SELECTION_PROMPT, CONTEXT_SELECTION_PROMPT, PROMPT_MAPPING, aprocess_user_query_streaming,
+    process_user_query_streaming,
+)
+from utils.async_runtime import iterate_async
+
+
+@pytest.fixture
+def fused(monkeypatch, fake_llm):
+    monkeypatch.setattr(run_user_query, "FUSED_CONTEXT_SELECTION", True)
+    return fake_llm
+
+
+def _data(events, status, kind=None):
+    return [e["data"] for e in events if e["status"] == status and e.get("type") == kind]
+
+
+@pytest.mark.parametrize("run", [
+    lambda query: list(process_user_query_streaming(query)),
+    lambda query: list(iterate_async(aprocess_user_query_streaming(query))),
+], ids=["threaded", "async"])
+def test_one_call_answers_steps_1_and_2(fused, run):
+    events = run("vestido leve para praia")
+    assert events[-1]["status"] == "final_result"
+    assert fused[CONTEXT_SELECTION_PROMPT] == 1
+    assert fused[PROMPT_MAPPING["ContextAnalyzer"]] == fused[ATTRIBUTE_SELECTION_PROMPT] == 0
+    # The answer is split back into the events the two calls would have produced
+    assert _data(events, "context_result") == [CONTEXT]
+    assert _data(events, "intermediate_result", "attributes") == [SELECTED]
+
+
+def test_a_fused_answer_without_context_falls_back_to_the_empty_context(monkeypatch, fused):
+    execute = run_user_query.execute_prompt
+
+    def no_context(row, prompt_template=None, prompt_template_path=None, *args, **kwargs):
+        answer = execute(row, prompt_template, prompt_template_path, *args, **kwargs)
+        if prompt_template_path == CONTEXT_SELECTION_PROMPT:
+            del answer["occasion"], answer["weather"]
+        return answer
+
+    monkeypatch.setattr(run_user_query, "execute_prompt", no_context)
+    events = list(process_user_query_streaming("vestido leve para praia"))
+    assert _data(events, "context_result") == [{"occasion": {}, "weather": {}}]
+    assert _data(events, "intermediate_result", "attributes") == [SELECTED]
+
+
+def test_streamed_context_is_reported_and_analyzers_start_from_the_fused_call(monkeypatch, fused):
+    monkeypatch.setattr(run_user_query, "LLM_STREAMING", True)
+    streamed = []
+
+    def stream(row, prompt_template=None, prompt_template_path=None, *args, **kwargs):
+        streamed.append(prompt_template_path)
+        yield from fake_answer(prompt_template_path).items()
+
+    monkeypatch.setattr(run_user_query, "execute_prompt_streaming", stream)
+    events = list(process_user_query_streaming("vestido leve para praia"))
+    assert events[-1]["status"] == "final_result"
+    assert streamed == [CONTEXT_SELECTION_PROMPT]
+    assert _data(events, "context_result") == [CONTEXT]
+    # Each selected analyzer was started once, while the selection streamed in
+    assert all(fused[PROMPT_MAPPING[attr]] == 1 for attr in SELECTED)
@@ -0,0 +1,43 @@
+import json
+
+import pytest
+
+from utils.json_stream import IncrementalJSONParser
+
+ANSWER = {"att_1": "Cor", "att_2": "Estrutura", "scores": [9, 7], "count": 10}
+
+
+def _feed(text, size):
+    parser = IncrementalJSONParser()
+    completed = []
+    for start in range(0, len(text), size):
+        completed.extend(parser.feed(text[start:start + size]))
+    return parser, completed
+
+
+@pytest.mark.parametrize("size", [1, 3, 1000])
+def test_members_complete_in_order_whatever_the_chunking(size):
+    parser, completed = _feed("```json\n" + json.dumps(ANSWER, indent=2) + "\n```", size)
+    assert completed == list(ANSWER.items())
+    assert parser.result == ANSWER and parser.done and not parser.failed
+
+
+def test_a_member_is_returned_as_soon_as_its_value_closes():
+    parser = IncrementalJSONParser()
+    assert parser.feed('{"att_1": "Co') == []
+    assert parser.feed('r", "att_2": "Es') == [("att_1", "Cor")]
+    assert parser.result == {"att_1": "Cor"}
+
+
+def test_a_number_waits_for_its_delimiter():
+    parser = IncrementalJSONParser()
+    assert parser.feed('{"count": 1') == []
+    assert parser.feed("0}") == [("count", 10)]
+    assert parser.done
+
+
+def test_malformed_input_stops_the_parser():
+    parser = IncrementalJSONParser()
+    assert parser.feed("{att_1: 'Cor'}") == []
+    assert parser.failed
+    assert parser.feed(', "att_2": "Estrutura"}') == []
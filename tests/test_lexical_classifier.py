@@ -0,0 +1,49 @@
+from run_user_query import apply_exclusion_rules, lexical_matches
+from utils.lexical_classifier import LexicalClassifier
+
+# Occasion and weather whose exclusion rules drop Couro (occasion) and Pesado | Estruturado (weather)
+BEACH_DAY = {
+    "occasion": {"formality": "INFORMAL", "time": "DIA", "location": "PRAIA", "activity": "LAZER"},
+    "weather": {"climate": "Hot"},
+}
+
+
+def _names(block):
+    return [block[f"value_{i}_name"] for i in range(1, 4) if f"value_{i}_name" in block]
+
+
+def test_blocks_use_the_prompt_names():
+    classifier = LexicalClassifier(
+        {"Material": [(4, "tecido plano", "crepe, viscose"), (5, "couro", "couro, couro sintético, suede")]},
+        names={"Material": {4: "Tecido plano", 5: "Couro"}})
+    block, confidence = classifier.classify("Material", "Bolsa de COURO sintético")
+    assert block["value_1_id"] == 5
+    assert block["value_1_name"] == "Couro"
+    assert confidence >= 0.5
+
+
+def test_confidence_drops_when_values_tie():
+    classifier = LexicalClassifier({"Material": [(3, "tecido festivo", "sarja"), (4, "tecido plano", "sarja")]})
+    block, confidence = classifier.classify("Material", "calça de sarja")
+    assert _names(block) == ["tecido festivo", "tecido plano"]
+    assert confidence == 0.25
+
+
+def test_no_match():
+    classifier = LexicalClassifier({"Material": [(1, "jeans", "jeans")]})
+    assert classifier.classify("Material", "vestido de festa") == (None, 0.0)
+
+
+def test_lexical_blocks_go_through_the_exclusion_rules():
+    matches = lexical_matches("vou à praia de dia com uma bolsa de couro sintético e um vestido estruturado e pesado")
+    assert _names(matches["Material"]) == ["Couro"]
+    assert _names(matches["Estrutura"]) == ["Pesado | Estruturado"]
+
+    kept = apply_exclusion_rules(BEACH_DAY, [matches["Material"], matches["Estrutura"]])
+    assert kept == []
+
+
+def test_lexical_labels_match_the_analyzer_prompts():
+    matches = lexical_matches("pantalona e blazer")
+    assert matches["Linha"]["attribute"] == "Linha | Forma"
+    assert _names(matches["Linha"]) == ["Linhas retas | Geométricas"]
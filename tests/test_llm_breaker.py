@@ -0,0 +1,68 @@
+import time
+
+from utils import llm_breaker
+from utils.llm_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, fallback_chain
+
+
+def _breaker(cooldown=0.05, slow_call_s=0.0):
+    return CircuitBreaker("test", failure_threshold=2, cooldown=cooldown, slow_call_s=slow_call_s)
+
+
+def test_consecutive_failures_open_the_circuit():
+    breaker = _breaker()
+    breaker.record_failure()
+    breaker.record_success()  # a success in between resets the count
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.snapshot()["rejected"] == 1
+
+
+def test_one_probe_after_the_cooldown_closes_it_again():
+    breaker = _breaker()
+    breaker.record_failure()
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()  # only one probe at a time
+    breaker.record_success()
+    assert breaker.state == CLOSED and breaker.allow()
+
+
+def test_a_failed_probe_reopens_for_another_cooldown():
+    breaker = _breaker()
+    breaker.record_failure()
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert breaker.snapshot()["times_opened"] == 2
+
+
+def test_a_released_probe_frees_the_slot():
+    breaker = _breaker()
+    breaker.record_failure()
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.release()  # e.g. a 429: says nothing about health
+    assert breaker.state == HALF_OPEN and breaker.allow()
+
+
+def test_slow_calls_count_as_failures():
+    breaker = _breaker(slow_call_s=1.0)
+    breaker.record_success(elapsed=2.0)
+    breaker.record_success(elapsed=2.0)
+    assert breaker.state == OPEN
+
+
+def test_fallback_chain_puts_the_requested_model_first(monkeypatch):
+    monkeypatch.setattr(llm_breaker, "LLM_FALLBACKS", {"default": ["gpt-4o-mini", "gpt-4o"],
+                                                       "7_att_cor": ["deepseek-v3"]})
+    assert fallback_chain("gpt-4o", "0_attribute_selection") == ["gpt-4o", "gpt-4o-mini"]
+    assert fallback_chain("gpt-4o", "7_att_cor") == ["gpt-4o", "deepseek-v3"]
@@ -0,0 +1,73 @@
+import sqlite3
+import time
+
+import pytest
+
+from utils import llm_cache, llm_utils
+from utils.llm_cache import SqliteTTLCache, request_key
+
+MESSAGES = [{"role": "user", "content": "vestido para casamento na praia"}]
+
+
+def _cache(tmp_path, **kwargs):
+    return SqliteTTLCache(tmp_path / "cache.sqlite", "llm", kwargs.get("ttl", 60), kwargs.get("max_entries", 10))
+
+
+def test_request_key_depends_on_the_model():
+    assert request_key(MESSAGES, "gpt-4o", 1) == request_key(list(MESSAGES), "gpt-4o", 1)
+    assert request_key(MESSAGES, "gpt-4o", 1) != request_key(MESSAGES, "deepseek-chat", 1)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = _cache(tmp_path, max_entries=2)
+    cache.put("a", "1")
+    time.sleep(0.01)
+    cache.put("b", "2")
+    time.sleep(0.01)
+    assert cache.get("a") == "1"
+    time.sleep(0.01)
+    cache.put("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1" and cache.get("c") == "3"
+
+
+def test_a_fallback_answer_is_cached_under_the_fallback_model(tmp_path, monkeypatch):
+    cache = _cache(tmp_path)
+    answer = llm_utils._completion("deepseek-chat", "{}")
+    monkeypatch.setattr(llm_utils, "get_cache", lambda namespace: cache)
+    monkeypatch.setattr(llm_utils, "_call_with_retries",
+                        lambda messages, model, *args: answer if model == "deepseek-v3" else None)
+
+    response = llm_utils._call_chain(MESSAGES, ["gpt-4o", "deepseek-v3"], None, False, 1, "test", False, True)
+    assert response is answer
+    assert llm_utils.served_by(response, "gpt-4o") == "deepseek-v3"
+    assert cache.get(request_key(MESSAGES, "gpt-4o", 1)) is None
+    assert cache.get(request_key(MESSAGES, "deepseek-chat", 1)) == answer.model_dump_json()
+
+
+def test_a_cache_hit_is_marked_as_reused(tmp_path, monkeypatch):
+    cache = _cache(tmp_path)
+    monkeypatch.setattr(llm_utils, "get_cache", lambda namespace: cache)
+    cache.put(request_key(MESSAGES, "gpt-4o", 1), llm_utils._completion("gpt-4o", "{}").model_dump_json())
+    response = llm_utils._call_model(MESSAGES, "gpt-4o", None, False, 1, "test", False, True)
+    assert llm_utils.reused_from(response) == "cache"
+
+
+def test_every_operation_closes_its_connection(tmp_path, monkeypatch):
+    opened = []
+    connect = llm_cache.sqlite3.connect
+
+    def tracking(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        opened.append(conn)
+        return conn
+
+    monkeypatch.setattr(llm_cache.sqlite3, "connect", tracking)
+    cache = _cache(tmp_path)
+    cache.put("a", "1")
+    assert cache.get("a") == "1"
+    cache.clear()
+    assert len(opened) == 4
+    for conn in opened:
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")  # closed
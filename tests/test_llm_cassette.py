@@ -0,0 +1,79 @@
+import asyncio
+import gzip
+
+import pytest
+
+from utils import llm_utils
+from utils.llm_cache import request_key
+from utils.llm_cassette import RECORD, REPLAY, Cassette
+
+MESSAGES = [{"role": "user", "content": "vestido para casamento na praia"}]
+USAGE = {"prompt_tokens": 120, "completion_tokens": 30, "total_tokens": 150}
+
+
+def test_a_recording_replays_with_its_latency(tmp_path):
+    path = tmp_path / "llm.jsonl.gz"
+    recorder = Cassette(path, RECORD)
+    recorder.record("k1", "gpt-4o", '{"att_1": "Cor"}', USAGE, 0.8)
+    recorder.close()
+
+    player = Cassette(path, REPLAY, replay_latency=True)
+    entry = player.get("k1")
+    assert entry["content"] == '{"att_1": "Cor"}'
+    assert player.delay(entry) == 0.8
+    assert Cassette(path, REPLAY).delay(entry) == 0.0
+    assert player.get("k2") is None
+    assert player.stats() == {"mode": REPLAY, "entries": 1, "hits": 1, "misses": 1, "recorded": 0}
+
+
+def test_a_truncated_recording_keeps_the_complete_entries(tmp_path):
+    path = tmp_path / "llm.jsonl.gz"
+    recorder = Cassette(path, RECORD)
+    recorder.record("k1", "gpt-4o", "{}", None, 0.1)
+    recorder.close()
+    data = path.read_bytes()
+    with gzip.open(path, "ab") as fh:
+        fh.write(b'{"key": "k2", "content": "{}"}\n')
+    path.write_bytes(path.read_bytes()[:len(data) + 10])  # killed mid-write
+
+    assert Cassette(path, REPLAY).get("k1") is not None
+
+
+def test_call_model_answers_from_the_cassette_without_the_api(tmp_path, monkeypatch):
+    path = tmp_path / "llm.jsonl.gz"
+    key = request_key(MESSAGES, llm_utils.MODELS["gpt-4o"]["model_name"], 1, None)
+    recorder = Cassette(path, RECORD)
+    recorder.record(key, "gpt-4o", '{"att_1": "Cor"}', USAGE, 0.5)
+    recorder.close()
+
+    def offline(*args):
+        raise AssertionError("replay must not reach the API")
+
+    monkeypatch.setattr(llm_utils, "get_cassette", lambda: Cassette(path, REPLAY))
+    monkeypatch.setattr(llm_utils, "_call_model", offline)
+    response = llm_utils.call_model(MESSAGES, "gpt-4o", stage="test")
+    assert response.choices[0].message.content == '{"att_1": "Cor"}'
+    assert response.usage.total_tokens == 150
+    assert llm_utils.call_model([{"role": "user", "content": "outra"}], "gpt-4o", stage="test") is None
+
+
+def test_answers_are_recorded_under_the_request_key(tmp_path, monkeypatch):
+    cassette = Cassette(tmp_path / "llm.jsonl.gz", RECORD)
+    answer = llm_utils._completion("gpt-4o", "{}")
+    monkeypatch.setattr(llm_utils, "get_cassette", lambda: cassette)
+    monkeypatch.setattr(llm_utils, "_call_model", lambda *args: answer)
+    assert llm_utils.call_model(MESSAGES, "gpt-4o", stage="test") is answer
+    cassette.close()
+
+    key = request_key(MESSAGES, llm_utils.MODELS["gpt-4o"]["model_name"], 1, None)
+    assert Cassette(cassette.path, REPLAY).get(key)["content"] == "{}"
+
+
+def test_an_unknown_model_is_refused_as_without_a_cassette(tmp_path, monkeypatch):
+    monkeypatch.setattr(llm_utils, "get_cassette", lambda: Cassette(tmp_path / "llm.jsonl.gz", REPLAY))
+    with pytest.raises(ValueError, match="Invalid model"):
+        llm_utils.call_model(MESSAGES, "gpt-9", stage="test")
+    with pytest.raises(ValueError, match="Invalid model"):
+        list(llm_utils.stream_model(MESSAGES, "gpt-9", stage="test"))
+    with pytest.raises(ValueError, match="Invalid model"):
+        asyncio.run(llm_utils.acall_model(MESSAGES, "gpt-9", stage="test"))
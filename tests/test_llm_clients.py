@@ -0,0 +1,13 @@
+from utils import llm_utils
+
+
+def test_prewarm_uses_each_providers_own_key(monkeypatch):
+    monkeypatch.setattr(llm_utils, "API_KEY", None)
+    monkeypatch.setenv("DEEPSEEK_API_KEY", "sk-deepseek")
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    monkeypatch.delenv("GOOGLE_API_KEY", raising=False)
+    warmed = []
+    monkeypatch.setattr(llm_utils, "prewarm_clients", lambda targets: warmed.extend(targets) or len(warmed))
+
+    assert llm_utils.prewarm_model_clients() == 1
+    assert warmed == [("deepseek", "sk-deepseek", "https://api.deepseek.com/v1")]
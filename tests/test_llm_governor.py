@@ -0,0 +1,87 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from utils import llm_governor
+from utils.llm_governor import ProviderGovernor, QueueTimeout, backoff_delay, retry_after_seconds
+
+
+def test_in_flight_cap_holds_callers_until_a_release():
+    governor = ProviderGovernor("test", max_in_flight=1, rpm=600, tpm=100_000)
+    assert governor.try_acquire(100) == 0.0
+    assert governor.try_acquire(100) > 0  # second caller must wait
+    admitted = threading.Event()
+    waiter = threading.Thread(target=lambda: (governor.acquire(100, timeout=2), admitted.set()))
+    waiter.start()
+    time.sleep(0.05)
+    assert not admitted.is_set()
+    governor.release(100)
+    waiter.join(2)
+    assert admitted.is_set()
+    assert governor.snapshot()["in_flight"] == 1
+
+
+def test_token_budget_refuses_a_request_it_cannot_cover():
+    governor = ProviderGovernor("test", max_in_flight=8, rpm=600, tpm=6000)
+    assert governor.try_acquire(6000) == 0.0
+    # The bucket is empty: 1000 tokens refill in 10 s at 6000/min
+    assert governor.try_acquire(1000) == pytest.approx(10.0, rel=0.05)
+
+
+def test_real_usage_beyond_the_reservation_is_charged():
+    governor = ProviderGovernor("test", max_in_flight=8, rpm=600, tpm=6000)
+    with governor.slot(1000) as slot:
+        slot["used"] = 4000
+    assert governor.try_acquire(2500) > 0  # 6000 - 4000 used leaves 2000
+
+
+def test_queue_timeout():
+    governor = ProviderGovernor("test", max_in_flight=1, rpm=600, tpm=100_000)
+    governor.acquire(10)
+    with pytest.raises(QueueTimeout):
+        governor.acquire(10, timeout=0.05)
+    assert governor.snapshot()["queued"] == 0
+
+
+def test_cool_down_pauses_admissions():
+    governor = ProviderGovernor("test", max_in_flight=8, rpm=600, tpm=100_000)
+    governor.cool_down(0.5)
+    assert 0 < governor.try_acquire(10) <= 0.5
+    assert governor.snapshot()["throttled"] == 1
+
+
+def test_async_slots_queue_on_the_loop(monkeypatch):
+    monkeypatch.setattr(llm_governor, "LLM_QUEUE_TIMEOUT", 2)
+    governor = ProviderGovernor("test", max_in_flight=1, rpm=600, tpm=100_000)
+    peak = []
+
+    async def call():
+        async with governor.aslot(10):
+            peak.append(governor.in_flight)
+            await asyncio.sleep(0.02)
+
+    async def run():
+        await asyncio.gather(call(), call(), call())
+
+    asyncio.run(run())
+    assert peak == [1, 1, 1]
+    assert governor.snapshot()["admitted"] == 3
+
+
+def test_retry_after_header_is_read_in_seconds_or_ms():
+    error = lambda headers: SimpleNamespace(response=SimpleNamespace(headers=headers))
+    assert retry_after_seconds(error({"retry-after": "3"})) == 3.0
+    assert retry_after_seconds(error({"retry-after-ms": "250"})) == 0.25
+    assert retry_after_seconds(error({})) is None
+    assert retry_after_seconds(ValueError("no response")) is None
+
+
+def test_backoff_honours_retry_after_up_to_the_cap(monkeypatch):
+    monkeypatch.setattr(llm_governor, "LLM_BACKOFF_BASE", 0.5)
+    monkeypatch.setattr(llm_governor, "LLM_BACKOFF_MAX", 8.0)
+    assert 0 <= backoff_delay(2) <= 2.0
+    assert backoff_delay(0, retry_after=5.0) == 5.0
+    assert backoff_delay(0, retry_after=60.0) == 8.0
@@ -0,0 +1,50 @@
+import concurrent.futures
+import threading
+import time
+
+from utils import executors, llm_hedging
+from utils.llm_hedging import run_hedged
+
+
+def _slow(value, seconds):
+    def call():
+        time.sleep(seconds)
+        return value
+    return call
+
+
+def test_a_busy_hedge_pool_does_not_delay_the_primary(monkeypatch):
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    release = threading.Event()
+    pool.submit(release.wait, 5)  # every hedge worker is taken
+    monkeypatch.setattr(llm_hedging, "_executor", pool)
+    fired = llm_hedging.hedge_stats()["hedges_fired"]
+    try:
+        assert run_hedged(_slow("primary", 0.05), _slow("hedge", 0), 0.5) == "primary"
+    finally:
+        release.set()
+        pool.shutdown()
+    assert llm_hedging.hedge_stats()["hedges_fired"] == fired
+
+
+def test_the_hedge_answers_for_a_slow_primary(monkeypatch):
+    monkeypatch.setattr(llm_hedging, "LLM_HEDGE_MAX_RATIO", 1.0)
+    won = llm_hedging.hedge_stats()["hedges_won"]
+    started = time.perf_counter()
+    assert run_hedged(_slow("primary", 1.0), _slow("hedge", 0), 0.05) == "hedge"
+    assert time.perf_counter() - started < 0.5
+    assert llm_hedging.hedge_stats()["hedges_won"] == won + 1
+
+
+def test_primaries_share_a_bounded_pool_and_queue_time_is_not_hedged(monkeypatch):
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setitem(executors._executors, "hedged", pool)
+    monkeypatch.setattr(llm_hedging, "LLM_HEDGE_MAX_RATIO", 1.0)
+    pool.submit(time.sleep, 0.2)  # the only worker is busy for longer than the hedge delay
+    fired = llm_hedging.hedge_stats()["hedges_fired"]
+    try:
+        assert run_hedged(_slow("primary", 0.02), _slow("hedge", 0), 0.1) == "primary"
+    finally:
+        pool.shutdown()
+    assert llm_hedging.hedge_stats()["hedges_fired"] == fired
+    assert len(pool._threads) == 1
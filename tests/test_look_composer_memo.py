@@ -0,0 +1,59 @@
+import pytest
+
+import run_user_query
+from conftest import CONTEXT, SELECTED, fake_answer
+from run_user_query import (
+    LOOK_COMPOSER_PROMPT, PROMPT_MAPPING, aprocess_user_query_streaming, look_composer_memo_key,
+    memoize_categories, process_user_query_streaming, recall_categories,
+)
+from utils.async_runtime import iterate_async
+from utils.execute_prompt import stage_name
+from utils.llm_cache import SqliteTTLCache
+
+TEMPLATE = "Categories for {user_query}: {fashion_attributes}"
+BLOCKS = [fake_answer(PROMPT_MAPPING[attr]) for attr in SELECTED]
+
+
+@pytest.fixture
+def memo(monkeypatch, tmp_path):
+    caches = {}
+    monkeypatch.setattr(run_user_query, "get_cache", lambda namespace, ttl: caches.setdefault(
+        namespace, SqliteTTLCache(str(tmp_path / "memo.sqlite"), namespace, ttl, 100)))
+    monkeypatch.setattr(run_user_query, "LOOK_COMPOSER_MEMO", True)
+    return caches
+
+
+def _context(**occasion):
+    return {**CONTEXT, "occasion": {**CONTEXT["occasion"], **occasion}}
+
+
+def test_the_key_is_the_attribute_signature_and_a_coarse_context():
+    key = look_composer_memo_key(CONTEXT, BLOCKS, TEMPLATE)
+    # Block order and case do not matter, nor do the finer context fields
+    shuffled = [dict(block, value_1_name=block["value_1_name"].upper()) for block in reversed(BLOCKS)]
+    assert look_composer_memo_key(_context(time="NOITE", activity="FESTA"), shuffled, TEMPLATE) == key
+    assert look_composer_memo_key(_context(location="CIDADE"), BLOCKS, TEMPLATE) != key
+    assert look_composer_memo_key({**CONTEXT, "weather": {"climate": "Cold"}}, BLOCKS, TEMPLATE) != key
+    assert look_composer_memo_key(CONTEXT, BLOCKS[1:], TEMPLATE) != key
+    # Editing the prompt starts a fresh memo
+    assert look_composer_memo_key(CONTEXT, BLOCKS, TEMPLATE + "\n") != key
+
+
+def test_only_answers_with_a_category_are_memoized(memo):
+    answer = fake_answer(LOOK_COMPOSER_PROMPT)
+    memoize_categories("k1", answer)
+    memoize_categories("k2", {"cat_1": None})
+    assert recall_categories("k1") == answer
+    assert recall_categories("k2") is None
+
+
+@pytest.mark.parametrize("run", [
+    lambda query: list(process_user_query_streaming(query)),
+    lambda query: list(iterate_async(aprocess_user_query_streaming(query))),
+], ids=["threaded", "async"])
+def test_a_repeated_signature_skips_the_look_composer(memo, fake_llm, run):
+    first = run("vestido leve para praia")[-1]
+    second = run("um vestido leve para a praia")[-1]
+    assert fake_llm[LOOK_COMPOSER_PROMPT] == 1
+    assert second["data"] == first["data"]
+    assert second["metrics"]["stages"][stage_name(LOOK_COMPOSER_PROMPT)]["cache_hits"] == 1
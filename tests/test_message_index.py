@@ -0,0 +1,47 @@
+from run_user_query import break_mensagem_ties, derive_mensagem, prompt_value_names
+from utils.message_index import MessageIndex
+
+LINE_AND_MATERIAL = ["line", "material"]
+
+
+def _index():
+    # Title 1 goes with line 1, title 2 with line 2; material 1 appears with both
+    rows = [(1, 1, 1), (1, 2, 1), (2, 1, 2), (2, 1, 2)]
+    return MessageIndex(LINE_AND_MATERIAL, rows, {1: "Afetivo", 2: "Alegre"})
+
+
+def test_rank_follows_the_analyzed_values():
+    ranked = _index().rank({"line": {1: 0.9}})
+    assert [title_id for title_id, _, _ in ranked] == [1, 2]
+    assert abs(sum(share for _, _, share in ranked) - 1.0) < 1e-9
+
+
+def test_unanalyzed_attributes_are_left_open():
+    # Without evidence the table's own row counts decide: two rows each
+    assert [share for _, _, share in _index().rank({})] == [0.5, 0.5]
+    ranked = _index().rank({"material": {1: 1.0}})
+    assert ranked[0][0] == 2
+
+
+def test_derived_mensagem_uses_the_prompt_names():
+    blocks = [{"attribute": "Material", "value_1_id": "3", "value_1_score": "9"},
+              {"attribute": "Cor", "value_1_id": "3", "value_1_score": "8"}]
+    block = derive_mensagem(blocks)
+    names = set(prompt_value_names("Mensagem").values())
+    assert block["attribute"] == "Mensagem"
+    assert all(block[f"value_{i}_name"] in names for i in range(1, 4))
+
+
+def test_tiebreak_only_reorders_equal_scores():
+    blocks = [{"attribute": "Material", "value_1_id": "3", "value_1_score": "9"}]
+    top = derive_mensagem(blocks)["value_1_id"]
+    other = 1 if top != 1 else 2
+    llm = {"attribute": "Mensagem",
+           "value_1_id": str(other), "value_1_name": "a", "value_1_score": "8", "value_1_justification": "",
+           "value_2_id": str(top), "value_2_name": "b", "value_2_score": "8", "value_2_justification": ""}
+    block, reordered = break_mensagem_ties(llm, blocks)
+    assert reordered and block["value_1_id"] == str(top)
+
+    llm["value_1_score"] = "9"
+    block, reordered = break_mensagem_ties(llm, blocks)
+    assert not reordered and block["value_1_id"] == str(other)
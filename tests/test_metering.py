@@ -0,0 +1,59 @@
+import concurrent.futures
+import threading
+
+from utils import llm_utils
+from utils.metering import bind_meter, current_meter, metering_scope
+
+MESSAGES = [{"role": "user", "content": "vestido para casamento na praia"}]
+
+
+def test_a_spent_budget_skips_the_call(monkeypatch):
+    def api(*args):
+        raise AssertionError("the budget should have stopped this call")
+
+    monkeypatch.setattr(llm_utils, "_call_with_retries", api)
+    with metering_scope(budget_tokens=100) as meter:
+        meter.add_usage("context_analyzer", "gpt-4o", 80, 20, 0.001)
+        assert meter.exceeded() == "token budget of 100 reached"
+        assert llm_utils.call_model(MESSAGES, "gpt-4o", stage="0_attribute_selection") is None
+    assert meter.blocked_calls == 1
+    assert current_meter() is None
+
+
+def test_cost_budget():
+    with metering_scope(budget_cost=0.01) as meter:
+        meter.add_usage("look_composer", "gpt-4o", 10, 10, 0.004)
+        assert meter.exceeded() is None
+        meter.add_usage("look_composer", "gpt-4o", 10, 10, 0.006)
+        assert "cost budget" in meter.exceeded()
+
+
+def test_concurrent_queries_report_into_their_own_meters():
+    barrier = threading.Barrier(2)
+    meters = {}
+
+    def query(name, tokens):
+        with metering_scope() as meter:
+            barrier.wait()  # both scopes are open at the same time
+            current_meter().add_usage("context_analyzer", "gpt-4o", tokens, 0, 0.0)
+            meters[name] = meter
+
+    threads = [threading.Thread(target=query, args=(name, tokens)) for name, tokens in (("a", 10), ("b", 20))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert meters["a"].totals()["input_tokens"] == 10
+    assert meters["b"].totals()["input_tokens"] == 20
+
+
+def test_pool_workers_report_into_the_bound_meter():
+    with metering_scope() as meter:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+            # A plain submit would run without the caller's context
+            assert pool.submit(current_meter).result() is None
+            work = bind_meter(meter, lambda stage: current_meter().add_call(stage, 0.5))
+            list(pool.map(work, ["1_att_mensagem", "7_att_cor"]))
+    summary = meter.summary()
+    assert summary["calls"] == 2
+    assert set(summary["stages"]) == {"1_att_mensagem", "7_att_cor"}
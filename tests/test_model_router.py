@@ -0,0 +1,36 @@
+from utils import model_router
+from utils.model_router import record_outcome, route
+
+
+def _router(monkeypatch, candidates):
+    monkeypatch.setattr(model_router, "MODEL_ROUTER", True)
+    monkeypatch.setattr(model_router, "MODEL_ROUTING", {})
+    monkeypatch.setattr(model_router, "ROUTER_CANDIDATES", {"default": candidates})
+    monkeypatch.setattr(model_router, "ROUTER_MIN_SAMPLES", 2)
+    monkeypatch.setattr(model_router, "ROUTER_EXPLORE_RATE", 0.0)
+    monkeypatch.setattr(model_router, "_seeded", True)
+    monkeypatch.setattr(model_router, "_samples", model_router.defaultdict(lambda: model_router.deque(maxlen=10)))
+
+
+def test_a_cold_start_default_is_not_sticky(monkeypatch):
+    _router(monkeypatch, ["gpt-4o-mini"])
+    routes = {}
+    assert route("0_attribute_selection", routes, default="gpt-4o") == "gpt-4o"
+    assert routes == {}
+
+    for _ in range(2):
+        record_outcome("0_attribute_selection", "gpt-4o-mini", 0.5, ok=True, valid=True)
+    assert route("0_attribute_selection", routes, default="gpt-4o") == "gpt-4o-mini"
+    assert routes == {"0_attribute_selection": "gpt-4o-mini"}
+
+
+def test_a_measured_pick_stays_for_the_session(monkeypatch):
+    _router(monkeypatch, ["gpt-4o-mini"])
+    for model, latency in (("gpt-4o", 2.0), ("gpt-4o-mini", 0.5)):
+        for _ in range(2):
+            record_outcome("7_att_cor", model, latency, ok=True, valid=True)
+    routes = {}
+    assert route("7_att_cor", routes, default="gpt-4o") == "gpt-4o-mini"
+    for _ in range(5):
+        record_outcome("7_att_cor", "gpt-4o", 0.1, ok=True, valid=True)
+    assert route("7_att_cor", routes, default="gpt-4o") == "gpt-4o-mini"
@@ -0,0 +1,95 @@
+import json
+
+import pytest
+
+from utils import execute_prompt
+from utils.execute_prompt import parse_structured
+from utils.prompt_schemas import (
+    SCHEMAS, adapt_response_format, parse_stats, parse_strict, register_batch_schema, response_format_for,
+    split_context_selection,
+)
+from utils.util_functions import load_prompt
+
+CONTEXT = {"occasion": {"formality": "INFORMAL", "time": "DIA", "location": "PRAIA", "activity": "LAZER"},
+           "weather": {"climate": "Hot"}}
+
+
+def _estrutura(**overrides):
+    block = {"attribute": "Estrutura"}
+    for i in (1, 2):
+        block.update({f"value_{i}_id": i, f"value_{i}_name": "Leve | Fluido", f"value_{i}_score": 9 - i,
+                      f"value_{i}_justification": "..."})
+    block.update(overrides)
+    return block
+
+
+def test_a_fenced_answer_parses_and_numeric_strings_become_integers():
+    content = "```json\n" + json.dumps(_estrutura(value_1_score="8")) + "\n```"
+    data = parse_strict(content, SCHEMAS["4_att_estrutura"])
+    assert data["value_1_score"] == 8
+
+
+@pytest.mark.parametrize("answer, problem", [
+    (_estrutura(value_2_score="alto"), "value_2_score"),
+    ({k: v for k, v in _estrutura().items() if k != "value_2_name"}, "value_2_name: missing"),
+    ({**CONTEXT, "weather": {"climate": "Chuvoso"}}, "not in enum"),
+])
+def test_schema_violations_are_refused(answer, problem):
+    schema = SCHEMAS["context_analyzer"] if "occasion" in answer else SCHEMAS["4_att_estrutura"]
+    with pytest.raises(ValueError, match=problem):
+        parse_strict(json.dumps(answer), schema)
+
+
+def test_invalid_json_raises_value_error():
+    with pytest.raises(ValueError):
+        parse_strict('{"attribute": "Estrutura",}', SCHEMAS["4_att_estrutura"])
+
+
+def test_lenient_fallback_only_after_a_strict_failure():
+    before = parse_stats()
+    assert parse_structured(json.dumps(CONTEXT), "context_analyzer") == CONTEXT
+    # Prose around the JSON fails the strict parse; the lenient parser still finds the object
+    wrapped = "Aqui está:\n" + json.dumps(CONTEXT)
+    assert parse_structured(wrapped, "context_analyzer") == CONTEXT
+    after = parse_stats()
+    assert after["strict"] == before["strict"] + 1
+    assert after["fallback"] == before["fallback"] + 1
+
+
+def test_batch_schema_nests_each_analyzer():
+    schema = register_batch_schema("att_batch_test", {"Estrutura": "4_att_estrutura"})
+    assert schema["properties"]["Estrutura"] is SCHEMAS["4_att_estrutura"]
+    assert parse_strict(json.dumps({"Estrutura": _estrutura()}), schema)["Estrutura"]["value_1_id"] == 1
+
+
+def test_response_format_is_downgraded_per_provider():
+    response_format = response_format_for("look_composer")
+    assert response_format["json_schema"]["strict"] is True
+    assert adapt_response_format(response_format, "openai") is response_format
+    assert adapt_response_format(response_format, "deepseek") == {"type": "json_object"}
+    assert adapt_response_format(response_format, "together") is None
+
+
+def test_fused_answer_splits_into_context_and_selection():
+    context, selection = split_context_selection({**CONTEXT, "att_1": "Cor"})
+    assert context == CONTEXT and selection == {"att_1": "Cor"}
+    assert split_context_selection(None) == ({}, {})
+
+
+@pytest.mark.parametrize("stage", [stage for stage in SCHEMAS if "_att_" in stage])
+def test_analyzer_prompts_ask_for_as_many_values_as_their_schema(stage):
+    prompt = load_prompt(f"./prompts/prompt_{stage}.txt")
+    count = sum(1 for key in SCHEMAS[stage]["properties"] if key.endswith("_id"))
+    assert f"top {count} most relevant" in prompt
+    assert f'"value_{count}_id"' in prompt and f'"value_{count + 1}_id"' not in prompt
+
+
+def test_streamed_fields_are_coerced_by_the_schema(monkeypatch):
+    answer = json.dumps(_estrutura(value_1_score="8", value_2_id="2"))
+    monkeypatch.setattr(execute_prompt, "stream_model",
+                        lambda *args, **kwargs: iter([answer[i:i + 7] for i in range(0, len(answer), 7)]))
+    before = parse_stats()
+    fields = dict(execute_prompt.execute_prompt_streaming({}, prompt_template="Query", api_model="gpt-4o",
+                                                          stage="4_att_estrutura"))
+    assert fields["value_1_score"] == 8 and fields["value_2_id"] == 2
+    assert parse_stats()["strict"] == before["strict"] + 1
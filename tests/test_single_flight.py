@@ -0,0 +1,103 @@
+import asyncio
+import threading
+
+import pytest
+
+from utils import single_flight
+from utils.single_flight import acoalesce, coalesce, join_flight
+
+
+def _leader_running(key, result, release):
+    """Starts a leader call for `key` that returns `result` once `release` is set."""
+    started = threading.Event()
+
+    def leader():
+        started.set()
+        release.wait(5)
+        return result
+
+    thread = threading.Thread(target=coalesce, args=(key, leader))
+    thread.start()
+    started.wait(5)
+    return thread
+
+
+def test_followers_share_the_leaders_answer():
+    release = threading.Event()
+    thread = _leader_running("shared", "answer", release)
+    answers = []
+    follower = threading.Thread(target=lambda: answers.append(coalesce("shared", lambda: "own")))
+    follower.start()
+    release.set()
+    thread.join()
+    follower.join()
+    assert answers == [("answer", True)]
+
+
+def test_a_failed_leader_lets_followers_call_themselves():
+    # _call_chain reports failure as None, not as an exception
+    release = threading.Event()
+    thread = _leader_running("failing", None, release)
+    answers = []
+    follower = threading.Thread(target=lambda: answers.append(coalesce("failing", lambda: "own")))
+    follower.start()
+    release.set()
+    thread.join()
+    follower.join()
+    assert answers == [("own", False)]
+
+
+def test_async_followers_call_themselves_after_a_failed_leader():
+    async def run():
+        release = asyncio.Event()
+
+        async def leader():
+            await release.wait()
+            return None
+
+        async def own():
+            return "own"
+
+        lead = asyncio.ensure_future(acoalesce("async-failing", leader))
+        await asyncio.sleep(0)
+        follow = asyncio.ensure_future(acoalesce("async-failing", own))
+        await asyncio.sleep(0)
+        release.set()
+        return await lead, await follow
+
+    assert asyncio.run(run()) == ((None, False), ("own", False))
+
+
+def test_every_subscriber_sees_the_pipeline_error():
+    def pipeline():
+        yield {"status": "progress"}
+        raise RuntimeError("upstream down")
+
+    first = join_flight("broken", pipeline)
+    second = join_flight("broken", lambda: iter(()))
+    assert next(first) == {"status": "progress"}
+    assert next(second) == {"status": "progress"}
+    with pytest.raises(RuntimeError):
+        next(first)
+    with pytest.raises(RuntimeError):
+        next(second)
+    assert "broken" not in single_flight._flights
+
+
+def test_a_query_after_the_last_subscriber_left_starts_a_new_run():
+    closed = []
+
+    def pipeline(name):
+        try:
+            yield name
+            yield name
+        finally:
+            closed.append(name)
+
+    first = join_flight("left", lambda: pipeline("first"))
+    assert next(first) == "first"
+    first.close()
+    # The abandoned run is out of the table as soon as its last subscriber is gone
+    assert "left" not in single_flight._flights
+    assert closed == ["first"]
+    assert next(join_flight("left", lambda: pipeline("second"))) == "second"
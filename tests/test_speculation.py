@@ -0,0 +1,70 @@
+import time
+
+import pytest
+
+import run_user_query
+from conftest import FAKE_USAGE, SELECTED
+from run_user_query import (
+    ANALYZER_ATTRIBUTES, ATTRIBUTE_SELECTION_PROMPT, PROMPT_MAPPING, _Speculation, aprocess_user_query_streaming,
+    process_user_query_streaming,
+)
+from utils.async_runtime import iterate_async
+from utils.execute_prompt import stage_name
+from utils.metering import Meter
+
+
+@pytest.fixture
+def speculating(monkeypatch, fake_llm):
+    """Speculation on, with step 2 slow enough that every speculative analyzer has run by the time it answers."""
+    monkeypatch.setattr(run_user_query, "SPECULATIVE_ATTRIBUTES", True)
+    execute, aexecute = run_user_query.execute_prompt, run_user_query.aexecute_prompt
+
+    def slow_selection(row, prompt_template=None, prompt_template_path=None, *args, **kwargs):
+        if prompt_template_path == ATTRIBUTE_SELECTION_PROMPT:
+            time.sleep(0.2)
+        return execute(row, prompt_template, prompt_template_path, *args, **kwargs)
+
+    async def aslow_selection(row, prompt_template=None, prompt_template_path=None, *args, **kwargs):
+        if prompt_template_path == ATTRIBUTE_SELECTION_PROMPT:
+            time.sleep(0.2)
+        return await aexecute(row, prompt_template, prompt_template_path, *args, **kwargs)
+
+    monkeypatch.setattr(run_user_query, "execute_prompt", slow_selection)
+    monkeypatch.setattr(run_user_query, "aexecute_prompt", aslow_selection)
+    return fake_llm
+
+
+@pytest.mark.parametrize("run", [
+    lambda query: list(process_user_query_streaming(query)),
+    lambda query: list(iterate_async(aprocess_user_query_streaming(query))),
+], ids=["threaded", "async"])
+def test_selected_analyzers_are_reused_and_the_rest_billed_as_waste(speculating, run):
+    final = run("vestido leve para praia")[-1]
+    assert final["status"] == "final_result"
+    # Hits: the speculative answers of the selected attributes are used, not asked for again
+    assert all(speculating[PROMPT_MAPPING[attr]] == 1 for attr in ANALYZER_ATTRIBUTES)
+    report = final["speculation"]
+    discarded = [attr for attr in ANALYZER_ATTRIBUTES if attr not in SELECTED]
+    assert report["launched"] == len(ANALYZER_ATTRIBUTES)
+    assert report["used"] == len(SELECTED)
+    # Misses: what the unselected analyzers were billed
+    assert report["discarded"] == discarded
+    assert report["wasted_tokens"] == sum(FAKE_USAGE) * len(discarded)
+    assert report["wasted_cost"] == pytest.approx(0.001 * len(discarded))
+
+
+def test_latency_saved_is_measured_from_the_end_of_step_2():
+    speculation = _Speculation()
+    speculation.selected = ["Cor", "Material"]
+    speculation.spans = {"Cor": (0.0, 1.0), "Material": (0.2, 0.6), "Mensagem": (0.0, 3.0)}
+    speculation.analysis_started = 0.8
+    meter = Meter()
+    meter.add_usage(stage_name(PROMPT_MAPPING["Mensagem"]), "gpt-4o", 300, 50, 0.002)
+    report = speculation.report(meter)
+    # Started after step 2, the longest selected run (Cor, 1 s) would have ended at 1.8 s rather than 1.0 s
+    assert report["latency_saved_s"] == pytest.approx(0.8)
+    assert report["wasted_tokens"] == 350 and report["wasted_cost"] == pytest.approx(0.002)
+
+
+def test_no_report_without_speculation(fake_llm):
+    assert "speculation" not in list(process_user_query_streaming("vestido leve para praia"))[-1]
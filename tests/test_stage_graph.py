@@ -0,0 +1,79 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from utils.stage_graph import StageGraph, StopPipeline
+
+
+def _graph(order):
+    def stage(name, seconds=0.0):
+        def run(results, emit):
+            time.sleep(seconds)
+            order.append(name)
+            emit({"stage": name})
+            return name
+        return run
+
+    return (StageGraph()
+            .add("context", stage("context", 0.05))
+            .add("prompts", stage("prompts"))
+            .add("selection", stage("selection"), deps=("context", "prompts")))
+
+
+def test_stages_wait_for_their_dependencies():
+    order = []
+    graph = _graph(order)
+    events = list(graph.run())
+    assert order.index("selection") > order.index("context")
+    assert [event["stage"] for event in events] == order
+    assert graph.results["selection"] == "selection"
+    assert graph.critical_path() == ["context", "selection"]
+    assert [row["stage"] for row in graph.timeline()][-1] == "selection"
+
+
+def test_a_stop_ends_the_run_before_dependent_stages():
+    ran = threading.Event()
+
+    def stop(results, emit):
+        raise StopPipeline({"status": "final_message", "message": "nada"})
+
+    graph = StageGraph().add("context", stop).add("selection", lambda results, emit: ran.set(), deps=("context",))
+    assert list(graph.run()) == []
+    assert graph.stop_event == {"status": "final_message", "message": "nada"}
+    assert not ran.is_set()
+
+
+def test_a_failing_stage_becomes_an_error_event():
+    def boom(results, emit):
+        raise ValueError("no catalog")
+
+    graph = StageGraph().add("attribute_ids", boom)
+    list(graph.run())
+    assert graph.stop_event["status"] == "error"
+    assert "no catalog" in graph.stop_event["message"]
+
+
+def test_unknown_dependencies_are_rejected():
+    with pytest.raises(ValueError):
+        StageGraph().add("selection", lambda results, emit: None, deps=("context",))
+
+
+def test_the_async_run_mixes_coroutine_and_thread_stages():
+    async def context(results, emit):
+        await asyncio.sleep(0.01)
+        emit({"stage": "context"})
+        return {"occasion": {}}
+
+    def selection(results, emit):
+        return list(results["context"])
+
+    async def run():
+        graph = StageGraph().add("context", context).add("selection", selection, deps=("context",))
+        events = [event async for event in graph.arun()]
+        return graph, events
+
+    graph, events = asyncio.run(run())
+    assert events == [{"stage": "context"}]
+    assert graph.results["selection"] == ["occasion"]
@@ -0,0 +1,79 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from llm import stand_in_server
+from llm.stand_in_server import Profile, parse_args
+from utils.prompt_schemas import SCHEMAS, parse_strict
+from utils.util_functions import load_prompt
+
+QUERY = "vestido vermelho para casamento na praia"
+
+
+@pytest.fixture
+def serve(monkeypatch):
+    servers = []
+
+    def start(*flags):
+        monkeypatch.setattr(stand_in_server.Handler, "profile",
+                            Profile(parse_args(["--latency", "fixed", "--median-ms", "0", *flags])))
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), stand_in_server.Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        servers.append(httpd)
+        return f"http://127.0.0.1:{httpd.server_address[1]}/v1"
+
+    yield start
+    for httpd in servers:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def _post(url, prompt_path, **body):
+    prompt = load_prompt(prompt_path).format(user_query=QUERY, fashion_attributes="Cor: Vermelho")
+    data = json.dumps({"model": "stand-in", "messages": [{"role": "user", "content": prompt}], **body}).encode()
+    request = urllib.request.Request(f"{url}/chat/completions", data, {"Content-Type": "application/json"})
+    return urllib.request.urlopen(request, timeout=5)
+
+
+@pytest.mark.parametrize("prompt_path, stage", [
+    ("./prompts/prompt_context_analyzer.txt", "context_analyzer"),
+    ("./prompts/prompt_0_attribute_selection.txt", "0_attribute_selection"),
+    ("./prompts/prompt_7_att_cor.txt", "7_att_cor"),
+    ("./prompts/prompt_look_composer.txt", "look_composer"),
+])
+def test_every_pipeline_prompt_gets_an_answer_that_passes_its_schema(serve, prompt_path, stage):
+    with _post(serve(), prompt_path) as response:
+        body = json.loads(response.read())
+    parse_strict(body["choices"][0]["message"]["content"], SCHEMAS[stage])
+    assert body["usage"]["total_tokens"] > 0
+
+
+def test_analyzer_values_come_from_the_prompt(serve):
+    with _post(serve(), "./prompts/prompt_7_att_cor.txt") as response:
+        answer = json.loads(json.loads(response.read())["choices"][0]["message"]["content"])
+    prompt = load_prompt("./prompts/prompt_7_att_cor.txt")
+    assert answer["attribute"] == "Cor"
+    for i in (1, 2, 3):
+        assert f"{answer[f'value_{i}_id']} – {answer[f'value_{i}_name']}" in prompt
+
+
+def test_a_streamed_answer_reassembles_with_usage_last(serve):
+    with _post(serve(), "./prompts/prompt_context_analyzer.txt", stream=True,
+               stream_options={"include_usage": True}) as response:
+        events = [line[len(b"data: "):] for line in response.read().splitlines() if line.startswith(b"data: ")]
+    assert events[-1] == b"[DONE]"
+    chunks = [json.loads(event) for event in events[:-1]]
+    content = "".join(chunk["choices"][0]["delta"].get("content", "") for chunk in chunks if chunk["choices"])
+    parse_strict(content, SCHEMAS["context_analyzer"])
+    assert chunks[-1]["usage"]["completion_tokens"] > 0
+
+
+def test_injected_rate_limits_carry_retry_after(serve):
+    with pytest.raises(urllib.error.HTTPError) as error:
+        _post(serve("--rate-limit", "1", "--retry-after", "2"), "./prompts/prompt_context_analyzer.txt")
+    assert error.value.code == 429
+    assert error.value.headers["Retry-After"] == "2.0"
@@ -0,0 +1,137 @@
+# admission.py
+# Admission control for whole queries, shared by every Streamlit session.
+# At most MAX_CONCURRENT_QUERIES queries run at once; the others wait in a
+# FIFO queue and can report their position while they wait. Queue depth and
+# wait times are kept as process counters for the dev sidebar.
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from config.config import MAX_CONCURRENT_QUERIES
+
+# Waits kept for the percentile in admission_stats()
+WAIT_WINDOW = 200
+
+
+class Ticket:
+    """A query's place in the admission queue; release() it when the query ends (admitted or not)."""
+
+    def __init__(self, admission: "Admission"):
+        self._admission = admission
+        self._admitted = threading.Event()
+        self._notify = None
+        self._enqueued = time.perf_counter()
+        self.waited_s = 0.0
+
+    def _admit(self) -> None:
+        self.waited_s = time.perf_counter() - self._enqueued
+        self._admitted.set()
+        if self._notify is not None:
+            self._notify()
+
+    @property
+    def admitted(self) -> bool:
+        return self._admitted.is_set()
+
+    def position(self) -> int:
+        """1-based place in the queue (0 once admitted)."""
+        return self._admission.position(self)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until admitted or `timeout` passes; True when admitted."""
+        return self._admitted.wait(timeout)
+
+    async def await_admission(self, timeout: Optional[float] = None) -> bool:
+        """asyncio wait(): does not hold a thread while queued."""
+        if self.admitted:
+            return True
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        self._notify = lambda: loop.call_soon_threadsafe(event.set)
+        if self.admitted:  # admitted before the callback was in place
+            return True
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.admitted
+
+    def release(self) -> None:
+        self._admission.release(self)
+
+
+class Admission:
+    def __init__(self, limit: int):
+        self.limit = limit or None
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._running = set()
+        self._waits = deque(maxlen=WAIT_WINDOW)
+        self._stats = {"admitted": 0, "queued_total": 0, "max_queue_depth": 0}
+
+    def enqueue(self) -> Ticket:
+        ticket = Ticket(self)
+        with self._lock:
+            self._queue.append(ticket)
+            self._promote()
+            if not ticket.admitted:
+                self._stats["queued_total"] += 1
+                self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], len(self._queue))
+        return ticket
+
+    def _promote(self) -> None:
+        # Caller holds the lock
+        while self._queue and (self.limit is None or len(self._running) < self.limit):
+            ticket = self._queue.popleft()
+            self._running.add(ticket)
+            self._stats["admitted"] += 1
+            ticket._admit()
+            self._waits.append(ticket.waited_s)
+
+    def position(self, ticket: Ticket) -> int:
+        with self._lock:
+            try:
+                return self._queue.index(ticket) + 1
+            except ValueError:
+                return 0
+
+    def release(self, ticket: Ticket) -> None:
+        with self._lock:
+            if ticket in self._running:
+                self._running.discard(ticket)
+            elif ticket in self._queue:
+                self._queue.remove(ticket)  # gave up while queued
+            self._promote()
+
+    def stats(self) -> dict:
+        with self._lock:
+            waits = sorted(self._waits)
+            return {
+                "limit": self.limit or 0,
+                "running": len(self._running),
+                "queue_depth": len(self._queue),
+                **self._stats,
+                "wait_s_avg": round(sum(waits) / len(waits), 3) if waits else 0.0,
+                "wait_s_p95": round(waits[min(int(0.95 * len(waits)), len(waits) - 1)], 3) if waits else 0.0,
+                "wait_s_max": round(waits[-1], 3) if waits else 0.0,
+            }
+
+
+_lock = threading.Lock()
+_admission: Optional[Admission] = None
+
+
+def get_admission() -> Admission:
+    global _admission
+    if _admission is not None:
+        return _admission
+    with _lock:
+        if _admission is None:
+            _admission = Admission(MAX_CONCURRENT_QUERIES)
+    return _admission
+
+
+def admission_stats() -> dict:
+    return get_admission().stats()
@@ -0,0 +1,52 @@
+# async_runtime.py
+# One background event loop per process for the asyncio pipeline.
+# Sync callers (Streamlit script threads) drive coroutines and async generators
+# on it, so every concurrent query shares that loop and its async connection
+# pools instead of holding a worker thread per in-flight LLM call. Blocking
+# stages (asyncio.to_thread) run on the shared "stages" pool.
+import asyncio
+import threading
+from typing import AsyncIterator, Iterator, Optional
+
+from utils.executors import get_executor
+
+_lock = threading.Lock()
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """The shared loop, started on a daemon thread on first use."""
+    global _loop
+    if _loop is not None:
+        return _loop
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            loop.set_default_executor(get_executor("stages"))
+            threading.Thread(target=loop.run_forever, name="async-pipeline", daemon=True).start()
+            _loop = loop
+    return _loop
+
+
+def run_sync(coro, timeout: Optional[float] = None):
+    """Run a coroutine on the shared loop and block the calling thread for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result(timeout)
+
+
+def iterate_async(agen: AsyncIterator) -> Iterator:
+    """
+    Sync generator over an async generator running on the shared loop:
+        for event in iterate_async(aprocess_user_query_streaming(query)):
+            ...
+    Closing the sync generator early also closes the async one.
+    """
+    loop = get_loop()
+    try:
+        while True:
+            try:
+                item = asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result()
@@ -0,0 +1,58 @@
+# deadline.py
+# End-to-end deadline for one query.
+# A Deadline is created with the query and handed to every stage. Stages with
+# a usable partial answer wait for their LLM calls only until their share of
+# the budget is spent, then go on with what has arrived (the empty context,
+# default attributes, dropping straggling attribute analyses, or default
+# categories) and record the degradation. Degradations land in the query's
+# Meter and in process counters.
+import threading
+import time
+from typing import Optional
+
+from utils.metering import Meter
+
+_lock = threading.Lock()
+_stats = {"queries": 0, "degraded_queries": 0, "attributes_dropped": 0, "context_fallbacks": 0,
+          "selection_fallbacks": 0, "category_fallbacks": 0}
+# Stages whose degradation is a fallback answer rather than dropped attributes
+_FALLBACKS = {"context": "context_fallbacks", "selection": "selection_fallbacks", "categories": "category_fallbacks"}
+
+
+class Deadline:
+    def __init__(self, seconds: float, meter: Optional[Meter] = None):
+        self.seconds = seconds or None
+        self.meter = meter
+        self._started = time.perf_counter()
+        self._degraded = False
+        with _lock:
+            _stats["queries"] += 1
+
+    def remaining(self, share: float = 1.0) -> Optional[float]:
+        """Seconds left until `share` of the budget is spent (never negative), or None without a deadline."""
+        if self.seconds is None:
+            return None
+        return max(self._started + self.seconds * share - time.perf_counter(), 0.0)
+
+    def degrade(self, stage: str, reason: str, dropped=()) -> None:
+        """Record that `stage` went on without part of its answer (`dropped` names what was left out)."""
+        dropped = list(dropped)
+        if self.meter is not None:
+            self.meter.degrade(stage, reason, dropped)
+        with _lock:
+            if not self._degraded:
+                _stats["degraded_queries"] += 1
+            self._degraded = True
+            if stage in _FALLBACKS:
+                _stats[_FALLBACKS[stage]] += 1
+            else:
+                _stats["attributes_dropped"] += len(dropped)
+
+    @property
+    def degraded(self) -> bool:
+        return self._degraded
+
+
+def deadline_stats() -> dict:
+    with _lock:
+        return dict(_stats)
@@ -1,12 +1,18 @@
 # execute_prompt.py
 import ast
+import asyncio
 import json
 import re
 import string
 import time
+from pathlib import Path
 
+from config.config import LLM_STRUCTURED_OUTPUT
 from utils.database_utils import connect_to_db, join
-from utils.llm_utils import call_model
+from utils.json_stream import IncrementalJSONParser
+from utils.llm_utils import call_model, acall_model, reused_from, served_by, stream_model
+from utils.model_router import route, record_outcome
+from utils.prompt_schemas import get_schema, response_format_for, parse_strict, conform, conform_member, record_parse
 from utils.util_functions import load_prompt
 
 
@@ -24,10 +30,48 @@ TABLE_ID = 'mutua_id'
 start_time = time.perf_counter()
 
 
-def parse_api_response(response, row_index):
+def parse_api_response(response, row_index, stage=None):
     try:
         content = response.choices[0].message.content
+    except AttributeError as e:
+        if "object has no attribute 'message'" in str(e):
+            raise ValueError("The API response does not contain the expected 'message' attribute.")
+        else:
+            raise e
+    return parse_structured(content, stage, row_index)
+
+
+def parse_structured(content, stage=None, row_index=0):
+    """
+    Parse a stage's answer with its JSON schema (utils/prompt_schemas.py): a
+    single json.loads plus validation. The lenient parser below only runs when
+    that fails, or for prompts without a schema.
+    """
+    schema = get_schema(stage)
+    if schema is None:
+        return parse_response_content(content, row_index)
+
+    started = time.perf_counter()
+    try:
+        response_data = parse_strict(content, schema)
+        record_parse("strict", time.perf_counter() - started)
+        return response_data
+    except ValueError as e:
+        print(f"Strict parse failed for stage '{stage}' (row {row_index + 1}): {e}. Falling back to lenient parser.")
+
+    response_data = parse_response_content(content, row_index)
+    if not isinstance(response_data, dict):
+        # A schema'd stage never answers CSV; anything but an object is unusable downstream
+        record_parse("failed", time.perf_counter() - started)
+        return None
+    conform(response_data, schema)
+    record_parse("fallback", time.perf_counter() - started)
+    return response_data
+
 
+def parse_response_content(content, row_index=0):
+    """Lenient parse of a model's text output into a dict (or raw CSV text)."""
+    try:
         # Detect CSV format: check if the first line contains at least one ";" or ","
         first_line = content.split("\n")[0]
         if ";" in first_line or "," in first_line or "csv" in first_line:
@@ -61,11 +105,6 @@ def parse_api_response(response, row_index):
         print(f"Error parsing API response for row {row_index + 1}: {e}")
         print(f"Response content: {content}")
         return None
-    except AttributeError as e:
-        if "object has no attribute 'message'" in str(e):
-            raise ValueError("The API response does not contain the expected 'message' attribute.")
-        else:
-            raise e
     except Exception as e:
         print(f"Error parsing API response for row {row_index + 1}: {e}")
         return None
@@ -102,31 +141,132 @@ def prepare_prompt(row, prompt_template):
     return prompt.format(**row)
 
 
-def execute_prompt(row, prompt_template=None, prompt_template_path=None, api_model=MODEL, row_index=0):
+def stage_name(prompt_template_path):
+    """Pipeline stage label for a prompt file, e.g. 'prompt_7_att_cor.txt' -> '7_att_cor'."""
+    if not prompt_template_path:
+        return None
+    return Path(prompt_template_path).stem.removeprefix("prompt_")
+
+
+def _first_field_index(template):
+    """Offset of the first {placeholder} in a str.format template (escaped {{ }} skipped), or -1."""
+    i = 0
+    while i < len(template):
+        char = template[i]
+        if char in "{}" and template[i + 1:i + 2] == char:
+            i += 2
+            continue
+        if char == "{":
+            return i
+        i += 1
+    return -1
+
+
+def split_template(prompt_template):
+    """
+    Split a template into a static prefix (every paragraph before the one
+    holding the first placeholder, braces unescaped) and the dynamic suffix
+    template, so labels like "User Query:" stay next to their value.
+    The prefix is byte-identical across queries, so providers' automatic
+    prompt caching can reuse it; the prompt files keep the query paragraph
+    last so everything else (output format included) is in the prefix.
+    Providers only cache past a minimum length (OpenAI: 1024 tokens), which
+    the shorter prompts do not reach; DeepSeek has no such floor.
+    """
+    field = _first_field_index(prompt_template)
+    if field < 0:
+        return "", prompt_template
+    paragraph = prompt_template.rfind("\n\n", 0, field)
+    cut = paragraph + 2 if paragraph >= 0 else prompt_template.rfind("\n", 0, field) + 1
+    static = prompt_template[:cut]
+    return static.replace("{{", "{").replace("}}", "}").rstrip(), prompt_template[cut:]
+
+
+def build_messages(row, prompt_template=None, prompt_template_path=None, row_index=0):
+    """
+    System message, then the template's static prefix, then its formatted
+    dynamic suffix as a separate message; the first two form a stable
+    cacheable prefix per prompt.
+    """
+    if prompt_template is None:
+        prompt_template = load_prompt(prompt_template_path)
+
+    static_prefix, dynamic_template = split_template(prompt_template)
+    prompt = prepare_prompt(row, dynamic_template)
+    print("INPUT", {"row_index": row_index + 1, "prompt": f"{static_prefix}\n\n{prompt}" if static_prefix else prompt})
+
+    messages = [{"role": "system", "content": "You are a fashion expert with knowledge in AI and semiotics."}]
+    if static_prefix:
+        messages.append({"role": "user", "content": static_prefix})
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+def execute_prompt(row, prompt_template=None, prompt_template_path=None, api_model=None, row_index=0, stage=None,
+                   session_routes=None):
+    """
+    Run one prompt and parse its JSON answer. Without api_model the stage is
+    routed by utils/model_router.py (MODEL unless routing is configured);
+    session_routes makes that choice sticky for a UI session.
+    """
+    if stage is None:
+        stage = stage_name(prompt_template_path)
     if not api_model:
-        api_model = MODEL
+        api_model = route(stage, session_routes, default=MODEL)
 
     try:
         if prompt_template is None and prompt_template_path is None:
             raise ValueError("Either prompt_template or prompt_template_path must be provided.")
 
-        if prompt_template is None:
-            prompt_template = load_prompt(prompt_template_path)
+        messages = build_messages(row, prompt_template, prompt_template_path, row_index)
+        response_format = response_format_for(stage) if LLM_STRUCTURED_OUTPUT else None
+        started = time.perf_counter()
+        response = call_model(messages, api_model, response_format=response_format, stage=stage)
+        # Check if the response is valid before parsing
+        if response is None:
+            record_outcome(stage, api_model, time.perf_counter() - started, ok=False, valid=False)
+            print(f"Failed to get a response from the model for row {row_index + 1}. Skipping.")
+            return None
+
+        response_data = parse_api_response(response, row_index, stage)
+        if not reused_from(response):
+            record_outcome(stage, served_by(response, api_model), time.perf_counter() - started, ok=True,
+                           valid=isinstance(response_data, dict))
+        print("OUTPUT:")
+        print(response_data)
 
-        prompt = prepare_prompt(row, prompt_template)
-        print("INPUT", {"row_index": row_index + 1, "prompt": prompt})
+        return response_data
+    except Exception as e:
+        print(f"Error executing prompt for row {row_index + 1}", e)
+        return None
 
-        messages = [
-            {"role": "system", "content": "You are a fashion expert with knowledge in AI and semiotics."},
-            {"role": "user", "content": prompt}
-        ]
-        response = call_model(messages, api_model)
-        # Check if the response is valid before parsing
+
+async def aexecute_prompt(row, prompt_template=None, prompt_template_path=None, api_model=None, row_index=0,
+                          stage=None, session_routes=None):
+    """asyncio counterpart of execute_prompt (same routing, parsing and None-on-failure contract)."""
+    if stage is None:
+        stage = stage_name(prompt_template_path)
+    if not api_model:
+        api_model = route(stage, session_routes, default=MODEL)
+
+    try:
+        if prompt_template is None and prompt_template_path is None:
+            raise ValueError("Either prompt_template or prompt_template_path must be provided.")
+
+        # Prompt loading and table lookups touch disk/SQLite: keep them off the event loop
+        messages = await asyncio.to_thread(build_messages, row, prompt_template, prompt_template_path, row_index)
+        response_format = response_format_for(stage) if LLM_STRUCTURED_OUTPUT else None
+        started = time.perf_counter()
+        response = await acall_model(messages, api_model, response_format=response_format, stage=stage)
         if response is None:
+            record_outcome(stage, api_model, time.perf_counter() - started, ok=False, valid=False)
             print(f"Failed to get a response from the model for row {row_index + 1}. Skipping.")
             return None
 
-        response_data = parse_api_response(response, row_index)
+        response_data = parse_api_response(response, row_index, stage)
+        if not reused_from(response):
+            record_outcome(stage, served_by(response, api_model), time.perf_counter() - started, ok=True,
+                           valid=isinstance(response_data, dict))
         print("OUTPUT:")
         print(response_data)
 
@@ -136,6 +276,64 @@ def execute_prompt(row, prompt_template=None, prompt_template_path=None, api_mod
         return None
 
 
+def execute_prompt_streaming(row, prompt_template=None, prompt_template_path=None, api_model=None, row_index=0,
+                             stage=None, session_routes=None):
+    """
+    Streaming variant of execute_prompt: yields (key, value) for each top-level
+    field of the JSON answer as soon as that field is complete, coerced by the
+    stage's schema like parse_structured does. If the stream cannot be parsed
+    incrementally, the full text goes through the regular lenient parser and
+    any fields not yet yielded are yielded at the end.
+    """
+    if stage is None:
+        stage = stage_name(prompt_template_path)
+    if not api_model:
+        api_model = route(stage, session_routes, default=MODEL)
+    if prompt_template is None and prompt_template_path is None:
+        raise ValueError("Either prompt_template or prompt_template_path must be provided.")
+
+    messages = build_messages(row, prompt_template, prompt_template_path, row_index)
+    response_format = response_format_for(stage) if LLM_STRUCTURED_OUTPUT else None
+    schema = get_schema(stage)
+    parser = IncrementalJSONParser()
+    pieces = []
+    served = {}
+    started = time.perf_counter()
+    try:
+        for delta in stream_model(messages, api_model, response_format=response_format, stage=stage, sink=served):
+            pieces.append(delta)
+            for key, value in parser.feed(delta):
+                yield key, conform_member(key, value, schema)
+    except Exception as e:
+        print(f"Error streaming prompt for row {row_index + 1}", e)
+
+    model = served.get("model", api_model)  # the fallback's, if one answered
+    upstream = not served.get("reused_from")  # cache/cassette answers say nothing about the model
+    if parser.done and schema is not None:
+        _record_streamed_parse(parser.result, schema, stage, row_index)
+    if parser.done or not pieces:
+        if upstream:
+            record_outcome(stage, model, time.perf_counter() - started, ok=bool(pieces), valid=parser.done)
+        return
+    response_data = parse_structured("".join(pieces), stage, row_index)
+    if upstream:
+        record_outcome(stage, model, time.perf_counter() - started, ok=True, valid=isinstance(response_data, dict))
+    if isinstance(response_data, dict):
+        for key, value in response_data.items():
+            if key not in parser.result:
+                yield key, value
+
+
+def _record_streamed_parse(response_data, schema, stage, row_index):
+    """Schema check of a fully streamed answer, counted like parse_structured's strict/fallback outcomes."""
+    started = time.perf_counter()
+    errors = conform(response_data, schema)
+    if errors:
+        print(f"Streamed answer for stage '{stage}' (row {row_index + 1}) does not match its schema: "
+              f"{'; '.join(errors[:5])}.")
+    record_parse("fallback" if errors else "strict", time.perf_counter() - started)
+
+
 def start_conversation(row, prompt_template, model=MODEL, temperature=1):
 
     if not model:
@@ -0,0 +1,63 @@
+# executors.py
+# Process-wide, bounded thread pools shared by every query.
+# Each kind of work has its own named pool ("stages" for pipeline stages,
+# "llm" for the step-3 / look composer calls, "ranking" for step 6, "hedged"
+# for the primaries of hedged LLM requests), sized by EXECUTOR_WORKERS, so a
+# traffic spike queues work instead of spawning threads.
+# Pools are separate because stages block on the llm and ranking futures; one
+# shared pool could fill up with waiting stages.
+import concurrent.futures
+import threading
+from typing import Dict
+
+from config.config import EXECUTOR_WORKERS
+
+DEFAULT_WORKERS = 16
+
+_lock = threading.Lock()
+_executors: Dict[str, concurrent.futures.ThreadPoolExecutor] = {}
+
+
+def get_executor(name: str) -> concurrent.futures.ThreadPoolExecutor:
+    executor = _executors.get(name)
+    if executor is not None:
+        return executor
+    with _lock:
+        if name not in _executors:
+            _executors[name] = concurrent.futures.ThreadPoolExecutor(
+                max_workers=int((EXECUTOR_WORKERS or {}).get(name, DEFAULT_WORKERS)), thread_name_prefix=name)
+        return _executors[name]
+
+
+class TaskScope:
+    """
+    One query's view of a shared pool: submits like an executor and remembers
+    the futures, so the query can cancel what it left queued without shutting
+    the pool down.
+    """
+
+    def __init__(self, executor: concurrent.futures.Executor):
+        self._executor = executor
+        self._futures = []
+
+    def submit(self, fn, *args, **kwargs) -> concurrent.futures.Future:
+        future = self._executor.submit(fn, *args, **kwargs)
+        self._futures.append(future)
+        return future
+
+    def cancel_pending(self) -> None:
+        for future in self._futures:
+            future.cancel()  # only stops work that has not started
+
+
+def executor_stats() -> dict:
+    with _lock:
+        executors = dict(_executors)
+    return {
+        name: {
+            "workers": executor._max_workers,
+            "threads": len(executor._threads),
+            "queued": executor._work_queue.qsize(),
+        }
+        for name, executor in executors.items()
+    }
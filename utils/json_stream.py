@@ -0,0 +1,82 @@
+# json_stream.py
+# Incremental parser for a streamed JSON object.
+# Feed it text deltas as they arrive; it returns each top-level member as
+# soon as that member's value is complete, so downstream work can start
+# before the whole completion has been received.
+import json
+from typing import Any, List, Tuple
+
+_decoder = json.JSONDecoder(strict=False)
+_WHITESPACE = " \t\r\n"
+
+
+class IncrementalJSONParser:
+    """
+    parser = IncrementalJSONParser()
+    for delta in stream:
+        for key, value in parser.feed(delta):
+            ...
+    parser.result  # members parsed so far
+    """
+
+    def __init__(self):
+        self._buf = ""
+        self._pos = None  # index just after the opening '{'
+        self.result = {}
+        self.done = False
+        self.failed = False
+
+    def _skip(self, pos: int, chars: str) -> int:
+        while pos < len(self._buf) and self._buf[pos] in chars:
+            pos += 1
+        return pos
+
+    def feed(self, text: str) -> List[Tuple[str, Any]]:
+        self._buf += text
+        completed = []
+        if self._pos is None:
+            # Anything before the object (e.g. a ```json fence) is ignored
+            start = self._buf.find("{")
+            if start < 0:
+                return completed
+            self._pos = start + 1
+
+        while not self.done and not self.failed:
+            pos = self._skip(self._pos, _WHITESPACE + ",")
+            if pos >= len(self._buf):
+                break
+            if self._buf[pos] == "}":
+                self.done = True
+                break
+            if self._buf[pos] != '"':
+                self.failed = True
+                break
+            try:
+                key, end = _decoder.raw_decode(self._buf, pos)
+            except json.JSONDecodeError:
+                break  # key still arriving
+            end = self._skip(end, _WHITESPACE)
+            if end >= len(self._buf):
+                break
+            if self._buf[end] != ":":
+                self.failed = True
+                break
+            value_start = self._skip(end + 1, _WHITESPACE)
+            if value_start >= len(self._buf):
+                break
+            try:
+                value, value_end = _decoder.raw_decode(self._buf, value_start)
+            except json.JSONDecodeError:
+                break  # value still arriving
+            if not isinstance(value, (str, dict, list)):
+                # Numbers/literals may be cut mid-token ("1" of "10"): wait for a delimiter
+                after = self._skip(value_end, _WHITESPACE)
+                if after >= len(self._buf):
+                    break
+                if self._buf[after] not in ",}":
+                    self.failed = True
+                    break
+            self.result[key] = value
+            completed.append((key, value))
+            self._pos = value_end
+        return completed
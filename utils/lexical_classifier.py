@@ -0,0 +1,115 @@
+# lexical_classifier.py
+# LLM-free step-3 classifier built from the taxonomy `keywords` columns.
+# Every value's keywords, plus the words of its own name, are accent-folded
+# with canonicalize_query and compiled into one whole-word pattern; a query is
+# scored by which values it names. The answer has the shape of an analyzer
+# block (value_N_id/name/score/justification), with the attribute label and
+# value names the analyzer prompts use (the exclusion rules match on those),
+# so it can stand in for one:
+# LEXICAL_FAST_PATH = "skip" replaces the LLM call of a confidently matched
+# attribute, "preliminary" shows the match while the LLM runs.
+import re
+import threading
+from typing import Dict, Optional, Tuple
+
+from config.config import LEXICAL_CONFIDENCE
+from data.cache_runtime import canonicalize_query
+from utils.database_utils import connect_to_db
+
+# Values per block, as in the analyzer prompts
+MAX_VALUES = 3
+
+_lock = threading.Lock()
+_stats = {"classified": 0, "matched": 0, "confident": 0}
+
+
+def _terms(value: str, keywords: Optional[str]):
+    """Canonical search terms of one value: its keywords and the parts of its name ("retas | geométricas")."""
+    raw = (keywords or "").split(",") + value.split("|")
+    return sorted({term for term in (canonicalize_query(t) for t in raw) if term})
+
+
+def _pattern(terms):
+    # Longest first so "decote v" is not shadowed by a shorter term; optional plural ending
+    alternatives = "|".join(re.escape(term) for term in sorted(terms, key=len, reverse=True))
+    return re.compile(rf"\b({alternatives})(?:e?s)?\b")
+
+
+class LexicalClassifier:
+    def __init__(self, taxonomy: Dict[str, list], names: Optional[Dict[str, dict]] = None,
+                 labels: Optional[Dict[str, str]] = None):
+        """
+        taxonomy: {attribute: [(value id, value name, keywords)]}; names
+        ({attribute: {value id: name}}) and labels ({attribute: label}) override
+        the names and attribute label the blocks carry.
+        """
+        names = names or {}
+        self._labels = labels or {}
+        self._values = {
+            attr: [(value_id, names.get(attr, {}).get(value_id, name), _pattern(terms))
+                   for value_id, name, terms in
+                   ((value_id, name, _terms(name, keywords)) for value_id, name, keywords in rows) if terms]
+            for attr, rows in taxonomy.items()
+        }
+
+    @classmethod
+    def from_db(cls, tables: Dict[str, str], names: Optional[Dict[str, dict]] = None,
+                labels: Optional[Dict[str, str]] = None) -> "LexicalClassifier":
+        """tables: {attribute: value table}, e.g. ATTRIBUTE_INFO's "table" fields."""
+        with connect_to_db() as conn:
+            taxonomy = {attr: conn.execute(f"SELECT id, value, keywords FROM {table}").fetchall()
+                        for attr, table in tables.items()}
+        return cls(taxonomy, names, labels)
+
+    def classify(self, attr: str, query: str) -> Tuple[Optional[dict], float]:
+        """
+        (block, confidence) for `attr` in `query`; block is None when no value
+        is named. Confidence is the share of matched terms pointing at the best
+        value, discounted when it rests on few terms: one unambiguous keyword
+        gives 0.5, two give 0.75, a tie between two values 0.25. Matches at
+        LEXICAL_CONFIDENCE or above count as confident.
+        """
+        text = canonicalize_query(query)
+        hits = []
+        for value_id, name, pattern in self._values.get(attr, []):
+            found = sorted(set(pattern.findall(text)))
+            if found:
+                hits.append((value_id, name, found))
+        hits.sort(key=lambda hit: (-len(hit[2]), hit[0]))
+        confidence = 0.0
+        if hits:
+            top = len(hits[0][2])
+            confidence = top / sum(len(found) for _, _, found in hits) * (1 - 0.5 ** top)
+        with _lock:
+            _stats["classified"] += 1
+            _stats["matched"] += bool(hits)
+            _stats["confident"] += bool(hits) and confidence >= LEXICAL_CONFIDENCE
+        if not hits:
+            return None, 0.0
+        block = {"attribute": self._labels.get(attr, attr)}
+        for i, (value_id, name, found) in enumerate(hits[:MAX_VALUES], 1):
+            block[f"value_{i}_id"] = value_id
+            block[f"value_{i}_name"] = name
+            block[f"value_{i}_score"] = min(7 + len(found), 10)
+            block[f"value_{i}_justification"] = f"Termos da busca: {', '.join(found)}"
+        return block, round(confidence, 3)
+
+
+_classifier: Optional[LexicalClassifier] = None
+
+
+def get_lexical_classifier(tables: Dict[str, str], names: Optional[Dict[str, dict]] = None,
+                           labels: Optional[Dict[str, str]] = None) -> LexicalClassifier:
+    """The process-wide classifier; the taxonomy is read from the database once."""
+    global _classifier
+    if _classifier is not None:
+        return _classifier
+    with _lock:
+        if _classifier is None:
+            _classifier = LexicalClassifier.from_db(tables, names, labels)
+    return _classifier
+
+
+def lexical_stats() -> dict:
+    with _lock:
+        return dict(_stats)
@@ -0,0 +1,116 @@
+# llm_breaker.py
+# Per-provider circuit breakers for the LLM layer.
+# After LLM_BREAKER_FAILURES consecutive failures (errors, timeouts or calls
+# slower than LLM_BREAKER_SLOW_CALL_S) a provider is skipped for
+# LLM_BREAKER_COOLDOWN seconds; then a single half-open probe decides whether
+# it closes again or stays open for another cooldown.
+import threading
+import time
+from typing import Dict, List
+
+from config.config import LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN, LLM_BREAKER_SLOW_CALL_S, LLM_FALLBACKS
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    def __init__(self, provider: str, failure_threshold: int, cooldown: float, slow_call_s: float):
+        self.provider = provider
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.slow_call_s = slow_call_s
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        # metrics
+        self.successes = 0
+        self.failures = 0
+        self.rejected = 0
+        self.times_opened = 0
+
+    def allow(self) -> bool:
+        """True if a request may be sent now (closed, or the half-open probe slot is free)."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self, elapsed: float = 0.0) -> None:
+        if self.slow_call_s and elapsed > self.slow_call_s:
+            self.record_failure()
+            return
+        with self._lock:
+            self.successes += 1
+            self.consecutive_failures = 0
+            self.state = CLOSED
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.times_opened += 1
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+            self._probe_in_flight = False
+
+    def release(self) -> None:
+        """End an attempt that says nothing about provider health (e.g. a 429)."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            retry_in = 0.0
+            if self.state == OPEN:
+                retry_in = max(self.cooldown - (time.monotonic() - self.opened_at), 0.0)
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "successes": self.successes,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "times_opened": self.times_opened,
+                "retry_in_s": round(retry_in, 1),
+            }
+
+
+_lock = threading.Lock()
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(provider: str) -> CircuitBreaker:
+    breaker = _breakers.get(provider)
+    if breaker is not None:
+        return breaker
+    with _lock:
+        breaker = _breakers.get(provider)
+        if breaker is None:
+            breaker = CircuitBreaker(provider, LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN, LLM_BREAKER_SLOW_CALL_S)
+            _breakers[provider] = breaker
+    return breaker
+
+
+def breaker_states() -> Dict[str, dict]:
+    with _lock:
+        items = list(_breakers.items())
+    return {provider: b.snapshot() for provider, b in items}
+
+
+def fallback_chain(model: str, stage: str = None) -> List[str]:
+    """Ordered aliases to try for a stage: the requested model first, then LLM_FALLBACKS[stage|default]."""
+    fallbacks = LLM_FALLBACKS or {}
+    chain = [model] + list(fallbacks.get(stage) or fallbacks.get("default") or [])
+    return list(dict.fromkeys(chain))
@@ -0,0 +1,163 @@
+# llm_cache.py
+# Content-addressed, persistent cache for LLM responses (and other small JSON
+# payloads). Entries live in a local SQLite file, expire after a TTL and are
+# evicted least-recently-used once the namespace exceeds its size bound.
+import contextlib
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+from config.config import LLM_CACHE_PATH, LLM_CACHE_TTL, LLM_CACHE_MAX_ENTRIES
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache_entries (
+    namespace   TEXT NOT NULL,
+    key         TEXT NOT NULL,
+    payload     TEXT NOT NULL,
+    created_at  REAL NOT NULL,
+    accessed_at REAL NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS idx_cache_lru ON cache_entries (namespace, accessed_at);
+"""
+
+
+def request_key(messages, model_name, temperature, response_format=None) -> str:
+    """Stable hash of everything that determines a chat completion."""
+    material = {
+        "messages": messages,
+        "model": model_name,
+        "temperature": temperature,
+        "response_format": response_format,
+    }
+    raw = json.dumps(material, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class SqliteTTLCache:
+    """Namespaced key -> JSON text store with TTL and size-bounded LRU eviction."""
+
+    def __init__(self, path: str, namespace: str, ttl: int, max_entries: int):
+        self.path = str(path)
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """A connection for one operation: committed (or rolled back) and then closed."""
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL;")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT payload, created_at FROM cache_entries WHERE namespace = ? AND key = ?",
+                    (self.namespace, key),
+                ).fetchone()
+                if row and self.ttl and now - row[1] > self.ttl:
+                    conn.execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (self.namespace, key))
+                    row = None
+                if row:
+                    conn.execute(
+                        "UPDATE cache_entries SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                        (now, self.namespace, key),
+                    )
+        except sqlite3.Error as e:
+            # A broken cache is a miss, never a failed query
+            print(f"[CACHE] {self.namespace} read failed: {e}")
+            row = None
+
+        with self._lock:
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return row[0] if row else None
+
+    def put(self, key: str, payload: str) -> None:
+        now = time.time()
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache_entries (namespace, key, payload, created_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (self.namespace, key, payload, now, now),
+                )
+                self._evict(conn, now)
+        except sqlite3.Error as e:
+            print(f"[CACHE] {self.namespace} write failed: {e}")
+
+    def _evict(self, conn, now: float) -> None:
+        removed = 0
+        if self.ttl:
+            removed += conn.execute(
+                "DELETE FROM cache_entries WHERE namespace = ? AND created_at < ?",
+                (self.namespace, now - self.ttl),
+            ).rowcount
+        count = conn.execute("SELECT COUNT(*) FROM cache_entries WHERE namespace = ?", (self.namespace,)).fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow > 0:
+            removed += conn.execute(
+                """DELETE FROM cache_entries WHERE namespace = ? AND key IN (
+                       SELECT key FROM cache_entries WHERE namespace = ? ORDER BY accessed_at LIMIT ?)""",
+                (self.namespace, self.namespace, overflow),
+            ).rowcount
+        if removed:
+            with self._lock:
+                self.evictions += removed
+
+    def clear(self) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM cache_entries WHERE namespace = ?", (self.namespace,))
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+_lock = threading.Lock()
+_caches: Dict[str, SqliteTTLCache] = {}
+
+
+def get_cache(namespace: str, ttl: int = LLM_CACHE_TTL, max_entries: int = LLM_CACHE_MAX_ENTRIES) -> SqliteTTLCache:
+    """Process-wide cache instance for a namespace, backed by LLM_CACHE_PATH."""
+    cache = _caches.get(namespace)
+    if cache is not None:
+        return cache
+    with _lock:
+        cache = _caches.get(namespace)
+        if cache is None:
+            cache = SqliteTTLCache(LLM_CACHE_PATH, namespace, ttl, max_entries)
+            _caches[namespace] = cache
+    return cache
+
+
+def cache_stats() -> Dict[str, dict]:
+    with _lock:
+        items = list(_caches.items())
+    return {namespace: c.stats() for namespace, c in items}
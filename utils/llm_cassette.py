@@ -0,0 +1,114 @@
+# llm_cassette.py
+# Record/replay of LLM traffic at the call_model boundary.
+# In "record" mode every answered request is appended to a gzip'd JSONL file
+# (request hash -> content, usage, observed latency). In "replay" mode answers
+# are served from that file without API keys or network, optionally sleeping
+# for the recorded latency, so the pipeline, the cache prewarm and
+# llm/bench.py can be profiled and load-tested offline and reproducibly.
+import atexit
+import gzip
+import json
+import threading
+from pathlib import Path
+from typing import Optional
+
+from config.config import LLM_CASSETTE_MODE, LLM_CASSETTE_PATH, LLM_CASSETTE_REPLAY_LATENCY
+
+RECORD = "record"
+REPLAY = "replay"
+
+
+class Cassette:
+    def __init__(self, path: str, mode: str, replay_latency: bool = False):
+        self.path = Path(path)
+        self.mode = mode
+        self.replay_latency = replay_latency
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._fh = None
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        if mode == REPLAY:
+            self._load()
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == REPLAY
+
+    def _load(self) -> None:
+        if not self.path.exists():
+            print(f"[CASSETTE] {self.path} not found; every request will miss.")
+            return
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as fh:
+                for line in fh:
+                    entry = json.loads(line)
+                    self._entries[entry["key"]] = entry
+        except (EOFError, OSError, ValueError) as e:
+            # A recorder that was killed leaves a truncated last member; keep what was read
+            print(f"[CASSETTE] Stopped reading {self.path} early: {e}")
+        print(f"[CASSETTE] Loaded {len(self._entries)} recorded responses from {self.path}.")
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def delay(self, entry: dict) -> float:
+        """Seconds the caller should wait before answering (the recorded latency, if replayed)."""
+        return float(entry.get("latency_s") or 0.0) if self.replay_latency else 0.0
+
+    def record(self, key: str, model: str, content: str, usage: Optional[dict], latency_s: float) -> None:
+        line = json.dumps({"key": key, "model": model, "content": content, "usage": usage,
+                           "latency_s": round(latency_s, 4)}, ensure_ascii=False)
+        with self._lock:
+            if self._fh is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._fh = gzip.open(self.path, "at", encoding="utf-8")
+                atexit.register(self.close)
+            self._fh.write(line + "\n")
+            self._fh.flush()  # sync-flush so a crashed run still leaves readable entries
+            self.recorded += 1
+
+    def close(self) -> None:
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "recorded": self.recorded,
+            }
+
+
+_lock = threading.Lock()
+_cassette: Optional[Cassette] = None
+
+
+def get_cassette() -> Optional[Cassette]:
+    """The process-wide cassette, or None when LLM_CASSETTE_MODE is off."""
+    global _cassette
+    if LLM_CASSETTE_MODE not in (RECORD, REPLAY):
+        return None
+    if _cassette is not None:
+        return _cassette
+    with _lock:
+        if _cassette is None:
+            _cassette = Cassette(LLM_CASSETTE_PATH, LLM_CASSETTE_MODE, LLM_CASSETTE_REPLAY_LATENCY)
+    return _cassette
+
+
+def cassette_stats() -> Optional[dict]:
+    cassette = get_cassette()
+    return cassette.stats() if cassette is not None else None
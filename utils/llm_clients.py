@@ -0,0 +1,193 @@
+# llm_clients.py
+# Process-wide registry of OpenAI-compatible clients, one per provider/endpoint.
+# Each client keeps its own HTTP keep-alive pool, so the ~9 calls of a query
+# (and the step-3 worker threads) reuse warm TLS connections instead of
+# paying a fresh handshake per call. AsyncOpenAI clients for the asyncio
+# pipeline live in a parallel registry, one per event loop.
+import asyncio
+import hashlib
+import threading
+from typing import Dict, Optional, Tuple
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, OpenAI, DefaultHttpxClient
+
+from config.config import LLM_MAX_CONNECTIONS, LLM_KEEPALIVE_EXPIRY, LLM_REQUEST_TIMEOUT
+
+_lock = threading.Lock()
+_clients: Dict[Tuple[str, str, str], OpenAI] = {}
+_transports: Dict[Tuple[str, str, str], "_CountingTransport"] = {}
+_async_clients: Dict[Tuple[str, str, str, int], AsyncOpenAI] = {}
+_async_transports: Dict[Tuple[str, str, str, int], "_CountingAsyncTransport"] = {}
+
+
+class _ConnectionCounter:
+    """Request / new-connection counters fed by the httpcore trace extension."""
+
+    def _init_counters(self):
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.tls_handshakes = 0
+
+    def _count(self, event_name):
+        if event_name == "connection.connect_tcp.complete":
+            with self._stats_lock:
+                self.new_connections += 1
+        elif event_name == "connection.start_tls.complete":
+            with self._stats_lock:
+                self.tls_handshakes += 1
+
+    def _count_request(self):
+        with self._stats_lock:
+            self.requests += 1
+
+    def snapshot(self) -> dict:
+        with self._stats_lock:
+            reused = max(self.requests - self.new_connections, 0)
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "tls_handshakes": self.tls_handshakes,
+                "reused_connections": reused,
+                "reuse_ratio": round(reused / self.requests, 3) if self.requests else 0.0,
+            }
+
+
+class _CountingTransport(_ConnectionCounter, httpx.HTTPTransport):
+    """HTTP transport that counts requests vs. freshly opened connections."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._init_counters()
+
+    def _trace(self, event_name, info):
+        self._count(event_name)
+
+    def handle_request(self, request):
+        self._count_request()
+        request.extensions["trace"] = self._trace
+        return super().handle_request(request)
+
+
+class _CountingAsyncTransport(_ConnectionCounter, httpx.AsyncHTTPTransport):
+    """Async twin of _CountingTransport (httpcore wants a coroutine trace callback here)."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._init_counters()
+
+    async def _trace(self, event_name, info):
+        self._count(event_name)
+
+    async def handle_async_request(self, request):
+        self._count_request()
+        request.extensions["trace"] = self._trace
+        return await super().handle_async_request(request)
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_CONNECTIONS,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+    )
+
+
+def _key(provider: str, endpoint: Optional[str], api_key: str) -> Tuple[str, str, str]:
+    # Never keep the raw key in the registry key (it shows up in stats/logs)
+    key_hash = hashlib.sha1((api_key or "").encode("utf-8")).hexdigest()[:8]
+    return provider, endpoint or "default", key_hash
+
+
+def get_client(provider: str, api_key: str, endpoint: Optional[str] = None) -> OpenAI:
+    """
+    Return the shared client for (provider, endpoint, api_key), creating it once.
+    OpenAI clients are thread-safe, so the same instance is handed to every thread.
+    """
+    key = _key(provider, endpoint, api_key)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            transport = _CountingTransport(limits=_limits())
+            http_client = DefaultHttpxClient(transport=transport)
+            # Retries are paced by the governor (utils/llm_governor.py), not the SDK;
+            # the timeout bounds how long a hung provider can hold a caller before failover
+            options = {"http_client": http_client, "max_retries": 0, "timeout": LLM_REQUEST_TIMEOUT}
+            if endpoint:
+                client = OpenAI(api_key=api_key, base_url=endpoint, **options)
+            else:
+                client = OpenAI(api_key=api_key, **options)
+            _clients[key] = client
+            _transports[key] = transport
+    return client
+
+
+def get_async_client(provider: str, api_key: str, endpoint: Optional[str] = None) -> AsyncOpenAI:
+    """
+    AsyncOpenAI counterpart of get_client(). Async connection pools are bound to
+    the event loop that opened them, so clients are kept per running loop.
+    """
+    key = _key(provider, endpoint, api_key) + (id(asyncio.get_running_loop()),)
+    client = _async_clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _async_clients.get(key)
+        if client is None:
+            transport = _CountingAsyncTransport(limits=_limits())
+            http_client = DefaultAsyncHttpxClient(transport=transport)
+            options = {"http_client": http_client, "max_retries": 0, "timeout": LLM_REQUEST_TIMEOUT}
+            if endpoint:
+                client = AsyncOpenAI(api_key=api_key, base_url=endpoint, **options)
+            else:
+                client = AsyncOpenAI(api_key=api_key, **options)
+            _async_clients[key] = client
+            _async_transports[key] = transport
+    return client
+
+
+def prewarm_clients(targets) -> int:
+    """
+    Open one connection per (provider, api_key, endpoint) target ahead of the first query.
+    A cheap model-list request is enough to do the TCP + TLS handshake; any error
+    (including auth errors) is ignored since the connection is warm either way.
+    Returns the number of clients warmed.
+    """
+    warmed = 0
+    for provider, api_key, endpoint in targets:
+        try:
+            client = get_client(provider, api_key, endpoint)
+            client.with_options(timeout=5.0, max_retries=0).models.list()
+        except Exception as e:
+            print(f"[LLM] Prewarm for {provider} ended with: {type(e).__name__}")
+        warmed += 1
+    return warmed
+
+
+def client_stats() -> Dict[str, dict]:
+    """Connection reuse stats per registered client, keyed as 'provider@endpoint'."""
+    with _lock:
+        items = list(_transports.items())
+        async_items = list(_async_transports.items())
+    stats = {f"{provider}@{endpoint}": t.snapshot() for (provider, endpoint, _), t in items}
+    for (provider, endpoint, _, _), t in async_items:
+        stats[f"{provider}@{endpoint} (async)"] = t.snapshot()
+    return stats
+
+
+def close_clients() -> None:
+    """Close every pooled sync client (tests / shutdown); async clients go with their event loop."""
+    with _lock:
+        for client in _clients.values():
+            try:
+                client.close()
+            except Exception:
+                pass
+        _clients.clear()
+        _transports.clear()
@@ -0,0 +1,244 @@
+# llm_governor.py
+# Shared, per-provider concurrency governor for LLM calls.
+# Caps in-flight requests and requests/tokens per minute, queues callers until
+# capacity frees up, and paces retries with exponential backoff + jitter that
+# honors Retry-After. One governor per provider is shared by every Streamlit
+# session in the process.
+import asyncio
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+from config.config import LLM_RATE_LIMITS, LLM_BACKOFF_BASE, LLM_BACKOFF_MAX, LLM_QUEUE_TIMEOUT
+
+DEFAULT_LIMITS = {"max_in_flight": 8, "rpm": 500, "tpm": 800_000}
+
+# Rough chars-per-token ratio used to reserve TPM budget before the call
+CHARS_PER_TOKEN = 4
+# Completion budget reserved up front; reconciled with real usage afterwards
+EXPECTED_COMPLETION_TOKENS = 600
+# Longest an async waiter sleeps between admission checks (release() cannot wake it)
+ASYNC_POLL_S = 0.05
+
+
+class QueueTimeout(Exception):
+    """Raised when a caller waited longer than LLM_QUEUE_TIMEOUT for a slot."""
+
+
+class _TokenBucket:
+    """Per-minute bucket. May go negative when real usage exceeds the reservation."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount: float, now: float) -> float:
+        self._refill(now)
+        need = min(amount, self.capacity)
+        if self.level >= need:
+            return 0.0
+        return (need - self.level) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.level -= amount
+
+
+class ProviderGovernor:
+    def __init__(self, provider: str, max_in_flight: int, rpm: int, tpm: int):
+        self.provider = provider
+        self.max_in_flight = max_in_flight
+        self._cond = threading.Condition()
+        self._requests = _TokenBucket(rpm)
+        self._tokens = _TokenBucket(tpm)
+        self._blocked_until = 0.0
+        self.in_flight = 0
+        self.waiting = 0
+        # metrics
+        self.admitted = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def try_acquire(self, tokens: int) -> float:
+        """
+        Admit the caller if capacity allows and return 0.0; otherwise return
+        the suggested wait in seconds. Never blocks.
+        """
+        with self._cond:
+            return self._try_admit(tokens)
+
+    def _try_admit(self, tokens: int) -> float:
+        now = time.monotonic()
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        if self.in_flight >= self.max_in_flight:
+            return 1.0  # woken earlier by release()
+        wait = max(self._requests.wait_for(1, now), self._tokens.wait_for(tokens, now))
+        if wait > 0:
+            return wait
+        self._requests.take(1)
+        self._tokens.take(tokens)
+        self.in_flight += 1
+        return 0.0
+
+    def acquire(self, tokens: int, timeout: Optional[float] = None) -> float:
+        """Block until admitted. Returns the time spent queued, in seconds."""
+        start = time.monotonic()
+        deadline = start + (LLM_QUEUE_TIMEOUT if timeout is None else timeout)
+        with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    wait = self._try_admit(tokens)
+                    if wait == 0:
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise QueueTimeout(f"Timed out waiting for a {self.provider} slot")
+                    self._cond.wait(min(wait, remaining))
+            finally:
+                self.waiting -= 1
+        waited = time.monotonic() - start
+        self.record_wait(waited)
+        return waited
+
+    def record_wait(self, waited: float) -> None:
+        with self._cond:
+            self.admitted += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+
+    def release(self, reserved: int, used: Optional[int] = None) -> None:
+        """Free the slot and reconcile the token reservation with real usage."""
+        with self._cond:
+            self.in_flight -= 1
+            if used is not None:
+                self._tokens.take(used - reserved)
+            self._cond.notify_all()
+
+    def cool_down(self, seconds: float) -> None:
+        """Pause new admissions for this provider (e.g. after a 429)."""
+        with self._cond:
+            self.throttled += 1
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, tokens: int):
+        """
+        with governor.slot(estimate) as s:
+            response = ...
+            s["used"] = response.usage.total_tokens
+        """
+        self.acquire(tokens)
+        holder = {"used": None}
+        try:
+            yield holder
+        finally:
+            self.release(tokens, holder["used"])
+
+    @asynccontextmanager
+    async def aslot(self, tokens: int):
+        """
+        Async counterpart of slot(): waits with asyncio.sleep instead of blocking
+        a thread, so many coroutines can queue on one event loop.
+        """
+        start = time.monotonic()
+        deadline = start + LLM_QUEUE_TIMEOUT
+        with self._cond:
+            self.waiting += 1
+        try:
+            while True:
+                wait = self.try_acquire(tokens)
+                if wait == 0:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise QueueTimeout(f"Timed out waiting for a {self.provider} slot")
+                await asyncio.sleep(min(wait, remaining, ASYNC_POLL_S))
+        finally:
+            with self._cond:
+                self.waiting -= 1
+        self.record_wait(time.monotonic() - start)
+
+        holder = {"used": None}
+        try:
+            yield holder
+        finally:
+            self.release(tokens, holder["used"])
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            return {
+                "in_flight": self.in_flight,
+                "queued": self.waiting,
+                "admitted": self.admitted,
+                "throttled": self.throttled,
+                "avg_queue_wait_s": round(self.total_wait / self.admitted, 3) if self.admitted else 0.0,
+                "max_queue_wait_s": round(self.max_wait, 3),
+            }
+
+
+_lock = threading.Lock()
+_governors: Dict[str, ProviderGovernor] = {}
+
+
+def get_governor(provider: str) -> ProviderGovernor:
+    gov = _governors.get(provider)
+    if gov is not None:
+        return gov
+    with _lock:
+        gov = _governors.get(provider)
+        if gov is None:
+            limits = {**DEFAULT_LIMITS, **((LLM_RATE_LIMITS or {}).get(provider) or {})}
+            gov = ProviderGovernor(provider, int(limits["max_in_flight"]), int(limits["rpm"]), int(limits["tpm"]))
+            _governors[provider] = gov
+    return gov
+
+
+def governor_stats() -> Dict[str, dict]:
+    with _lock:
+        items = list(_governors.items())
+    return {provider: gov.snapshot() for provider, gov in items}
+
+
+def estimate_tokens(messages) -> int:
+    chars = sum(len(str(m.get("content") or "")) for m in messages)
+    return chars // CHARS_PER_TOKEN + EXPECTED_COMPLETION_TOKENS
+
+
+def retry_after_seconds(exc) -> Optional[float]:
+    """Read Retry-After (seconds or HTTP date) / retry-after-ms from an API error response."""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except Exception:
+        return None
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Exponential backoff with full jitter; a server-provided Retry-After wins when longer."""
+    delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, LLM_BACKOFF_MAX))
+    return delay
@@ -0,0 +1,169 @@
+# llm_hedging.py
+# Hedged requests for the sequential LLM stages.
+# If the primary call has not answered after a per-stage delay, a duplicate
+# request is fired (same or equivalent model) and the first usable answer wins.
+# A hedge budget caps how many extra requests we are willing to pay for.
+import asyncio
+import concurrent.futures
+import contextvars
+import threading
+from collections import defaultdict, deque
+from typing import Callable, Dict, Optional
+
+from config.config import LLM_HEDGE_DELAYS, LLM_HEDGE_MAX_RATIO
+from utils.executors import get_executor
+
+# Samples kept per stage for percentile-based delays ("p90", "p95", ...)
+LATENCY_WINDOW = 200
+# Below this many samples a percentile delay falls back to the default delay
+MIN_SAMPLES = 20
+DEFAULT_DELAY_S = 5.0
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix="llm-hedge")
+_lock = threading.Lock()
+_latencies: Dict[str, deque] = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+_stats = {"calls": 0, "hedges_fired": 0, "hedges_won": 0, "primaries_won": 0, "skipped_budget": 0}
+
+
+def observe_latency(stage: Optional[str], seconds: float) -> None:
+    with _lock:
+        _latencies[stage or "default"].append(seconds)
+
+
+def _percentile(samples, pct: float) -> float:
+    ordered = sorted(samples)
+    idx = min(int(round(pct / 100.0 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[idx]
+
+
+def hedge_delay(stage: Optional[str]) -> float:
+    """
+    Resolve the hedge delay for a stage from LLM_HEDGE_DELAYS.
+    Values are seconds or a percentile of observed latency such as "p90".
+    """
+    delays = LLM_HEDGE_DELAYS or {}
+    value = delays.get(stage, delays.get("default", DEFAULT_DELAY_S))
+    if isinstance(value, str) and value.lower().startswith("p"):
+        with _lock:
+            samples = list(_latencies.get(stage or "default", ()))
+        if len(samples) < MIN_SAMPLES:
+            return DEFAULT_DELAY_S
+        return _percentile(samples, float(value[1:]))
+    return float(value)
+
+
+def _take_hedge_budget() -> bool:
+    with _lock:
+        if _stats["hedges_fired"] + 1 > LLM_HEDGE_MAX_RATIO * _stats["calls"]:
+            _stats["skipped_budget"] += 1
+            return False
+        _stats["hedges_fired"] += 1
+        return True
+
+
+def _submit(fn: Callable):
+    # Each task gets its own copy of the caller's context (metering, routing, ...)
+    return _executor.submit(contextvars.copy_context().run, fn)
+
+
+def _start(fn: Callable):
+    """
+    (future, started) for fn submitted to the shared, bounded "hedged" pool;
+    `started` is set once a worker picks it up. The pool is not "llm": step-3
+    calls running there would wait on primaries queued behind them.
+    """
+    started = threading.Event()
+    context = contextvars.copy_context()
+
+    def run():
+        started.set()
+        return context.run(fn)
+
+    return get_executor("hedged").submit(run), started
+
+
+def run_hedged(primary: Callable, hedge: Callable, delay: float):
+    """
+    Run primary(); if it is still pending after `delay` seconds and the hedge
+    budget allows, also run hedge() and return the first non-None result.
+    The primary runs on the bounded "hedged" pool (utils/executors.py) and
+    `delay` counts from when it starts, so time queued for a worker is not
+    taken for a slow provider; the hedge goes to the separate hedge pool.
+    The loser is cancelled if it has not started yet; otherwise its result is
+    simply discarded (a running HTTP request cannot be interrupted).
+    """
+    with _lock:
+        _stats["calls"] += 1
+
+    primary_f, started = _start(primary)
+    started.wait()
+    try:
+        return primary_f.result(timeout=delay)
+    except concurrent.futures.TimeoutError:
+        pass
+
+    if not _take_hedge_budget():
+        return primary_f.result()
+
+    hedge_f = _submit(hedge)
+    pending = {primary_f, hedge_f}
+    result = None
+    while pending and result is None:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for f in done:
+            try:
+                value = f.result()
+            except Exception as e:
+                print(f"Hedged request failed: {e}")
+                continue
+            if value is not None and result is None:
+                result = value
+                with _lock:
+                    _stats["hedges_won" if f is hedge_f else "primaries_won"] += 1
+    for f in pending:
+        f.cancel()
+    return result
+
+
+async def arun_hedged(primary: Callable, hedge: Callable, delay: float):
+    """
+    Async run_hedged(): primary and hedge are coroutine functions. Unlike the
+    threaded version, the losing request is really cancelled.
+    """
+    with _lock:
+        _stats["calls"] += 1
+
+    primary_t = asyncio.ensure_future(primary())
+    done, _ = await asyncio.wait({primary_t}, timeout=delay)
+    if done:
+        return primary_t.result()
+
+    if not _take_hedge_budget():
+        return await primary_t
+
+    hedge_t = asyncio.ensure_future(hedge())
+    pending = {primary_t, hedge_t}
+    result = None
+    while pending and result is None:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for t in done:
+            try:
+                value = t.result()
+            except Exception as e:
+                print(f"Hedged request failed: {e}")
+                continue
+            if value is not None and result is None:
+                result = value
+                with _lock:
+                    _stats["hedges_won" if t is hedge_t else "primaries_won"] += 1
+    for t in pending:
+        t.cancel()
+    return result
+
+
+def hedge_stats() -> dict:
+    with _lock:
+        stats = dict(_stats)
+    fired = stats["hedges_fired"]
+    stats["hedge_win_rate"] = round(stats["hedges_won"] / fired, 3) if fired else 0.0
+    return stats
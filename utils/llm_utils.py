@@ -1,15 +1,38 @@
 # llm_utils.py
+import asyncio
+import threading
 import time
 import os
-from openai import OpenAI, APIError, RateLimitError, AuthenticationError
-from config.config import API_KEY
+from pathlib import Path
+from openai import APIError, APIConnectionError, InternalServerError, RateLimitError, AuthenticationError
+from openai.types import CompletionUsage
+from openai.types.chat import ChatCompletion
+from config.config import (
+    API_KEY, LLM_MAX_RETRIES, LLM_HEDGE_ENABLED, LLM_HEDGE_MODELS, LLM_CACHE, LLM_SINGLE_FLIGHT, STAND_IN_URL,
+    get_api_key,
+)
+from utils.llm_cache import request_key, get_cache, cache_stats
+from utils.llm_cassette import get_cassette, cassette_stats
+from utils.llm_breaker import get_breaker, fallback_chain
+from utils.llm_clients import get_client, get_async_client, prewarm_clients, client_stats
+from utils.llm_governor import (
+    QueueTimeout, get_governor, governor_stats, estimate_tokens, retry_after_seconds, backoff_delay,
+    CHARS_PER_TOKEN, EXPECTED_COMPLETION_TOKENS,
+)
+from utils.llm_hedging import run_hedged, arun_hedged, hedge_delay, observe_latency, hedge_stats
+from utils.metering import current_meter
+from utils.prompt_schemas import adapt_response_format, parse_stats
+from utils.single_flight import coalesce, acoalesce
 
 # Number of tokens in one million
 TOKENS_PER_MILLION = 1_000_000
 
-# Global counters for usage and cost tracking
+# Global, process-wide counters for usage and cost tracking.
+# Per-query numbers live in the metering scope (utils/metering.py).
+_usage_lock = threading.Lock()
 total_input_tokens = 0
 total_output_tokens = 0
+total_cached_tokens = 0
 total_cost = 0.0
 num_api_calls = 0
 
@@ -17,113 +40,663 @@ last_input_tokens = 0
 last_output_tokens = 0
 last_cost = 0.0
 
-# Supported model configurations
+# Supported model configurations.
+# "cached_input" is the rate for prompt tokens served from the provider's prefix
+# cache; models without it are billed the plain input rate for those tokens.
 MODELS = {
     "gpt-5-mini": {
         "provider": "openai",
         "model_name": "gpt-5-mini",
-        "cost_per_million": {"input": 0.25, "output": 2.0}
+        "cost_per_million": {"input": 0.25, "cached_input": 0.025, "output": 2.0}
     },
     "gpt-4o": {
         "provider": "openai",
         "model_name": "gpt-4o",
-        "cost_per_million": {"input": 2.5, "output": 10.0}
+        "cost_per_million": {"input": 2.5, "cached_input": 1.25, "output": 10.0}
     },
     "gpt-4o-mini": {
         "provider": "openai",
         "model_name": "gpt-4o-mini",
-        "cost_per_million": {"input": 0.15, "output": 0.6}
+        "cost_per_million": {"input": 0.15, "cached_input": 0.075, "output": 0.6}
     },
     "deepseek-v3": {
         "provider": "deepseek",
         "model_name": "deepseek-chat",
         "endpoint": "https://api.deepseek.com/v1",
-        "cost_per_million": {"input": 0.27, "output": 1.1}
+        "cost_per_million": {"input": 0.27, "cached_input": 0.07, "output": 1.1}
     },
     "gemini-2.5-flash": {
         "provider": "google",
         "model_name": "models/gemini-2.5-flash",
         "endpoint": "https://generativelanguage.googleapis.com/v1beta/openai/",
         "cost_per_million": {"input": 0.40, "output": 0.60}
+    },
+    # llm/stand_in_server.py: schema-valid fake answers for load tests, no key needed
+    "local-stand-in": {
+        "provider": "local",
+        "model_name": "stand-in",
+        "endpoint": STAND_IN_URL,
+        "keyless": True,
+        "cost_per_million": {"input": 0.0, "output": 0.0}
     }
 }
 
 # Default model to use
 current_model = "gpt-4o"
 
+# Size of the text deltas a replayed stream is cut into
+REPLAY_CHUNK_CHARS = 32
+
 
-def call_model(messages, model=current_model, response_format=None, retry=False, temperature=1):
+def call_model(messages, model=current_model, response_format=None, retry=False, temperature=1, *,
+               stage=None, hedge=None, cache=None):
     """
     Send a chat completion request to the specified model using the OpenAI library.
     Automatically picks the endpoint based on model provider configuration.
-    Tracks token usage and cost using per-million-token rates.
+    Requests go through the provider's shared governor: callers queue for a slot
+    instead of failing, and rate limits / transient errors are retried with
+    exponential backoff that honors Retry-After.
+    Each provider has a circuit breaker; when the model fails or its breaker is
+    open, the stage's fallback chain (LLM_FALLBACKS) is tried in order.
+    With hedging on (hedge=True or LLM_HEDGE_ENABLED), a duplicate request is sent
+    to LLM_HEDGE_MODELS[model] (default: the same model) when the stage's hedge
+    delay passes without an answer; the first answer wins.
+    With the response cache on (cache=True or LLM_CACHE), an identical request
+    (messages, model, temperature, response_format) is served from local disk.
+    With LLM_SINGLE_FLIGHT, an identical request already in flight (from any
+    query) is waited for instead of sent again; its caller is billed.
+    Tracks token usage and cost using per-million-token rates, globally and in
+    the active metering scope; once that scope's budget is spent, returns None
+    without calling the API.
+    With LLM_CASSETTE_MODE=record every answer is written to the cassette; with
+    =replay answers come from it instead (no API key or network needed).
+    Returns None when the call ultimately fails.
     """
-    global total_input_tokens, total_output_tokens, total_cost, num_api_calls
-    global last_input_tokens, last_output_tokens, last_cost, current_model
+    global current_model
 
     current_model = model
+    cassette = get_cassette()
+    if cassette is None:
+        return _call_model(messages, model, response_format, retry, temperature, stage, hedge, cache)
+
+    _check_model(model)
+    key = request_key(messages, MODELS[model]["model_name"], temperature, response_format)
+    if cassette.replaying:
+        entry = _replay(cassette, key, model, stage)
+        if entry is None:
+            return None
+        time.sleep(cassette.delay(entry))
+        return _reused(_completion(MODELS[model]["model_name"], entry["content"], entry.get("usage")), "cassette")
+
+    started = time.perf_counter()
+    response = _call_model(messages, model, response_format, retry, temperature, stage, hedge, cache)
+    if response is not None:
+        usage = response.usage.model_dump() if response.usage else None
+        cassette.record(key, model, response.choices[0].message.content, usage, time.perf_counter() - started)
+    return response
+
+
+def _call_model(messages, model, response_format, retry, temperature, stage, hedge, cache):
+    chain = fallback_chain(model, stage)
+    for alias in chain:
+        _check_model(alias)
+
+    meter = current_meter()
+    if _over_budget(meter, stage):
+        return None
+    started = time.perf_counter()
+
+    if cache is None:
+        cache = LLM_CACHE
+    cache_key = None
+    if cache:
+        cache_key = request_key(messages, MODELS[model]["model_name"], temperature, response_format)
+        cached = get_cache("llm").get(cache_key)
+        if cached is not None:
+            try:
+                response = ChatCompletion.model_validate_json(cached)
+                if meter is not None:
+                    meter.add_call(stage, time.perf_counter() - started, cache_hit=True)
+                return _reused(response, "cache")
+            except Exception as e:
+                print(f"[CACHE] Ignoring unreadable cached response: {e}")
+
+    if hedge is None:
+        hedge = LLM_HEDGE_ENABLED
+
+    request = lambda: _call_chain(messages, chain, response_format, retry, temperature, stage, hedge, cache)
+    if LLM_SINGLE_FLIGHT:
+        key = cache_key or request_key(messages, MODELS[model]["model_name"], temperature, response_format)
+        response, coalesced = coalesce(key, request)
+        if coalesced and response is not None:
+            # The leader's object is shared: mark a copy, so only this caller's answer reads as reused
+            response = _reused(response.model_copy(), "single_flight")
+    else:
+        response, coalesced = request(), False
+
+    if meter is not None:
+        # A coalesced answer costs this query nothing, like a cache hit
+        meter.add_call(stage, time.perf_counter() - started, ok=response is not None,
+                       cache_hit=coalesced and response is not None)
+    return response
+
+
+def _call_chain(messages, chain, response_format, retry, temperature, stage, hedge, cache):
+    """
+    The request itself: each model of the fallback chain in turn (hedged if
+    asked). The answer is cached under the key of the model that gave it.
+    """
+    for i, alias in enumerate(chain):
+        if i > 0:
+            print(f"Falling back to '{alias}' for stage '{stage or 'default'}'.")
+        if not hedge or retry:
+            served = _served(alias, _call_with_retries(messages, alias, response_format, retry, temperature, stage))
+        else:
+            hedge_model = (LLM_HEDGE_MODELS or {}).get(alias, alias)
+            _check_model(hedge_model)
+            served = run_hedged(
+                lambda m=alias: _served(m, _call_with_retries(messages, m, response_format, retry, temperature, stage)),
+                lambda m=hedge_model: _served(m, _call_with_retries(messages, m, response_format, retry, temperature,
+                                                                     stage)),
+                hedge_delay(stage),
+            )
+        if served is not None:
+            model, response = served
+            response.served_by = model
+            if cache:
+                key = request_key(messages, MODELS[model]["model_name"], temperature, response_format)
+                get_cache("llm").put(key, response.model_dump_json())
+            return response
+    return None
+
+
+def _served(model, response):
+    """(model, response), or None for a failed call, so a hedge race or fallback tells which model answered."""
+    return None if response is None else (model, response)
+
+
+def served_by(response, model):
+    """Alias of the model that gave `response` (a fallback's or hedge's when one answered), else `model`."""
+    return getattr(response, "served_by", None) or model
+
+
+def _reused(response, source):
+    response.reused_from = source
+    return response
+
+
+def reused_from(response):
+    """
+    "cache", "cassette" or "single_flight" when `response` was not fetched from
+    the provider for this call (so its latency says nothing about the model), else None.
+    """
+    return getattr(response, "reused_from", None)
+
 
+async def acall_model(messages, model=current_model, response_format=None, temperature=1, *,
+                      stage=None, hedge=None, cache=None):
+    """
+    asyncio counterpart of call_model, with the same governor, breakers,
+    fallback chain, hedging, response cache, single-flight and metering. Waiting (queue slots,
+    backoff, hedge delays) is done with awaits, so many queries can share one
+    event loop. Recorded/replayed through the cassette like call_model.
+    Returns None when the call ultimately fails.
+    """
+    cassette = get_cassette()
+    if cassette is None:
+        return await _acall_model(messages, model, response_format, temperature, stage, hedge, cache)
+
+    _check_model(model)
+    key = request_key(messages, MODELS[model]["model_name"], temperature, response_format)
+    if cassette.replaying:
+        entry = _replay(cassette, key, model, stage)
+        if entry is None:
+            return None
+        await asyncio.sleep(cassette.delay(entry))
+        return _reused(_completion(MODELS[model]["model_name"], entry["content"], entry.get("usage")), "cassette")
+
+    started = time.perf_counter()
+    response = await _acall_model(messages, model, response_format, temperature, stage, hedge, cache)
+    if response is not None:
+        usage = response.usage.model_dump() if response.usage else None
+        cassette.record(key, model, response.choices[0].message.content, usage, time.perf_counter() - started)
+    return response
+
+
+async def _acall_model(messages, model, response_format, temperature, stage, hedge, cache):
+    chain = fallback_chain(model, stage)
+    for alias in chain:
+        _check_model(alias)
+
+    meter = current_meter()
+    if _over_budget(meter, stage):
+        return None
+    started = time.perf_counter()
+
+    if cache is None:
+        cache = LLM_CACHE
+    cache_key = None
+    if cache:
+        cache_key = request_key(messages, MODELS[model]["model_name"], temperature, response_format)
+        cached = await asyncio.to_thread(get_cache("llm").get, cache_key)
+        if cached is not None:
+            try:
+                response = ChatCompletion.model_validate_json(cached)
+                if meter is not None:
+                    meter.add_call(stage, time.perf_counter() - started, cache_hit=True)
+                return _reused(response, "cache")
+            except Exception as e:
+                print(f"[CACHE] Ignoring unreadable cached response: {e}")
+
+    if hedge is None:
+        hedge = LLM_HEDGE_ENABLED
+
+    request = lambda: _acall_chain(messages, chain, response_format, temperature, stage, hedge, cache)
+    if LLM_SINGLE_FLIGHT:
+        key = cache_key or request_key(messages, MODELS[model]["model_name"], temperature, response_format)
+        response, coalesced = await acoalesce(key, request)
+        if coalesced and response is not None:
+            response = _reused(response.model_copy(), "single_flight")
+    else:
+        response, coalesced = await request(), False
+
+    if meter is not None:
+        meter.add_call(stage, time.perf_counter() - started, ok=response is not None,
+                       cache_hit=coalesced and response is not None)
+    return response
+
+
+async def _acall_chain(messages, chain, response_format, temperature, stage, hedge, cache):
+    """Async _call_chain."""
+    async def attempt(model):
+        return _served(model, await _acall_with_retries(messages, model, response_format, temperature, stage))
+
+    for i, alias in enumerate(chain):
+        if i > 0:
+            print(f"Falling back to '{alias}' for stage '{stage or 'default'}'.")
+        if not hedge:
+            served = await attempt(alias)
+        else:
+            hedge_model = (LLM_HEDGE_MODELS or {}).get(alias, alias)
+            _check_model(hedge_model)
+            served = await arun_hedged(lambda m=alias: attempt(m), lambda m=hedge_model: attempt(m),
+                                       hedge_delay(stage))
+        if served is not None:
+            model, response = served
+            response.served_by = model
+            if cache:
+                key = request_key(messages, MODELS[model]["model_name"], temperature, response_format)
+                await asyncio.to_thread(get_cache("llm").put, key, response.model_dump_json())
+            return response
+    return None
+
+
+async def _acall_with_retries(messages, model, response_format, temperature, stage):
+    """Async _call_with_retries. Returns None on failure."""
+    info, client, governor, breaker, params = _prepare_request(
+        messages, model, response_format, temperature, client_factory=get_async_client)
+    reserved = estimate_tokens(messages)
+
+    max_attempts = LLM_MAX_RETRIES + 1
+    for attempt in range(max_attempts):
+        if not breaker.allow():
+            print(f"Circuit open for {info['provider']}; skipping '{model}'.")
+            return None
+
+        try:
+            async with governor.aslot(reserved) as slot:
+                started = time.perf_counter()
+                response = await client.chat.completions.create(**params)
+                elapsed = time.perf_counter() - started
+                slot["used"] = getattr(response.usage, "total_tokens", None)
+            observe_latency(stage, elapsed)
+            breaker.record_success(elapsed)
+            _record_usage(info, response.usage, model, stage)
+            return response
+        except asyncio.CancelledError:
+            # Lost a hedge race or the query was abandoned: says nothing about the provider
+            breaker.release()
+            raise
+        except Exception as e:
+            should_retry, retry_after = _handle_error(e, info["provider"], breaker, attempt, max_attempts)
+            if not should_retry:
+                return None
+        await asyncio.sleep(_retry_delay(governor, attempt, max_attempts, retry_after))
+
+    print("Retry failed. No further attempts.")
+    return None
+
+
+def _over_budget(meter, stage):
+    """True (and the call is counted as blocked) once the active meter's budget is spent."""
+    if meter is None:
+        return False
+    reason = meter.exceeded()
+    if not reason:
+        return False
+    meter.block()
+    print(f"Skipping call for stage '{stage or 'default'}': {reason}.")
+    return True
+
+
+def _check_model(model):
     if model not in MODELS:
         available = ", ".join(MODELS.keys())
         raise ValueError(f"Invalid model '{model}'. Available models: {available}")
 
-    info = MODELS[model]
-    provider = info["provider"]
-    model_name = info["model_name"]
-    endpoint = info.get("endpoint")
 
-    # Use the single global API_KEY
-    api_key = API_KEY
+def _api_key_for(provider, keyless=False):
+    """
+    Provider-specific key (<PROVIDER>_API_KEY) when configured, else the global API_KEY.
+    Keyless endpoints (the local stand-in) get a placeholder when neither is set.
+    """
+    api_key = get_api_key(provider) or API_KEY
+    if keyless and (not api_key or api_key == "..."):
+        return "stand-in"
     if not api_key or api_key == "...":
         raise ValueError(f"API_KEY is not set. Please add your API key for the '{provider}' provider to the script.")
+    return api_key
 
-    try:
-        if endpoint:
-            # Use the custom endpoint for DeepSeek or Google
-            client = OpenAI(api_key=api_key, base_url=endpoint)
-        else:
-            # Use the default OpenAI endpoint
-            client = OpenAI(api_key=api_key)
 
-        params = {"model": model_name, "messages": messages, "temperature": temperature}
-        if response_format:
-            params["response_format"] = response_format
+def _call_with_retries(messages, model, response_format, retry, temperature, stage):
+    """One governed request to `model`, retried with backoff. Returns None on failure."""
+    info, client, governor, breaker, params = _prepare_request(messages, model, response_format, temperature)
+    reserved = estimate_tokens(messages)
 
-        response = client.chat.completions.create(**params)
+    # retry=True means the caller is already retrying: a single attempt only
+    max_attempts = 1 if retry else LLM_MAX_RETRIES + 1
+    for attempt in range(max_attempts):
+        if not breaker.allow():
+            print(f"Circuit open for {info['provider']}; skipping '{model}'.")
+            return None
 
-        input_tokens = response.usage.prompt_tokens
-        output_tokens = response.usage.completion_tokens
+        try:
+            with governor.slot(reserved) as slot:
+                started = time.perf_counter()
+                response = client.chat.completions.create(**params)
+                elapsed = time.perf_counter() - started
+                slot["used"] = getattr(response.usage, "total_tokens", None)
+            observe_latency(stage, elapsed)
+            breaker.record_success(elapsed)
+            _record_usage(info, response.usage, model, stage)
+            return response
+        except Exception as e:
+            should_retry, retry_after = _handle_error(e, info["provider"], breaker, attempt, max_attempts)
+            if not should_retry:
+                return None
+        _pause_before_retry(governor, attempt, max_attempts, retry_after)
+
+    print("Retry failed. No further attempts.")
+    return None
+
+
+def stream_model(messages, model=current_model, response_format=None, temperature=1, *, stage=None, cache=None,
+                 sink=None):
+    """
+    Streaming counterpart of call_model: a generator of text deltas.
+    Shares the governor, circuit breakers, fallback chain, response cache and
+    metering with call_model. Errors are retried (or failed over) only while
+    nothing has been yielded yet; a stream that breaks midway just ends.
+    Recorded/replayed through the cassette like call_model; a replayed answer
+    is re-cut into small deltas. A `sink` dict gets the alias of the model
+    that answered ("model", when a fallback did), the usage, and "reused_from"
+    when the answer came from the cache or cassette (see reused_from()).
+    """
+    cassette = get_cassette()
+    if cassette is None:
+        yield from _stream_model(messages, model, response_format, temperature, stage, cache, sink)
+        return
 
+    _check_model(model)
+    key = request_key(messages, MODELS[model]["model_name"], temperature, response_format)
+    if cassette.replaying:
+        entry = _replay(cassette, key, model, stage)
+        if entry is None:
+            return
+        time.sleep(cassette.delay(entry))
+        if sink is not None:
+            sink["reused_from"] = "cassette"
+        content = entry["content"] or ""
+        for i in range(0, len(content), REPLAY_CHUNK_CHARS):
+            yield content[i:i + REPLAY_CHUNK_CHARS]
+        return
+
+    started = time.perf_counter()
+    pieces = []
+    sink = {} if sink is None else sink
+    for piece in _stream_model(messages, model, response_format, temperature, stage, cache, sink):
+        pieces.append(piece)
+        yield piece
+    if pieces:
+        cassette.record(key, model, "".join(pieces), sink.get("usage"), time.perf_counter() - started)
+
+
+def _stream_model(messages, model, response_format, temperature, stage, cache, sink=None):
+    chain = fallback_chain(model, stage)
+    for alias in chain:
+        _check_model(alias)
+
+    meter = current_meter()
+    if _over_budget(meter, stage):
+        return
+    started = time.perf_counter()
+
+    if cache is None:
+        cache = LLM_CACHE
+    cache_key = None
+    if cache:
+        cache_key = request_key(messages, MODELS[model]["model_name"], temperature, response_format)
+        cached = get_cache("llm").get(cache_key)
+        if cached is not None:
+            try:
+                content = ChatCompletion.model_validate_json(cached).choices[0].message.content or ""
+                if meter is not None:
+                    meter.add_call(stage, time.perf_counter() - started, cache_hit=True)
+                if sink is not None:
+                    sink["reused_from"] = "cache"
+                yield content
+                return
+            except Exception as e:
+                print(f"[CACHE] Ignoring unreadable cached response: {e}")
+
+    pieces = []
+    for i, alias in enumerate(chain):
+        if i > 0:
+            print(f"Falling back to '{alias}' for stage '{stage or 'default'}'.")
+        for piece in _stream_with_retries(messages, alias, response_format, temperature, stage, sink):
+            pieces.append(piece)
+            yield piece
+        if pieces:
+            break
+
+    if pieces and sink is not None:
+        sink["model"] = alias
+    if pieces and cache_key:
+        # Under the key of the model that answered, which is a fallback's own after a failover
+        model_name = MODELS[alias]["model_name"]
+        key = request_key(messages, model_name, temperature, response_format)
+        get_cache("llm").put(key, _completion(model_name, "".join(pieces)).model_dump_json())
+    if meter is not None:
+        meter.add_call(stage, time.perf_counter() - started, ok=bool(pieces))
+
+
+def _stream_with_retries(messages, model, response_format, temperature, stage, sink=None):
+    info, client, governor, breaker, params = _prepare_request(messages, model, response_format, temperature)
+    params.update(stream=True, stream_options={"include_usage": True})
+    reserved = estimate_tokens(messages)
+
+    max_attempts = LLM_MAX_RETRIES + 1
+    for attempt in range(max_attempts):
+        if not breaker.allow():
+            print(f"Circuit open for {info['provider']}; skipping '{model}'.")
+            return
+
+        yielded = False
+        try:
+            with governor.slot(reserved) as slot:
+                started = time.perf_counter()
+                usage = None
+                chars = 0
+                with client.chat.completions.create(**params) as stream:
+                    for chunk in stream:
+                        if chunk.usage:
+                            usage = chunk.usage
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            piece = chunk.choices[0].delta.content
+                            chars += len(piece)
+                            yielded = True
+                            yield piece
+                elapsed = time.perf_counter() - started
+                if usage is None:
+                    # Provider sent no usage chunk: estimate so budgets still apply
+                    usage = CompletionUsage(prompt_tokens=reserved - EXPECTED_COMPLETION_TOKENS,
+                                            completion_tokens=chars // CHARS_PER_TOKEN, total_tokens=0)
+                slot["used"] = usage.prompt_tokens + usage.completion_tokens
+            observe_latency(stage, elapsed)
+            breaker.record_success(elapsed)
+            _record_usage(info, usage, model, stage)
+            if sink is not None:
+                sink["usage"] = usage.model_dump()
+            return
+        except GeneratorExit:
+            breaker.release()
+            raise
+        except Exception as e:
+            should_retry, retry_after = _handle_error(e, info["provider"], breaker, attempt, max_attempts)
+            if not should_retry or yielded:
+                return
+        _pause_before_retry(governor, attempt, max_attempts, retry_after)
+
+    print("Retry failed. No further attempts.")
+
+
+def _prepare_request(messages, model, response_format, temperature, client_factory=get_client):
+    info = MODELS[model]
+    provider = info["provider"]
+    api_key = _api_key_for(provider, info.get("keyless", False))
+
+    # Shared, pooled client per provider/endpoint (DeepSeek and Google use a custom endpoint)
+    client = client_factory(provider, api_key, info.get("endpoint"))
+    params = {"model": info["model_name"], "messages": messages, "temperature": temperature}
+    # A fallback model may sit on a provider without json_schema support
+    response_format = adapt_response_format(response_format, provider)
+    if response_format:
+        params["response_format"] = response_format
+    return info, client, get_governor(provider), get_breaker(provider), params
+
+
+def _handle_error(e, provider, breaker, attempt, max_attempts):
+    """Log an API error and update the breaker. Returns (should_retry, retry_after)."""
+    if isinstance(e, QueueTimeout):
+        breaker.release()
+        print(f"{e}. Giving up.")
+        return False, None
+    if isinstance(e, AuthenticationError):
+        breaker.record_failure()
+        print(f"Authentication failed. Check if the API_KEY is correct for the '{provider}' provider.")
+        return False, None
+    if isinstance(e, RateLimitError):
+        breaker.release()
+        print(f"Rate limit exceeded for {provider} (attempt {attempt + 1}/{max_attempts}).")
+        return True, retry_after_seconds(e)
+    if isinstance(e, (APIConnectionError, InternalServerError)):
+        breaker.record_failure()
+        print(f"Transient API error from {provider} (attempt {attempt + 1}/{max_attempts}): {str(e)}")
+        return True, None
+    if isinstance(e, APIError):
+        breaker.release()
+        print(f"API error from {provider}: {str(e)}")
+        return False, None
+    breaker.record_failure()
+    print(f"An unexpected error occurred with {provider}: {str(e)}")
+    return True, None
+
+
+def _retry_delay(governor, attempt, max_attempts, retry_after):
+    """Seconds to wait before the next attempt (0.0 after the last one)."""
+    if attempt + 1 >= max_attempts:
+        return 0.0
+    delay = backoff_delay(attempt, retry_after)
+    if retry_after is not None:
+        # Every caller of this provider backs off, not just this one
+        governor.cool_down(delay)
+    print(f"Retrying in {delay:.1f} seconds...")
+    return delay
+
+
+def _pause_before_retry(governor, attempt, max_attempts, retry_after):
+    time.sleep(_retry_delay(governor, attempt, max_attempts, retry_after))
+
+
+def _completion(model_name, content, usage=None):
+    """Wrap text (streamed or replayed) as a ChatCompletion, the format of the response cache and callers."""
+    return ChatCompletion(
+        id="local", object="chat.completion", created=int(time.time()), model=model_name,
+        choices=[{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+        usage=usage,
+    )
+
+
+def _replay(cassette, key, model, stage):
+    """
+    Look up a recorded answer and account for it as if it came from the API
+    (usage, cost, meter). Returns the cassette entry, or None on a miss.
+    """
+    _check_model(model)
+    meter = current_meter()
+    if _over_budget(meter, stage):
+        return None
+    entry = cassette.get(key)
+    if entry is None:
+        print(f"[CASSETTE] No recording for stage '{stage or 'default'}' on '{model}'; cannot answer offline.")
+        if meter is not None:
+            meter.add_call(stage, 0.0, ok=False)
+        return None
+    if entry.get("usage"):
+        _record_usage(MODELS[model], CompletionUsage.model_validate(entry["usage"]), model, stage)
+    if meter is not None:
+        meter.add_call(stage, cassette.delay(entry))
+    return entry
+
+
+def cached_prompt_tokens(usage):
+    """Prompt tokens served from the provider's prefix cache (OpenAI/Gemini details, or DeepSeek's hit count)."""
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None)
+    if cached is None:
+        cached = getattr(usage, "prompt_cache_hit_tokens", None)
+    return int(cached or 0)
+
+
+def _record_usage(info, usage, model=None, stage=None):
+    """Update the global usage/cost counters and the active meter from a response's usage."""
+    global total_input_tokens, total_output_tokens, total_cached_tokens, total_cost, num_api_calls
+    global last_input_tokens, last_output_tokens, last_cost
+
+    input_tokens = usage.prompt_tokens
+    output_tokens = usage.completion_tokens
+    cached_tokens = min(cached_prompt_tokens(usage), input_tokens)
+
+    rates = info["cost_per_million"]
+    cost_in = (input_tokens - cached_tokens) * (rates["input"] / TOKENS_PER_MILLION)
+    cost_cached = cached_tokens * (rates.get("cached_input", rates["input"]) / TOKENS_PER_MILLION)
+    cost_out = output_tokens * (rates["output"] / TOKENS_PER_MILLION)
+    cost = cost_in + cost_cached + cost_out
+
+    with _usage_lock:
         last_input_tokens = input_tokens
         last_output_tokens = output_tokens
-
-        rates = info["cost_per_million"]
-        cost_in = input_tokens * (rates["input"] / TOKENS_PER_MILLION)
-        cost_out = output_tokens * (rates["output"] / TOKENS_PER_MILLION)
-        last_cost = cost_in + cost_out
+        last_cost = cost
 
         total_input_tokens += input_tokens
         total_output_tokens += output_tokens
-        total_cost += last_cost
+        total_cached_tokens += cached_tokens
+        total_cost += cost
         num_api_calls += 1
 
-        return response
-
-    except AuthenticationError:
-        print(f"Authentication failed. Check if the API_KEY is correct for the '{provider}' provider.")
-    except RateLimitError:
-        print(f"Rate limit exceeded for {provider}. Try again later.")
-    except APIError as e:
-        print(f"API error from {provider}: {str(e)}")
-    except Exception as e:
-        print(f"An unexpected error occurred with {provider}: {str(e)}")
-        if not retry:
-            print("Retrying in 1 second...")
-            time.sleep(1)
-            return call_model(messages, model, response_format, retry=True, temperature=temperature)
-        else:
-            print("Retry failed. No further attempts.")
-            return None
+    meter = current_meter()
+    if meter is not None:
+        meter.add_usage(stage, model, input_tokens, output_tokens, cost, cached_tokens)
 
 
 def print_costs():
@@ -140,10 +713,55 @@ def print_costs():
     print(f"Total API calls: {num_api_calls}")
     print(f"Average cost per call: $ {avg_cost:.6f}")
     print(f"Total input tokens: {total_input_tokens}")
+    print(f"Cached input tokens: {total_cached_tokens} ({total_cached_tokens / max(total_input_tokens, 1):.0%})")
     print(f"Total output tokens: {total_output_tokens}")
+    for name, stats in client_stats().items():
+        print(f"Connections {name}: {stats['requests']} requests, "
+              f"{stats['new_connections']} new, {stats['reused_connections']} reused")
+    for provider, stats in governor_stats().items():
+        print(f"Queue {provider}: avg wait {stats['avg_queue_wait_s']}s, "
+              f"max wait {stats['max_queue_wait_s']}s, throttled {stats['throttled']}x")
+    for namespace, stats in cache_stats().items():
+        print(f"Cache {namespace}: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%})")
+    parsing = parse_stats()
+    if parsing["strict"] or parsing["fallback"] or parsing["failed"]:
+        print(f"Parsing: {parsing['strict']} strict, {parsing['fallback']} lenient fallback, "
+              f"{parsing['failed']} failed, avg {parsing['avg_parse_ms']} ms")
+    cassette = cassette_stats()
+    if cassette:
+        print(f"Cassette ({cassette['mode']}): {cassette['hits']} replayed, {cassette['misses']} missed, "
+              f"{cassette['recorded']} recorded")
+    hedges = hedge_stats()
+    if hedges["hedges_fired"]:
+        print(f"Hedges: {hedges['hedges_fired']} fired, {hedges['hedges_won']} won "
+              f"({hedges['hedge_win_rate']:.0%}), {hedges['skipped_budget']} skipped by budget")
     print(f"--------------------\n")
 
 
+def prewarm_model_clients(models=None):
+    """
+    Pre-open pooled connections for the given MODELS aliases (default: all).
+    Aliases sharing a provider/endpoint share one client, so each is warmed once.
+    Keyless local endpoints are only warmed when asked for by name, and
+    providers without a key (their own or API_KEY) are skipped.
+    """
+    cassette = get_cassette()
+    if cassette is not None and cassette.replaying:
+        return 0
+    targets = {}
+    for alias in models or MODELS.keys():
+        info = MODELS.get(alias)
+        if not info or (info.get("keyless") and not models):
+            continue
+        try:
+            # The key the calls will use, so the warmed client is the one they get
+            api_key = _api_key_for(info["provider"], info.get("keyless", False))
+        except ValueError:
+            continue
+        targets[(info["provider"], info.get("endpoint"))] = (info["provider"], api_key, info.get("endpoint"))
+    return prewarm_clients(targets.values())
+
+
 # --- ADD: small helper to read the prompt file ---
 def _read_text(path: str) -> str:
     with open(path, "r", encoding="utf-8") as f:
@@ -186,10 +804,6 @@ def execute_prompt(
 
     # --- Path A: explicit OpenAI-compatible call (bench uses this) ---
     if model_id or base_url or api_key:
-        client = OpenAI(
-            api_key=api_key or os.getenv("OPENAI_API_KEY") or os.getenv("GOOGLE_API_KEY") or os.getenv("DEEPSEEK_API_KEY") or os.getenv("TOGETHER_API_KEY"),
-            base_url=base_url or None,
-        )
         params = {
             "model": model_id or api_model,   # prefer explicit id
             "messages": messages,
@@ -199,7 +813,26 @@ def execute_prompt(
         if "max_tokens"  in defaults: params["max_tokens"]  = defaults["max_tokens"]
         if "top_p"       in defaults: params["top_p"]       = defaults["top_p"]
 
-        resp = client.chat.completions.create(**params)
+        # Cassette record/replay (LLM_CASSETTE_MODE) so the bench can run offline
+        cassette = get_cassette()
+        key = request_key(messages, params["model"], params.get("temperature")) if cassette else None
+        if cassette is not None and cassette.replaying:
+            entry = cassette.get(key)
+            if entry is None:
+                raise RuntimeError(f"no cassette recording for {api_model} / {Path(prompt_file).name}")
+            time.sleep(cassette.delay(entry))
+            resp = _completion(params["model"], entry["content"], entry.get("usage"))
+        else:
+            client = get_client(
+                "bench",
+                api_key or os.getenv("OPENAI_API_KEY") or os.getenv("GOOGLE_API_KEY") or os.getenv("DEEPSEEK_API_KEY") or os.getenv("TOGETHER_API_KEY"),
+                base_url or None,
+            )
+            started = time.perf_counter()
+            resp = client.chat.completions.create(**params)
+            if cassette is not None:
+                cassette.record(key, api_model, resp.choices[0].message.content,
+                                resp.usage.model_dump() if resp.usage else None, time.perf_counter() - started)
         text = (resp.choices[0].message.content or "").strip()
 
         # usage (if provider returns it)
@@ -209,6 +842,9 @@ def execute_prompt(
                 last_output_tokens = int(resp.usage.completion_tokens or 0)
             except Exception:
                 pass
+            meter = current_meter()
+            if meter is not None:
+                meter.add_usage(Path(prompt_file).stem, api_model, last_input_tokens, last_output_tokens, 0.0)
         # last_cost intentionally left at 0.0; bench will compute from pricing
         return text
 
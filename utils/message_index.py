@@ -0,0 +1,85 @@
+# message_index.py
+# In-memory index over the `message` combination table, which maps each
+# line/material/structure/texture/surface/color value combination to a
+# message title. Given the values step 3 scored for the other attributes,
+# rank() weighs every combination by how well it agrees with them
+# (attributes that were not analyzed match anything) and ranks the titles
+# by their share of the total weight, without an LLM call.
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from utils.database_utils import connect_to_db
+
+# Weight of a combination value the analysis did not suggest for that attribute;
+# keeps such combinations in play instead of ruling them out
+UNSUGGESTED_WEIGHT = 0.05
+
+_lock = threading.Lock()
+_stats = {"derived": 0, "tiebreaks": 0, "reordered": 0}
+
+
+class MessageIndex:
+    def __init__(self, attributes: List[str], rows: List[tuple], titles: Dict[int, str]):
+        """attributes: the attr_names of the value columns; rows: (value id per attribute..., title id)."""
+        self.attributes = list(attributes)
+        self.titles = titles
+        # {combination: {title id: rows}}; duplicates weigh a title up, as in the table
+        self._combinations: Dict[tuple, Dict[int, int]] = {}
+        for *values, title_id in rows:
+            counts = self._combinations.setdefault(tuple(values), {})
+            counts[title_id] = counts.get(title_id, 0) + 1
+
+    @classmethod
+    def from_db(cls, attributes: List[str], names: Optional[Dict[int, str]] = None) -> "MessageIndex":
+        """
+        attributes: attr_names with a <attr_name>_value_id column in `message`
+        (e.g. "line"); names ({title id: name}) override the message_titles values.
+        """
+        columns = ", ".join(f"{attr}_value_id" for attr in attributes)
+        with connect_to_db() as conn:
+            rows = conn.execute(f"SELECT {columns}, message_title_id FROM message").fetchall()
+            titles = dict(conn.execute("SELECT id, value FROM message_titles").fetchall())
+        return cls(attributes, rows, {**titles, **(names or {})})
+
+    def rank(self, weights: Dict[str, Dict[int, float]]) -> List[Tuple[int, str, float]]:
+        """
+        [(title id, title, share)] best first. weights: {attr_name: {value id:
+        weight}} for the analyzed attributes; the others are left open.
+        """
+        known = [(i, weights[attr]) for i, attr in enumerate(self.attributes) if weights.get(attr)]
+        totals: Dict[int, float] = {}
+        for combination, counts in self._combinations.items():
+            weight = 1.0
+            for i, values in known:
+                weight *= values.get(combination[i], UNSUGGESTED_WEIGHT)
+            for title_id, count in counts.items():
+                totals[title_id] = totals.get(title_id, 0.0) + weight * count
+        total = sum(totals.values()) or 1.0
+        ranked = sorted(totals.items(), key=lambda item: (-item[1], item[0]))
+        return [(title_id, self.titles.get(title_id, ""), weight / total) for title_id, weight in ranked]
+
+
+_index: Optional[MessageIndex] = None
+
+
+def get_message_index(attributes: List[str], names: Optional[Dict[int, str]] = None) -> MessageIndex:
+    """The process-wide index; the table is read from the database once."""
+    global _index
+    if _index is not None:
+        return _index
+    with _lock:
+        if _index is None:
+            _index = MessageIndex.from_db(attributes, names)
+    return _index
+
+
+def record_message(kind: str, reordered: bool = False) -> None:
+    """Count a derived Mensagem ("derived") or a tie-break of the LLM's ("tiebreaks")."""
+    with _lock:
+        _stats[kind] += 1
+        _stats["reordered"] += reordered
+
+
+def message_index_stats() -> dict:
+    with _lock:
+        return dict(_stats)
@@ -0,0 +1,165 @@
+# metering.py
+# Per-request metering scopes for LLM usage.
+# A Meter aggregates tokens, cost, call count and time per stage for one
+# query. It travels in a ContextVar, so concurrent Streamlit sessions and the
+# step-3 worker threads each report into their own query's meter. A meter
+# can carry a token/cost budget; once it is spent, call_model short-circuits.
+import asyncio
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+_current: contextvars.ContextVar[Optional["Meter"]] = contextvars.ContextVar("llm_meter", default=None)
+
+
+class Meter:
+    def __init__(self, budget_tokens: Optional[int] = None, budget_cost: Optional[float] = None):
+        self.budget_tokens = budget_tokens or None
+        self.budget_cost = budget_cost or None
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._stages: Dict[str, dict] = {}
+        self.blocked_calls = 0
+        self.degradations = []
+        self.queue_wait_s = 0.0
+
+    def _stage(self, stage: Optional[str]) -> dict:
+        return self._stages.setdefault(stage or "default", {
+            "calls": 0, "cache_hits": 0, "failures": 0,
+            "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0, "cost": 0.0, "time_s": 0.0, "models": [],
+        })
+
+    def add_usage(self, stage, model, input_tokens, output_tokens, cost, cached_tokens=0) -> None:
+        """
+        One billed API response (hedge losers included: they were paid for).
+        cached_tokens is the part of input_tokens served from the provider's prompt cache.
+        """
+        with self._lock:
+            s = self._stage(stage)
+            s["input_tokens"] += input_tokens or 0
+            s["cached_tokens"] += cached_tokens or 0
+            s["output_tokens"] += output_tokens or 0
+            s["cost"] += cost or 0.0
+            if model and model not in s["models"]:
+                s["models"].append(model)
+
+    def add_call(self, stage, elapsed: float, ok: bool = True, cache_hit: bool = False) -> None:
+        """One logical call_model() as seen by the pipeline (retries/hedges folded in)."""
+        with self._lock:
+            s = self._stage(stage)
+            s["calls"] += 1
+            s["time_s"] += elapsed
+            if cache_hit:
+                s["cache_hits"] += 1
+            if not ok:
+                s["failures"] += 1
+
+    def totals(self) -> dict:
+        with self._lock:
+            stages = list(self._stages.values())
+        return {
+            "calls": sum(s["calls"] for s in stages),
+            "input_tokens": sum(s["input_tokens"] for s in stages),
+            "cached_tokens": sum(s["cached_tokens"] for s in stages),
+            "output_tokens": sum(s["output_tokens"] for s in stages),
+            "cost": sum(s["cost"] for s in stages),
+        }
+
+    def exceeded(self) -> Optional[str]:
+        """Reason string when the budget is spent, else None."""
+        totals = self.totals()
+        if self.budget_tokens and totals["input_tokens"] + totals["output_tokens"] >= self.budget_tokens:
+            return f"token budget of {self.budget_tokens} reached"
+        if self.budget_cost and totals["cost"] >= self.budget_cost:
+            return f"cost budget of ${self.budget_cost:.4f} reached"
+        return None
+
+    def block(self) -> None:
+        with self._lock:
+            self.blocked_calls += 1
+
+    def degrade(self, stage: str, reason: str, dropped=()) -> None:
+        """A stage went on with a partial answer (e.g. past the query deadline)."""
+        with self._lock:
+            self.degradations.append({"stage": stage, "reason": reason, "dropped": list(dropped)})
+
+    def summary(self) -> dict:
+        totals = self.totals()
+        with self._lock:
+            stages = {name: {**s, "cost": round(s["cost"], 6), "time_s": round(s["time_s"], 3)}
+                      for name, s in self._stages.items()}
+            blocked = self.blocked_calls
+            degradations = list(self.degradations)
+        return {
+            **totals,
+            "cost": round(totals["cost"], 6),
+            "wall_time_s": round(time.perf_counter() - self._started, 3),
+            "blocked_calls": blocked,
+            "degradations": degradations,
+            "queue_wait_s": round(self.queue_wait_s, 3),
+            "stages": stages,
+        }
+
+
+def current_meter() -> Optional[Meter]:
+    return _current.get()
+
+
+@contextmanager
+def metering_scope(budget_tokens: Optional[int] = None, budget_cost: Optional[float] = None):
+    """
+    with metering_scope() as meter:
+        call_model(...)
+    print(meter.summary())
+    """
+    meter = Meter(budget_tokens, budget_cost)
+    token = _current.set(meter)
+    try:
+        yield meter
+    finally:
+        _current.reset(token)
+
+
+def _run_with(meter: Meter, fn: Callable, args, kwargs):
+    _current.set(meter)
+    return fn(*args, **kwargs)
+
+
+def bind_meter(meter: Meter, fn: Callable) -> Callable:
+    """
+    Wrap fn so every call runs in a fresh context that reports into `meter`.
+    Use it for calls made from a generator (which must not leave a ContextVar
+    set between yields) and for functions submitted to thread pools.
+    """
+    def runner(*args, **kwargs):
+        return contextvars.copy_context().run(_run_with, meter, fn, args, kwargs)
+    return runner
+
+
+def bind_meter_iter(meter: Meter, fn: Callable) -> Callable:
+    """Like bind_meter, for generator functions: every step of the iteration runs in the meter's context."""
+    def runner(*args, **kwargs):
+        ctx = contextvars.copy_context()
+        ctx.run(_current.set, meter)
+        iterator = ctx.run(fn, *args, **kwargs)
+        while True:
+            try:
+                item = ctx.run(next, iterator)
+            except StopIteration:
+                return
+            yield item
+    return runner
+
+
+def bind_meter_async(meter: Meter, fn: Callable) -> Callable:
+    """Like bind_meter, for coroutine functions: each call runs as its own task reporting into `meter`."""
+    async def scoped(args, kwargs):
+        # A task runs in its own context copy, so this does not leak to the caller
+        _current.set(meter)
+        return await fn(*args, **kwargs)
+
+    async def runner(*args, **kwargs):
+        return await asyncio.ensure_future(scoped(args, kwargs))
+    return runner
@@ -0,0 +1,151 @@
+# model_router.py
+# Adaptive per-stage model routing.
+# Keeps rolling latency / error / JSON-validity samples per (stage, model) and
+# sends each stage to the fastest candidate whose success rate meets the
+# stage's quality floor. MODEL_ROUTING pins stages outright; a session's routes
+# dict keeps the first measured pick per stage for the rest of that session.
+# Outcomes are recorded for the model that actually answered (a fallback's or
+# hedge's, when one did), and only for answers fetched from the provider:
+# cache hits, cassette replays and shared single-flight answers are not samples.
+import glob
+import random
+import re
+import threading
+from collections import defaultdict, deque
+from pathlib import Path
+from typing import Dict, Optional
+
+from config.config import (
+    MODEL_ROUTER, MODEL_ROUTING, ROUTER_CANDIDATES, ROUTER_QUALITY_FLOOR, ROUTER_MIN_SAMPLES,
+    ROUTER_EXPLORE_RATE, ROUTER_BENCH_GLOB,
+)
+from utils.llm_utils import MODELS
+
+# Samples kept per (stage, model)
+SAMPLE_WINDOW = 100
+DEFAULT_QUALITY_FLOOR = 0.95
+
+_lock = threading.Lock()
+_samples: Dict[tuple, deque] = defaultdict(lambda: deque(maxlen=SAMPLE_WINDOW))
+_seeded = False
+
+
+def record_outcome(stage: Optional[str], model: str, latency_s: float, ok: bool, valid: bool) -> None:
+    """One pipeline call: did the model answer (ok) and did the answer parse into the expected JSON (valid)."""
+    if not stage:
+        return
+    with _lock:
+        _samples[(stage, model)].append((latency_s, ok and valid))
+
+
+def _summary(samples) -> dict:
+    latencies = sorted(latency for latency, _ in samples)
+    return {
+        "samples": len(samples),
+        "p50_latency_s": round(latencies[len(latencies) // 2], 3) if latencies else None,
+        "success_rate": round(sum(1 for _, good in samples if good) / len(samples), 3) if samples else None,
+    }
+
+
+def _candidates(stage: str, default: str) -> list:
+    configured = ROUTER_CANDIDATES or {}
+    chain = [default] + list(configured.get(stage) or configured.get("default") or [])
+    return [alias for alias in dict.fromkeys(chain) if alias in MODELS]
+
+
+def _quality_floor(stage: str) -> float:
+    floors = ROUTER_QUALITY_FLOOR or {}
+    return float(floors.get(stage, floors.get("default", DEFAULT_QUALITY_FLOOR)))
+
+
+def route(stage: Optional[str], session_routes: Optional[dict] = None, default: str = "gpt-4o") -> str:
+    """
+    Model alias for a stage:
+      1. MODEL_ROUTING[stage] (or MODEL_ROUTING["default"]) when pinned in config;
+      2. the session's earlier pick for the stage (sticky);
+      3. with MODEL_ROUTER on, the lowest-p50 candidate meeting the quality
+         floor (candidates without ROUTER_MIN_SAMPLES samples are tried now and
+         then, at ROUTER_EXPLORE_RATE, so their stats fill in);
+      4. `default`, which is not made sticky: it is what a stage gets before
+         any candidate has the samples to be picked on merit.
+    """
+    pins = MODEL_ROUTING or {}
+    pinned = pins.get(stage) or (pins.get("default") if stage else None)
+    if pinned:
+        return pinned
+    if not stage or not MODEL_ROUTER:
+        return default
+    if session_routes is not None and stage in session_routes:
+        return session_routes[stage]
+
+    _seed_from_bench()
+    candidates = _candidates(stage, default)
+    floor = _quality_floor(stage)
+    with _lock:
+        stats = {alias: _summary(list(_samples.get((stage, alias), ()))) for alias in candidates}
+
+    unexplored = [alias for alias in candidates if stats[alias]["samples"] < ROUTER_MIN_SAMPLES]
+    if unexplored and random.random() < ROUTER_EXPLORE_RATE:
+        # Exploration picks are not made sticky: one session should not be stuck on an untested model
+        return random.choice(unexplored)
+
+    eligible = [alias for alias in candidates
+                if alias not in unexplored and stats[alias]["success_rate"] >= floor]
+    if not eligible:
+        # Cold start (or no candidate meets the floor): the session keeps routing until one does
+        return default
+    choice = min(eligible, key=lambda alias: stats[alias]["p50_latency_s"])
+    if session_routes is not None:
+        session_routes[stage] = choice
+    return choice
+
+
+def _bench_stage(prompt_file: str) -> str:
+    # bench rows may carry Windows paths; take the file name either way
+    name = re.split(r"[\\/]", prompt_file)[-1]
+    return Path(name).stem.removeprefix("prompt_")
+
+
+def _seed_from_bench() -> None:
+    """Load llm/bench.py results (ROUTER_BENCH_GLOB) once, so routing has data before live traffic."""
+    global _seeded
+    if _seeded:
+        return
+    with _lock:
+        if _seeded:
+            return
+        _seeded = True
+    if not ROUTER_BENCH_GLOB:
+        return
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        print("[ROUTER] openpyxl not installed; skipping bench seeding.")
+        return
+
+    loaded = 0
+    for path in sorted(glob.glob(ROUTER_BENCH_GLOB)):
+        try:
+            rows = load_workbook(path, read_only=True).active.iter_rows(values_only=True)
+            headers = next(rows)
+            for values in rows:
+                row = dict(zip(headers, values))
+                # call_failed rows are bench harness errors (missing keys, bad config), not model quality
+                if row.get("model") not in MODELS or str(row.get("quality_reason") or "").startswith("call_failed"):
+                    continue
+                record_outcome(_bench_stage(str(row.get("prompt_file") or "")), row["model"],
+                               float(row.get("latency_ms") or 0) / 1000.0, True, bool(row.get("quality_ok")))
+                loaded += 1
+        except Exception as e:
+            print(f"[ROUTER] Could not read bench results {path}: {e}")
+    print(f"[ROUTER] Seeded {loaded} samples from bench results.")
+
+
+def router_stats() -> Dict[str, dict]:
+    """{stage: {model: {samples, p50_latency_s, success_rate}}}"""
+    with _lock:
+        items = [(key, list(samples)) for key, samples in _samples.items()]
+    stats: Dict[str, dict] = {}
+    for (stage, model), samples in sorted(items):
+        stats.setdefault(stage, {})[model] = _summary(samples)
+    return stats
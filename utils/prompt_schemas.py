@@ -0,0 +1,196 @@
+# prompt_schemas.py
+# JSON schemas for the pipeline prompts, keyed by stage name (prompt file stem
+# without "prompt_"). They are sent as response_format where the provider
+# supports it and checked by a single-pass strict parser; only answers that
+# fail the strict parse go through the lenient parser in execute_prompt.py.
+import json
+import threading
+from typing import Optional
+
+ATTRIBUTE_NAMES = ["Mensagem", "Linha", "Material", "Estrutura", "Textura", "Superfície", "Cor"]
+
+CATEGORY_NAMES = [
+    "BLUSAS & TOPS", "SHORTS", "SAIAS", "VESTIDOS", "CALÇAS", "CALÇAS JEANS", "BIQUÍNIS CALCINHA", "BIQUÍNIS TOP",
+    "COLETES", "CAMISETAS", "BLAZERS", "BODIES", "CAMISAS", "MACACÕES", "ROUPAS DE PRAIA", "SAÍDAS DE PRAIA",
+    "SUÉTERS", "CASACOS", "CONJUNTOS DE BIQUÍNI", "JAQUETAS",
+]
+
+# response_format type each provider accepts; providers not listed get none
+PROVIDER_FORMATS = {"openai": "json_schema", "deepseek": "json_object", "google": "json_object", "local": "json_schema"}
+
+
+def _string(enum=None) -> dict:
+    return {"type": "string", "enum": enum} if enum else {"type": "string"}
+
+
+def _object(properties: dict) -> dict:
+    # Strict structured outputs require every property listed and no extras
+    return {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
+
+
+def _ranked(prefix: str, count: int, name=None) -> dict:
+    properties = {}
+    for i in range(1, count + 1):
+        properties[f"{prefix}_{i}"] = name or _string()
+        properties[f"{prefix}_{i}_score"] = {"type": "integer"}
+        properties[f"{prefix}_{i}_justification"] = _string()
+    return properties
+
+
+def _attribute_values(count: int = 3) -> dict:
+    properties = {"attribute": _string()}
+    for i in range(1, count + 1):
+        properties[f"value_{i}_id"] = {"type": "integer"}
+        properties[f"value_{i}_name"] = _string()
+        properties[f"value_{i}_score"] = {"type": "integer"}
+        properties[f"value_{i}_justification"] = _string()
+    return _object(properties)
+
+
+_CONTEXT = {
+    "occasion": _object({
+        "formality": _string(["FORMAL", "INFORMAL", "N/A"]),
+        "time": _string(["DIA", "NOITE", "N/A"]),
+        "location": _string(["CIDADE", "CAMPO", "PRAIA", "N/A"]),
+        "activity": _string(["ESPORTE", "LAZER", "FESTA", "ATIVIDADES DIA A DIA", "TRABALHO", "N/A"]),
+    }),
+    "weather": _object({"climate": _string(["Hot", "Cold", "Temperate", "N/A"])}),
+}
+
+SCHEMAS = {
+    "context_analyzer": _object(_CONTEXT),
+    "0_attribute_selection": _object(_ranked("att", 5, _string(ATTRIBUTE_NAMES))),
+    # Fused steps 1 + 2 (FUSED_CONTEXT_SELECTION): context first, so it can be used before the attributes stream in
+    "context_selection": _object({**_CONTEXT, **_ranked("att", 5, _string(ATTRIBUTE_NAMES))}),
+    "1_att_mensagem": _attribute_values(),
+    "2_att_linha": _attribute_values(),
+    "3_att_material": _attribute_values(),
+    # Only two values exist for these attributes; a third would have to be invented
+    "4_att_estrutura": _attribute_values(2),
+    "5_att_textura": _attribute_values(2),
+    "6_att_superficie": _attribute_values(),
+    "7_att_cor": _attribute_values(),
+    "look_composer": _object(_ranked("cat", 5, _string(CATEGORY_NAMES))),
+}
+
+_lock = threading.Lock()
+_stats = {"strict": 0, "fallback": 0, "failed": 0, "parse_time_s": 0.0}
+
+
+def register_batch_schema(stage: str, parts: dict) -> dict:
+    """
+    Schema for one call answering several attribute analyzers: {key: analyzer stage}
+    becomes an object with each analyzer's schema under its key. Registered in
+    SCHEMAS as `stage`, so response_format_for and the strict parser find it.
+    """
+    with _lock:
+        if stage not in SCHEMAS:
+            SCHEMAS[stage] = _object({key: SCHEMAS[part] for key, part in parts.items()})
+        return SCHEMAS[stage]
+
+
+def get_schema(stage: Optional[str]) -> Optional[dict]:
+    return SCHEMAS.get(stage) if stage else None
+
+
+def response_format_for(stage: Optional[str]) -> Optional[dict]:
+    """json_schema response_format for a stage (None if the stage has no schema)."""
+    schema = get_schema(stage)
+    if schema is None:
+        return None
+    return {"type": "json_schema", "json_schema": {"name": stage, "schema": schema, "strict": True}}
+
+
+def adapt_response_format(response_format: Optional[dict], provider: str) -> Optional[dict]:
+    """Downgrade a json_schema response_format to what `provider` accepts."""
+    if not response_format or response_format.get("type") != "json_schema":
+        return response_format
+    supported = PROVIDER_FORMATS.get(provider)
+    if supported == "json_schema":
+        return response_format
+    if supported == "json_object":
+        return {"type": "json_object"}
+    return None
+
+
+def _check(value, schema: dict, path: str, errors: list):
+    """Validate value against the subset of JSON schema used above; returns the (coerced) value."""
+    kind = schema.get("type")
+    if kind == "object":
+        if not isinstance(value, dict):
+            errors.append(f"{path or '$'}: expected object")
+            return value
+        for key in schema.get("required", ()):
+            if key not in value:
+                errors.append(f"{path}.{key}: missing")
+        for key, sub in schema.get("properties", {}).items():
+            if key in value:
+                value[key] = _check(value[key], sub, f"{path}.{key}", errors)
+    elif kind == "integer":
+        if isinstance(value, str) and value.strip().lstrip("-").isdigit():
+            value = int(value)  # "8" from models that ignore the schema
+        elif isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if not isinstance(value, int) or isinstance(value, bool):
+            errors.append(f"{path}: expected integer, got {value!r}")
+    elif kind == "string":
+        if not isinstance(value, str):
+            errors.append(f"{path}: expected string, got {value!r}")
+        elif "enum" in schema and value not in schema["enum"]:
+            errors.append(f"{path}: {value!r} not in enum")
+    return value
+
+
+def conform(data, schema: dict) -> list:
+    """Coerce numeric strings to integers in place and return the list of schema violations."""
+    errors = []
+    _check(data, schema, "", errors)
+    return errors
+
+
+def conform_member(key: str, value, schema: Optional[dict]):
+    """conform for one top-level member of an answer (a streamed field): returns the coerced value."""
+    sub = (schema or {}).get("properties", {}).get(key)
+    return value if sub is None else _check(value, sub, f".{key}", [])
+
+
+def _strip_fence(content: str) -> str:
+    content = content.strip()
+    if content.startswith("```"):
+        content = content.split("\n", 1)[1] if "\n" in content else ""
+        if content.rstrip().endswith("```"):
+            content = content.rstrip()[:-3]
+    return content
+
+
+def parse_strict(content: str, schema: dict) -> dict:
+    """One json.loads over the (un-fenced) answer plus schema validation. Raises ValueError on any problem."""
+    data = json.loads(_strip_fence(content), strict=False)
+    errors = conform(data, schema)
+    if errors:
+        raise ValueError("; ".join(errors[:5]))
+    return data
+
+
+def split_context_selection(data):
+    """(context, attribute selection) from a fused context_selection answer; either part may be empty."""
+    if not isinstance(data, dict):
+        return {}, {}
+    context = {key: data[key] for key in _CONTEXT if key in data}
+    selection = {key: value for key, value in data.items() if key not in _CONTEXT}
+    return context, selection
+
+
+def record_parse(outcome: str, elapsed: float) -> None:
+    with _lock:
+        _stats[outcome] += 1
+        _stats["parse_time_s"] += elapsed
+
+
+def parse_stats() -> dict:
+    with _lock:
+        stats = dict(_stats)
+    parsed = stats["strict"] + stats["fallback"] + stats["failed"]
+    stats["avg_parse_ms"] = round(stats.pop("parse_time_s") / parsed * 1000, 3) if parsed else 0.0
+    stats["strict_rate"] = round(stats["strict"] / parsed, 3) if parsed else 0.0
+    return stats
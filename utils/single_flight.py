@@ -0,0 +1,178 @@
+# single_flight.py
+# Coalescing of identical work that is already in flight.
+# Queries: sessions asking the same canonical query while it runs attach to
+# the one pipeline run and get its full event stream (earlier events replayed,
+# then live). Whichever subscriber needs the next event pulls it from the
+# pipeline, so the run survives its first session leaving; it is closed when
+# the last one does.
+# LLM calls (LLM_SINGLE_FLIGHT): identical requests that overlap share one
+# API call, for sync and asyncio callers alike.
+import asyncio
+import concurrent.futures
+import threading
+from typing import Callable, Dict, Iterator
+
+from data.cache_runtime import canonicalize_query
+
+_lock = threading.Lock()
+_stats = {"flights": 0, "attached": 0, "calls": 0, "calls_coalesced": 0}
+
+
+class _Flight:
+    def __init__(self, key: str, events: Iterator):
+        self.key = key
+        self._events = events
+        self._pull = threading.Lock()
+        self._buffer = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+
+    def event(self, i: int):
+        """
+        Event number i, pulled from the pipeline if no subscriber has yet;
+        raises IndexError past the end, or the pipeline's own error for every subscriber.
+        """
+        if i < len(self._buffer):
+            return self._buffer[i]
+        with self._pull:  # one puller at a time; the others find the event buffered
+            while i >= len(self._buffer) and not self.done:
+                try:
+                    self._buffer.append(next(self._events))
+                except StopIteration:
+                    self._finish()
+                except BaseException as e:
+                    self.error = e
+                    self._finish()
+        if i < len(self._buffer):
+            return self._buffer[i]
+        if self.error is not None:
+            raise self.error
+        raise IndexError(i)
+
+    def _finish(self) -> None:
+        self.done = True
+        with _lock:
+            if _flights.get(self.key) is self:
+                del _flights[self.key]  # later identical queries start a run of their own
+
+    def leave(self) -> None:
+        with _lock:
+            self.subscribers -= 1
+            abandoned = self.subscribers == 0 and not self.done
+            if abandoned and _flights.get(self.key) is self:
+                del _flights[self.key]  # in the same step, so no session joins a run being closed
+        if abandoned:
+            with self._pull:
+                self.done = True
+                close = getattr(self._events, "close", None)
+                if close is not None:
+                    close()  # stops the pipeline run (and releases its admission slot)
+
+
+_flights: Dict[str, _Flight] = {}
+
+
+def query_flight_key(user_query: str, category_score_threshold: int = 6) -> str:
+    """Key of a query's run for join_flight, the same for every front end: threshold and canonical query text."""
+    return f"{category_score_threshold}:{canonicalize_query(user_query)}"
+
+
+def join_flight(key: str, start: Callable[[], Iterator]) -> Iterator:
+    """
+    Events of the run for `key`: attaches to the one in flight, or starts it
+    with start(). Every subscriber sees the whole stream from the first event.
+    """
+    with _lock:
+        flight = _flights.get(key)
+        if flight is None:
+            flight = _flights[key] = _Flight(key, start())
+            _stats["flights"] += 1
+        else:
+            _stats["attached"] += 1
+        flight.subscribers += 1
+    try:
+        i = 0
+        while True:
+            try:
+                event = flight.event(i)
+            except IndexError:
+                return
+            yield event
+            i += 1
+    finally:
+        flight.leave()
+
+
+_calls: Dict[str, concurrent.futures.Future] = {}
+
+
+def _claim(key: str):
+    """(future, leader): the shared slot for `key`, and whether this caller must fill it."""
+    with _lock:
+        _stats["calls"] += 1
+        future = _calls.get(key)
+        if future is not None:
+            _stats["calls_coalesced"] += 1
+            return future, False
+        future = _calls[key] = concurrent.futures.Future()
+        return future, True
+
+
+def _settle(key: str, future: concurrent.futures.Future, result=None, error=None) -> None:
+    with _lock:
+        _calls.pop(key, None)
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+def coalesce(key: str, fn: Callable):
+    """
+    fn(), or the result of the identical call already running -> (result, coalesced).
+    If that call fails (raises, is cancelled or returns None), this caller makes its own.
+    """
+    future, leader = _claim(key)
+    if not leader:
+        try:
+            result = future.result()
+        except BaseException:
+            result = None
+        if result is not None:
+            return result, True
+        return fn(), False
+    try:
+        result = fn()
+    except BaseException as e:
+        _settle(key, future, error=e)
+        raise
+    _settle(key, future, result)
+    return result, False
+
+
+async def acoalesce(key: str, fn: Callable):
+    """asyncio coalesce(): fn is a coroutine function; also shares calls with sync callers."""
+    future, leader = _claim(key)
+    if not leader:
+        try:
+            result = await asyncio.shield(asyncio.wrap_future(future))
+        except BaseException:
+            if not future.done():
+                raise  # this caller was cancelled, not the shared call
+            result = None
+        if result is not None:
+            return result, True
+        return await fn(), False
+    try:
+        result = await fn()
+    except BaseException as e:
+        _settle(key, future, error=e)
+        raise
+    _settle(key, future, result)
+    return result, False
+
+
+def single_flight_stats() -> dict:
+    with _lock:
+        return {**_stats, "in_flight_queries": len(_flights), "in_flight_calls": len(_calls)}
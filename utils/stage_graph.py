@@ -0,0 +1,186 @@
+# stage_graph.py
+# Dependency-graph scheduler for the query pipeline.
+# A pipeline is a set of named stages, each listing the stages whose results
+# it needs. Every stage starts as soon as its dependencies are done, so work
+# that does not depend on the previous LLM answer (prompt loading, DB lookups)
+# overlaps with it. Stages report UI events through an `emit` callback and the
+# scheduler yields them in emission order; each stage's start/end offsets are
+# kept as a timeline, from which the critical path is read off.
+import asyncio
+import concurrent.futures
+import inspect
+import queue
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+_EVENT = "event"
+_DONE = "done"
+
+
+class StopPipeline(Exception):
+    """Raised by a stage to end the run early; `event` becomes the run's terminal event."""
+
+    def __init__(self, event: dict):
+        super().__init__(event.get("message"))
+        self.event = event
+
+
+class StageGraph:
+    """
+    graph = StageGraph()
+    graph.add("context", lambda results, emit: ...)
+    graph.add("selection", lambda results, emit: ..., deps=("context",))
+    for event in graph.run():
+        ...
+    graph.results["selection"], graph.stop_event, graph.timeline()
+
+    A stage function gets the results of every finished stage (read its deps
+    only) and `emit`. Stages can only depend on stages added before them, so
+    the graph is acyclic by construction. One graph is built per run.
+    """
+
+    def __init__(self):
+        self._stages: Dict[str, tuple] = {}
+        self.results: Dict[str, object] = {}
+        self.stop_event: Optional[dict] = None
+        self._spans: Dict[str, list] = {}
+        self._started = None
+
+    def add(self, name: str, fn: Callable, deps: Iterable[str] = ()) -> "StageGraph":
+        deps = tuple(deps)
+        unknown = [dep for dep in deps if dep not in self._stages]
+        if name in self._stages or unknown:
+            raise ValueError(f"Stage {name!r}: duplicate name or unknown dependencies {unknown}")
+        self._stages[name] = (fn, deps)
+        return self
+
+    def _ready(self, launched) -> List[str]:
+        if self.stop_event is not None:
+            return []
+        return [name for name, (_, deps) in self._stages.items()
+                if name not in launched and all(dep in self.results for dep in deps)]
+
+    def _finish(self, name: str, outcome: Callable) -> None:
+        """Store a finished stage's result; a StopPipeline or error ends the run."""
+        try:
+            self.results[name] = outcome()
+        except StopPipeline as stop:
+            if self.stop_event is None:
+                self.stop_event = stop.event
+        except Exception as e:
+            print(f"Stage '{name}' failed: {e}")
+            if self.stop_event is None:
+                self.stop_event = {"status": "error", "message": f"Stage '{name}' failed: {e}"}
+
+    def _offset(self) -> float:
+        return time.perf_counter() - self._started
+
+    def _timed(self, name: str, fn: Callable, emit: Callable):
+        self._spans[name] = [self._offset(), None]
+        try:
+            return fn(self.results, emit)
+        finally:
+            self._spans[name][1] = self._offset()
+
+    def run(self, max_workers: Optional[int] = None, executor: Optional[concurrent.futures.Executor] = None):
+        """
+        Run the stages on a thread pool, yielding emitted events as they arrive.
+        executor: a shared pool to run on (left running afterwards); without
+        one the run gets a pool of its own.
+        """
+        self._started = time.perf_counter()
+        inbox: queue.Queue = queue.Queue()
+        emit = lambda event: inbox.put((_EVENT, event))
+        owned = executor is None
+        if owned:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or len(self._stages) or 1,
+                                                             thread_name_prefix="stage")
+        launched, running, futures = set(), 0, []
+        try:
+            while True:
+                for name in self._ready(launched):
+                    launched.add(name)
+                    running += 1
+                    future = executor.submit(self._timed, name, self._stages[name][0], emit)
+                    future.add_done_callback(lambda f, name=name: inbox.put((_DONE, name, f)))
+                    futures.append(future)
+                if not running:
+                    return
+                item = inbox.get()
+                if item[0] == _EVENT:
+                    yield item[1]
+                else:
+                    running -= 1
+                    self._finish(item[1], item[2].result)
+        finally:
+            # A consumer that stops iterating must not leave queued stages behind
+            if owned:
+                executor.shutdown(wait=False, cancel_futures=True)
+            else:
+                for future in futures:
+                    future.cancel()
+
+    async def arun(self):
+        """asyncio twin of run(): coroutine stages run as tasks, plain ones in worker threads."""
+        self._started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        inbox: asyncio.Queue = asyncio.Queue()
+        # Thread-safe, and keeps emit/done ordering since both go through the loop's callback queue
+        emit = lambda event: loop.call_soon_threadsafe(inbox.put_nowait, (_EVENT, event))
+        launched, tasks = set(), set()
+        try:
+            while True:
+                for name in self._ready(launched):
+                    launched.add(name)
+                    fn = self._stages[name][0]
+                    if inspect.iscoroutinefunction(fn):
+                        coro = self._atimed(name, fn, emit)
+                    else:
+                        coro = asyncio.to_thread(self._timed, name, fn, emit)
+                    task = asyncio.ensure_future(coro)
+                    task.add_done_callback(lambda t, name=name: inbox.put_nowait((_DONE, name, t)))
+                    tasks.add(task)
+                if not tasks:
+                    return
+                item = await inbox.get()
+                if item[0] == _EVENT:
+                    yield item[1]
+                else:
+                    tasks.discard(item[2])
+                    self._finish(item[1], item[2].result)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _atimed(self, name: str, fn: Callable, emit: Callable):
+        self._spans[name] = [self._offset(), None]
+        try:
+            return await fn(self.results, emit)
+        finally:
+            self._spans[name][1] = self._offset()
+
+    def timeline(self) -> List[dict]:
+        """[{stage, deps, start_s, end_s, duration_s}] in start order, offsets from the start of the run."""
+        rows = []
+        for name, (start, end) in sorted(self._spans.items(), key=lambda item: item[1][0]):
+            rows.append({
+                "stage": name,
+                "deps": list(self._stages[name][1]),
+                "start_s": round(start, 3),
+                "end_s": round(end, 3) if end is not None else None,
+                "duration_s": round(end - start, 3) if end is not None else None,
+            })
+        return rows
+
+    def critical_path(self) -> List[str]:
+        """Chain of stages that determined the run's length: from the last stage to end, back through the
+        dependency that finished last."""
+        finished = {name: span for name, span in self._spans.items() if span[1] is not None}
+        if not finished:
+            return []
+        path = [max(finished, key=lambda name: finished[name][1])]
+        while True:
+            deps = [dep for dep in self._stages[path[-1]][1] if dep in finished]
+            if not deps:
+                return path[::-1]
+            path.append(max(deps, key=lambda dep: finished[dep][1]))